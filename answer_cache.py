@@ -0,0 +1,189 @@
+# file: answer_cache.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os
+import re
+import time
+import logging
+import threading  # Nhiều session Streamlit cùng đọc/ghi cache.
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np  # So khớp cosine giữa embedding câu hỏi mới và các câu hỏi đã lưu.
+
+import collection_events  # Phiên bản collection: thay đổi khi /save_milvus chèn dữ liệu mới.
+
+logger = logging.getLogger(__name__)
+
+# --- II. CẤU HÌNH ---
+
+# Độ tương đồng cosine tối thiểu để coi hai câu hỏi là "cùng một câu hỏi".
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+# Số câu trả lời tối đa được giữ cho mỗi collection (bỏ câu ít được dùng lại nhất khi đầy).
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "256"))
+# Các công cụ cho kết quả thay đổi theo thời gian: câu trả lời dùng chúng không được lưu.
+VOLATILE_TOOLS = {"get_vietnam_current_time", "web_search"}
+# Độ rộng mỗi ô trong biểu đồ phân bố độ tương đồng (dùng để chỉnh ngưỡng).
+_HISTOGRAM_BIN = 0.05
+
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+
+def _numbers(text: str) -> Tuple[str, ...]:
+    """Các con số trong câu hỏi. "tháng 5" và "tháng 6" rất giống nhau về ngữ nghĩa nhưng khác đáp án."""
+    return tuple(sorted(_NUMBER.findall(text)))
+
+# --- III. CACHE CÂU TRẢ LỜI THEO NGỮ NGHĨA ---
+
+@dataclass
+class AnswerLookup:
+    """Kết quả tra cache. Được truyền lại cho `store` để lưu đúng phiên bản collection lúc hỏi."""
+    collection_name: str
+    question: str
+    embedding: np.ndarray
+    version: Tuple[int, int]
+    answer: Optional[str] = None
+    similarity: float = 0.0
+    matched_question: Optional[str] = None
+
+    @property
+    def hit(self) -> bool:
+        return self.answer is not None
+
+@dataclass
+class _CollectionEntries:
+    version: Tuple[int, int]
+    embeddings: np.ndarray  # (n, dim), đã chuẩn hóa L2.
+    questions: List[str] = field(default_factory=list)
+    answers: List[str] = field(default_factory=list)
+    numbers: List[Tuple[str, ...]] = field(default_factory=list)
+    latencies: List[float] = field(default_factory=list)  # Thời gian agent đã mất để tạo câu trả lời.
+    last_used: List[float] = field(default_factory=list)
+
+class SemanticAnswerCache:
+    """
+    Cache câu trả lời của agent, khóa theo embedding của câu hỏi + phiên bản collection.
+    - Câu hỏi mới có độ tương đồng cosine >= `threshold` với một câu đã lưu (và cùng các con số)
+      sẽ nhận lại câu trả lời cũ mà không cần gọi LLM và công cụ.
+    - Khi /save_milvus chèn dữ liệu (phiên bản trong `collection_events` thay đổi),
+      toàn bộ câu trả lời của collection đó bị hủy ở lần tra tiếp theo.
+    - `stats()` báo tỉ lệ trúng, thời gian tiết kiệm và phân bố độ tương đồng để chỉnh ngưỡng.
+    """
+
+    def __init__(self, embed_fn: Callable[[str], np.ndarray], threshold: float = ANSWER_CACHE_THRESHOLD,
+                 max_entries: int = ANSWER_CACHE_MAX_ENTRIES, version_fn=collection_events.get_version):
+        self._embed_fn = embed_fn
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._version_fn = version_fn
+        self._lock = threading.Lock()
+        self._collections: Dict[str, _CollectionEntries] = {}
+        self.lookups = 0
+        self.hits = 0
+        self.saved_s = 0.0
+        self.invalidations = 0
+        self._histogram: Dict[float, int] = {}
+
+    def _embed(self, text: str) -> np.ndarray:
+        vec = np.asarray(self._embed_fn(text), dtype=np.float32).ravel()
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def _entries(self, collection_name: str, version: Tuple[int, int]) -> Optional[_CollectionEntries]:
+        entries = self._collections.get(collection_name)
+        if entries is not None and entries.version != version:
+            # Dữ liệu đã thay đổi: mọi câu trả lời cũ có thể sai.
+            logger.info(f"Cache câu trả lời của '{collection_name}' bị hủy ({len(entries.answers)} mục) do dữ liệu thay đổi.")
+            del self._collections[collection_name]
+            self.invalidations += 1
+            entries = None
+        return entries
+
+    def lookup(self, collection_name: str, question: str) -> AnswerLookup:
+        """Tìm câu trả lời đã lưu cho câu hỏi tương tự. Kiểm tra `result.hit` để biết có trúng không."""
+        version = self._version_fn(collection_name)
+        embedding = self._embed(question)
+        result = AnswerLookup(collection_name, question, embedding, version)
+        with self._lock:
+            self.lookups += 1
+            entries = self._entries(collection_name, version)
+            if entries is None or not entries.answers:
+                return result
+            sims = entries.embeddings @ embedding
+            wanted = _numbers(question)
+            # Chỉ xét các câu đã lưu có cùng các con số với câu hỏi mới.
+            candidates = [i for i, nums in enumerate(entries.numbers) if nums == wanted]
+            if not candidates:
+                return result
+            best = max(candidates, key=lambda i: sims[i])
+            result.similarity = float(sims[best])
+            bucket = round(int(result.similarity / _HISTOGRAM_BIN) * _HISTOGRAM_BIN, 2)
+            self._histogram[bucket] = self._histogram.get(bucket, 0) + 1
+            if result.similarity >= self.threshold:
+                result.answer = entries.answers[best]
+                result.matched_question = entries.questions[best]
+                entries.last_used[best] = time.monotonic()
+                self.hits += 1
+                self.saved_s += entries.latencies[best]
+        return result
+
+    def store(self, lookup: AnswerLookup, answer: str, latency_s: float):
+        """Lưu câu trả lời của agent cho câu hỏi đã tra (bỏ qua nếu dữ liệu đã đổi trong lúc agent chạy)."""
+        if lookup.hit or not answer:
+            return
+        with self._lock:
+            if self._version_fn(lookup.collection_name) != lookup.version:
+                return  # Câu trả lời được tính trên dữ liệu cũ.
+            entries = self._entries(lookup.collection_name, lookup.version)
+            if entries is None:
+                entries = _CollectionEntries(lookup.version, np.empty((0, lookup.embedding.shape[0]), dtype=np.float32))
+                self._collections[lookup.collection_name] = entries
+            if len(entries.answers) >= self.max_entries:
+                self._evict(entries)
+            entries.embeddings = np.vstack([entries.embeddings, lookup.embedding[None, :]])
+            entries.questions.append(lookup.question)
+            entries.answers.append(answer)
+            entries.numbers.append(_numbers(lookup.question))
+            entries.latencies.append(latency_s)
+            entries.last_used.append(time.monotonic())
+
+    @staticmethod
+    def _evict(entries: _CollectionEntries):
+        oldest = int(np.argmin(entries.last_used))
+        entries.embeddings = np.delete(entries.embeddings, oldest, axis=0)
+        for values in (entries.questions, entries.answers, entries.numbers, entries.latencies, entries.last_used):
+            del values[oldest]
+
+    def stats(self) -> dict:
+        """Số lần tra, tỉ lệ trúng, tổng thời gian tiết kiệm và phân bố độ tương đồng của câu gần nhất."""
+        with self._lock:
+            return {
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+                "saved_s": round(self.saved_s, 2),
+                "invalidations": self.invalidations,
+                "entries": sum(len(e.answers) for e in self._collections.values()),
+                "threshold": self.threshold,
+                "similarity_histogram": dict(sorted(self._histogram.items())),
+            }
+
+def depends_on_history(history: list) -> bool:
+    """
+    Câu hỏi được hỏi sau ít nhất một lượt của người dùng (không tính lời chào của trợ lý) có thể phụ thuộc
+    ngữ cảnh ("còn tháng trước thì sao?"). Khóa cache chỉ gồm câu hỏi, nên các lượt này không được tra và không được lưu.
+    """
+    return any(getattr(message, "type", None) == "human" for message in history)
+
+def is_cacheable(trace_events: List[dict], succeeded: bool = True) -> bool:
+    """
+    Chỉ lưu câu trả lời agent đã hoàn thành (`succeeded`: có câu trả lời cuối, không dừng vì giới hạn
+    số bước/thời gian), không dùng công cụ thay đổi theo thời gian và không gặp lỗi.
+    """
+    if not succeeded:
+        return False
+    for event in trace_events:
+        if event["type"] in ("tool_error", "llm_error"):
+            return False
+        if event["type"] == "action" and event.get("tool") in VOLATILE_TOOLS:
+            return False
+    return True
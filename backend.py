@@ -16,6 +16,15 @@ import random
 import os
 import json
 import google.generativeai as genai  # SDK của Google cho các mô hình Gemini.
+import time  # Đo độ trễ từng bước OCR.
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple, Union
+# Parse JSON tăng dần/chịu lỗi, kiểm tra lược đồ hóa đơn và thống kê việc hỏi lại.
+from resource_scheduler import get_scheduler  # Chia nhân CPU giữa OCR / sửa lỗi / embedding.
+from receipt_parser import (StreamingJSONRepair, parse_llm_json, validate_receipt, suspect_field,
+                            extraction_stats, ALL_FIELDS)
 
 # --- II. CẤU HÌNH BAN ĐẦU ---
 
@@ -116,6 +125,201 @@ def extract_text_from_image(image_path: str) -> str:
     text = pytesseract.image_to_string(processed_img, lang='vie')
     return text
 
+# --- IV.1. OCR THÍCH ỨNG THEO ĐỘ TIN CẬY ---
+# Lượt nhanh: tiền xử lý nhẹ + `image_to_data` (có độ tin cậy từng từ). Chỉ những dòng có độ tin cậy thấp
+# mới được OCR lại với tiền xử lý nặng hơn (phóng to, morphology khác, PSM dòng đơn). Hóa đơn in rõ
+# không phải trả chi phí của pipeline đầy đủ; ảnh chụp kém có thêm cơ hội thứ hai cho các dòng khó.
+
+# "adaptive" (mặc định) hoặc "full" (pipeline cũ: một lần tiền xử lý nặng cho cả trang).
+OCR_MODE = os.getenv("OCR_MODE", "adaptive")
+# Dòng có độ tin cậy trung bình (0-100) dưới ngưỡng này sẽ được OCR lại.
+OCR_LINE_CONF_THRESHOLD = float(os.getenv("OCR_LINE_CONF_THRESHOLD", "70"))
+# Nếu quá tỉ lệ này số dòng phải OCR lại, chạy luôn pipeline đầy đủ cho cả trang (rẻ hơn xử lý từng dòng).
+OCR_FULL_PAGE_RATIO = float(os.getenv("OCR_FULL_PAGE_RATIO", "0.6"))
+# Dòng có độ tin cậy từ ngưỡng này trở lên được giữ nguyên, không đưa qua mô hình sửa lỗi.
+OCR_CORRECT_CONF_THRESHOLD = float(os.getenv("OCR_CORRECT_CONF_THRESHOLD", "85"))
+OCR_FAST_CONFIG = os.getenv("OCR_FAST_CONFIG", "--psm 4")  # Một cột văn bản, cỡ chữ thay đổi (kiểu hóa đơn).
+_LINE_PAD_PX = 6  # Lề thêm quanh mỗi dòng khi cắt ra để OCR lại.
+
+@dataclass
+class OcrLine:
+    text: str
+    conf: float  # Độ tin cậy trung bình của các từ (0-100).
+    bbox: Tuple[int, int, int, int]  # (left, top, width, height) trên ảnh của lượt nhanh.
+    block: int
+    escalated: bool = False
+
+@dataclass
+class OcrResult:
+    lines: List[OcrLine]
+    mode: str
+    timings_ms: Dict[str, float] = field(default_factory=dict)
+    corrected_lines: int = 0  # Số dòng được đưa qua mô hình sửa lỗi (đếm, không phải độ trễ).
+
+    @property
+    def text(self) -> str:
+        """Văn bản đầy đủ; các khối (block) cách nhau một dòng trống như `image_to_string`."""
+        parts, prev_block = [], None
+        for line in self.lines:
+            if prev_block is not None and line.block != prev_block:
+                parts.append("")
+            parts.append(line.text)
+            prev_block = line.block
+        return "\n".join(parts)
+
+    @property
+    def escalation_rate(self) -> float:
+        return sum(l.escalated for l in self.lines) / len(self.lines) if self.lines else 0.0
+
+    @property
+    def mean_conf(self) -> float:
+        return sum(l.conf for l in self.lines) / len(self.lines) if self.lines else 0.0
+
+def _lines_from_data(data: dict) -> List[OcrLine]:
+    """Gom kết quả `image_to_data` (từng từ) thành từng dòng với độ tin cậy trung bình."""
+    groups: Dict[tuple, List[int]] = {}
+    for i, word in enumerate(data["text"]):
+        if word.strip() and float(data["conf"][i]) >= 0:
+            groups.setdefault((data["block_num"][i], data["par_num"][i], data["line_num"][i]), []).append(i)
+    lines = []
+    for (block, _, _), idx in groups.items():
+        left = min(data["left"][i] for i in idx)
+        top = min(data["top"][i] for i in idx)
+        right = max(data["left"][i] + data["width"][i] for i in idx)
+        bottom = max(data["top"][i] + data["height"][i] for i in idx)
+        lines.append(OcrLine(
+            text=" ".join(data["text"][i] for i in idx),
+            conf=sum(float(data["conf"][i]) for i in idx) / len(idx),
+            bbox=(left, top, right - left, bottom - top), block=block,
+        ))
+    return lines
+
+def _ocr_lines(image: np.ndarray, config: str) -> List[OcrLine]:
+    data = pytesseract.image_to_data(image, lang='vie', config=config, output_type=pytesseract.Output.DICT)
+    return _lines_from_data(data)
+
+def _light_preprocess(image: Image.Image) -> Tuple[np.ndarray, np.ndarray]:
+    """Tiền xử lý nhẹ cho lượt nhanh: ảnh xám + phân ngưỡng OTSU (chữ đen trên nền trắng). Trả về (ảnh xám, ảnh nhị phân)."""
+    gray = cv2.cvtColor(np.array(resize_image_in_memory(image).convert("RGB")), cv2.COLOR_RGB2GRAY)
+    return gray, cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+
+def _heavy_variants(crop: np.ndarray):
+    """Các biến thể tiền xử lý nặng cho một dòng khó: phóng to, làm phẳng nền, morphology khác nhau."""
+    big = cv2.resize(crop, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+    background = cv2.GaussianBlur(big, (0, 0), sigmaX=15)
+    flattened = cv2.divide(big, background, scale=255)
+    inv = cv2.threshold(flattened, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+    yield 255 - auto_morphology(inv)  # Closing theo mật độ chữ (như pipeline cũ).
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2, 2))
+    yield 255 - cv2.morphologyEx(inv, cv2.MORPH_OPEN, kernel)  # Opening: bỏ nhiễu lấm tấm.
+    yield cv2.adaptiveThreshold(big, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 15)  # Ánh sáng không đều.
+
+def _escalate_line(gray: np.ndarray, line: OcrLine) -> OcrLine:
+    """OCR lại một dòng với các biến thể nặng (PSM 7: một dòng), giữ kết quả có độ tin cậy cao nhất."""
+    left, top, width, height = line.bbox
+    y0, y1 = max(0, top - _LINE_PAD_PX), min(gray.shape[0], top + height + _LINE_PAD_PX)
+    x0, x1 = max(0, left - _LINE_PAD_PX), min(gray.shape[1], left + width + _LINE_PAD_PX)
+    crop = gray[y0:y1, x0:x1]
+    best = line
+    for variant in (_heavy_variants(crop) if crop.size else ()):
+        candidates = _ocr_lines(variant, "--psm 7")
+        if not candidates:
+            continue
+        text = " ".join(c.text for c in candidates)
+        conf = sum(c.conf for c in candidates) / len(candidates)
+        if conf > best.conf:
+            best = OcrLine(text=text, conf=conf, bbox=line.bbox, block=line.block, escalated=True)
+    if best is line:
+        best = OcrLine(text=line.text, conf=line.conf, bbox=line.bbox, block=line.block, escalated=True)
+    return best
+
+def extract_text_adaptive(image_path: str) -> OcrResult:
+    """
+    OCR thích ứng: lượt nhanh cho cả trang, sau đó chỉ OCR lại các dòng có độ tin cậy thấp.
+    Nếu phần lớn các dòng đều kém, chạy pipeline đầy đủ cho cả trang; nếu kết quả đó không tốt hơn,
+    vẫn OCR lại từng dòng kém như bình thường (trang kém nhất không bị bỏ qua).
+    """
+    timings = {}
+    start = time.perf_counter()
+    img = Image.open(image_path)
+    gray, binary = _light_preprocess(img)
+    lines = _ocr_lines(binary, OCR_FAST_CONFIG)
+    timings["fast_ms"] = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    weak = [i for i, l in enumerate(lines) if l.conf < OCR_LINE_CONF_THRESHOLD]
+    mode = "lines" if weak else "fast"
+    if not lines or len(weak) / len(lines) > OCR_FULL_PAGE_RATIO:
+        # Gần như cả trang đều kém: chạy pipeline nặng cho cả trang (như chế độ "full").
+        full = OcrResult(_ocr_lines(preprocess_pipeline(img), ""), mode="full_page")
+        if full.mean_conf > OcrResult(lines, mode).mean_conf:
+            lines = [OcrLine(l.text, l.conf, l.bbox, l.block, escalated=True) for l in full.lines]
+            mode = "full_page"
+    if mode == "lines":
+        for i in weak:
+            lines[i] = _escalate_line(gray, lines[i])
+    timings["escalation_ms"] = (time.perf_counter() - start) * 1000
+    return OcrResult(lines=lines, mode=mode, timings_ms=timings)
+
+def extract_text_fast(image_path: str) -> str:
+    """Chỉ lượt OCR nhanh (không OCR lại, không sửa lỗi): dùng để xác nhận nhanh hóa đơn trùng lặp."""
+    with get_scheduler().stage("ocr"):
+        _, binary = _light_preprocess(Image.open(image_path))
+        return pytesseract.image_to_string(binary, lang='vie', config=OCR_FAST_CONFIG)
+
+def correct_text_adaptive(result: OcrResult) -> str:
+    """
+    Chỉ đưa các dòng có độ tin cậy thấp qua mô hình sửa lỗi (gom thành một batch);
+    các dòng đã rõ ràng được giữ nguyên. Dòng có độ tin cậy thấp được đánh dấu "[?]" cho bước trích xuất.
+    """
+    start = time.perf_counter()
+    weak = [i for i, l in enumerate(result.lines) if l.conf < OCR_CORRECT_CONF_THRESHOLD]
+    corrected = {}
+    if weak:
+        predictions = corrector([result.lines[i].text for i in weak], max_length=MAX_LENGTH)
+        corrected = {i: p[0]["generated_text"] if isinstance(p, list) else p["generated_text"]
+                     for i, p in zip(weak, predictions)}
+    parts, prev_block = [], None
+    for i, line in enumerate(result.lines):
+        if prev_block is not None and line.block != prev_block:
+            parts.append("")
+        parts.append(f"[?] {corrected[i]}" if i in corrected else line.text)
+        prev_block = line.block
+    result.timings_ms["correction_ms"] = (time.perf_counter() - start) * 1000
+    result.corrected_lines = len(weak)
+    return "\n".join(parts)
+
+class OcrStats:
+    """Thống kê OCR theo từng hóa đơn: tỉ lệ dòng phải OCR lại và độ trễ từng bước."""
+
+    def __init__(self, keep_last: int = 100):
+        self._lock = threading.Lock()
+        self.recent = deque(maxlen=keep_last)
+
+    def record(self, image_path: str, result: OcrResult):
+        with self._lock:
+            self.recent.append({
+                "file": os.path.basename(image_path), "mode": result.mode, "lines": len(result.lines),
+                "escalation_rate": round(result.escalation_rate, 3), "mean_conf": round(result.mean_conf, 1),
+                "corrected_lines": result.corrected_lines,
+                **{k: round(v, 1) for k, v in result.timings_ms.items()},
+            })
+
+    def report(self) -> dict:
+        with self._lock:
+            recent = list(self.recent)
+        n = len(recent) or 1
+        return {
+            "receipts": len(recent),
+            "avg_escalation_rate": round(sum(r["escalation_rate"] for r in recent) / n, 3),
+            "full_page_rate": round(sum(r["mode"] == "full_page" for r in recent) / n, 3),
+            "avg_latency_ms": {k: round(sum(r.get(k, 0) for r in recent) / n, 1)
+                               for k in ("fast_ms", "escalation_ms", "correction_ms")},
+            "per_receipt": recent,
+        }
+
+ocr_stats = OcrStats()
+
 # Kiểm tra xem có GPU (CUDA) không để tăng tốc các mô hình AI.
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 print(f"⏳ Đang tải mô hình sửa lỗi văn bản...")
@@ -149,9 +353,9 @@ genai.configure(api_key=selected_key)
 # Khởi tạo mô hình Gemini. 'gemini-2.5-flash' là một lựa chọn tốt, cân bằng giữa tốc độ và hiệu năng.
 model = genai.GenerativeModel('gemini-2.5-flash')
 
-def extract_structured_info(text: str) -> str:
+def build_extraction_prompt(text: str) -> str:
     """
-    Sử dụng mô hình Gemini để chuyển đổi văn bản OCR đã sửa thành một đối tượng JSON có cấu trúc.
+    Tạo prompt trích xuất đầy đủ cho văn bản OCR đã sửa.
     """
     # Prompt là phần quan trọng nhất, nó hướng dẫn chi tiết cho LLM cách hành xử và định dạng đầu ra.
     # Một prompt chi tiết, rõ ràng và có nhiều quy tắc sẽ cho kết quả chính xác và ổn định hơn.
@@ -259,15 +463,157 @@ Nhiệm vụ của bạn là phân tích văn bản được cung cấp và hãy
 - KHÔNG đưa ra bất kỳ giải thích, ghi chú hay văn bản nào ngoài JSON thuần.
 - ƯU TIÊN sự hiện diện rõ ràng: Một giá trị được ghi rõ ràng bên cạnh từ khóa (`Tổng cộng: 50.000`) luôn được ưu tiên hơn một giá trị suy luận.
 - Đảm bảo JSON đúng chuẩn để có thể `json.loads(...)` mà không lỗi.
+- Các dòng bắt đầu bằng "[?]" có độ tin cậy OCR thấp (đã được sửa tự động): hãy kiểm tra chéo chúng kỹ hơn; các dòng khác được nhận dạng rõ ràng.
 
 === Văn bản hóa đơn gốc ===
 \"\"\"{text}\"\"\"
 """
+    return prompt
+
+def extract_structured_info(text: str) -> str:
+    """
+    Sử dụng mô hình Gemini để chuyển đổi văn bản OCR đã sửa thành một đối tượng JSON có cấu trúc.
+    """
     # Gửi prompt (bao gồm cả hướng dẫn và dữ liệu) đến API của Gemini.
-    response = model.generate_content(prompt)
+    response = model.generate_content(build_extraction_prompt(text))
     # Trả về phần văn bản trong phản hồi của mô hình.
     return response.text
 
+# --- V.1. ĐỌC PHẢN HỒI DẠNG STREAMING VÀ CHỈ HỎI LẠI CÁC TRƯỜNG LỖI ---
+
+# Số lần hỏi lại tối đa cho các trường còn lỗi.
+MAX_REASK_ATTEMPTS = int(os.getenv("GEMINI_MAX_REASK_ATTEMPTS", "1"))
+
+# Mô tả ngắn của từng trường, dùng trong prompt hỏi lại (ngắn hơn nhiều so với prompt đầy đủ).
+FIELD_SPECS = {
+    "store_name": "string hoặc null (tên cửa hàng, thường ở dòng đầu)",
+    "website": "string hoặc null",
+    "address": "string hoặc null (địa chỉ cửa hàng)",
+    "payment_method": "string hoặc null ('Tiền mặt', 'Thẻ' hoặc tên ví điện tử)",
+    "receipt_number": "string hoặc null (số/mã hóa đơn)",
+    "receipt_datetime": "string hoặc null (định dạng YYYY-MM-DDTHH:MM:SS nếu được)",
+    "staff_name": "string hoặc null (thu ngân/nhân viên)",
+    "items": '[{"name": string, "quantity": số hoặc null, "unit_price": số hoặc null, "total_price": số hoặc null}]',
+    "total_amount": "số hoặc null (tổng cộng)",
+    "discount_amount": "số hoặc null (giảm giá)",
+    "paid_amount": "số hoặc null (đã thanh toán)",
+    "customer_paid": "số hoặc null (khách đưa)",
+    "change": "số hoặc null (tiền thừa)",
+}
+
+def _estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+def _usage_tokens(response, prompt: str, output: str) -> int:
+    """Tổng token của một lần gọi Gemini (ước lượng nếu API không trả về usage)."""
+    usage = getattr(response, "usage_metadata", None)
+    total = getattr(usage, "total_token_count", 0) if usage is not None else 0
+    return total or (_estimate_tokens(prompt) + _estimate_tokens(output))
+
+def stream_structured_info(text: str) -> Tuple[StreamingJSONRepair, int]:
+    """
+    Gọi Gemini ở chế độ streaming và đưa từng đoạn phản hồi vào bộ parse tăng dần ngay khi nhận được.
+    Nếu luồng bị ngắt giữa chừng, phần đã nhận vẫn được giữ lại để khôi phục.
+
+    Returns:
+        tuple: (bộ parse chứa phản hồi, số token đã dùng)
+    """
+    prompt = build_extraction_prompt(text)
+    parser = StreamingJSONRepair()
+    response = None
+    try:
+        response = model.generate_content(prompt, stream=True)
+        for chunk in response:
+            try:
+                parser.feed(chunk.text)
+            except ValueError:
+                continue  # Đoạn không có văn bản (ví dụ: chỉ chứa metadata).
+    except Exception as e:
+        print(f"⚠️ Luồng phản hồi từ Gemini bị ngắt: {e}")
+    return parser, _usage_tokens(response, prompt, parser.raw_text)
+
+def reask_fields(text: str, errors: dict) -> Tuple[dict, int]:
+    """
+    Chỉ hỏi lại Gemini các trường bị lỗi, với một prompt ngắn chỉ mô tả các trường đó.
+
+    Returns:
+        tuple: (dict chứa các trường được trả lời, số token đã dùng)
+    """
+    fields = [f for f in ALL_FIELDS if f in errors]
+    spec = ",\n".join(f'  "{f}": {FIELD_SPECS[f]}' for f in fields)
+    reasons = "; ".join(f"{f}: {errors[f]}" for f in fields)
+    prompt = f"""
+Bạn là "Kế toán viên Robot" trích xuất dữ liệu từ văn bản OCR của hóa đơn bán lẻ.
+CHỈ trích xuất các trường sau và trả về JSON thuần (không giải thích, không markdown):
+{{
+{spec}
+}}
+Lần trích xuất trước các trường này bị lỗi ({reasons}).
+- Chỉ lấy thông tin có rõ trong văn bản; nếu không có, đặt null.
+- Số tiền phải là số JSON không có dấu phân cách (ví dụ: 1250000).
+
+=== Văn bản hóa đơn gốc ===
+\"\"\"{text}\"\"\"
+"""
+    response = model.generate_content(prompt)
+    data, _ = parse_llm_json(response.text)
+    return data, _usage_tokens(response, prompt, response.text)
+
+def extract_receipt_fields(text: str) -> Union[dict, str]:
+    """
+    Trích xuất thông tin có cấu trúc một cách bền vững:
+    1. Stream phản hồi của Gemini qua bộ parse chịu lỗi (sửa dấu phẩy thừa, chú thích, JSON bị cắt ngang).
+    2. Kiểm tra lược đồ có kiểu và chuẩn hóa số tiền kiểu Việt Nam.
+    3. Chỉ hỏi lại các trường còn lỗi (thay vì chạy lại toàn bộ trích xuất).
+
+    Returns:
+        dict nếu thành công; chuỗi phản hồi thô nếu không khôi phục được gì (như hành vi cũ).
+    """
+    parser, first_tokens = stream_structured_info(text)
+    try:
+        data = parser.result()
+    except (ValueError, json.JSONDecodeError) as e:
+        print(f"❌ Lỗi khi parse JSON: {e}")
+        data = None
+    check = validate_receipt(data)
+    errors = dict(check.errors)
+    suspect = suspect_field(data, parser)
+    if suspect and suspect not in errors:
+        errors[suspect] = "phản hồi bị cắt ngang"
+
+    reasked, reask_tokens = 0, 0
+    for _ in range(MAX_REASK_ATTEMPTS):
+        if not errors:
+            break
+        print(f"🔁 Hỏi lại {len(errors)} trường lỗi: {', '.join(errors)}")
+        reasked += len(errors)
+        try:
+            extra, tokens = reask_fields(text, errors)
+        except Exception as e:
+            print(f"⚠️ Hỏi lại thất bại: {e}")
+            break
+        reask_tokens += tokens
+        fixed = validate_receipt(extra, required=tuple(errors))
+        for name in list(errors):
+            if name not in fixed.errors:
+                check.data[name] = fixed.data[name]
+                del errors[name]
+
+    failed = data is None and len(errors) == len(ALL_FIELDS)
+    extraction_stats.record(
+        repaired=parser.repaired, truncated=parser.truncated, reasked_fields=reasked,
+        tokens_used=first_tokens + reask_tokens,
+        # Cách cũ: mỗi lần lỗi phải chạy lại toàn bộ prompt trích xuất.
+        tokens_saved=max(0, first_tokens - reask_tokens) if reasked else 0,
+        failed=failed,
+    )
+    if failed:
+        return parser.raw_text.strip()
+    if errors:
+        print(f"⚠️ Các trường vẫn lỗi sau khi hỏi lại, đặt về rỗng: {errors}")
+    # Giữ đúng thứ tự và đủ các trường như lược đồ; trường còn lỗi được đặt null (hoặc danh sách rỗng).
+    return {name: check.data.get(name, [] if name == "items" else None) for name in ALL_FIELDS}
+
 # --- VI. CÁC HÀM TIỆN ÍCH VÀ PIPELINE CHÍNH ---
 
 def save_json_from_image_path(image_path: str, data: dict, output_root: str = "output_structured"):
@@ -298,35 +644,43 @@ def process_receipt(image_path: str):
     print("\n" + "="*50)
     print(f"🚀 Bắt đầu pipeline xử lý cho: {os.path.basename(image_path)}")
     print("="*50)
+    # Mỗi bước chạy trên nhóm nhân CPU riêng (xem resource_scheduler) để các lượt tải lên đồng thời
+    # không làm Tesseract, torch và embedding tranh nhau toàn bộ nhân.
+    scheduler = get_scheduler()
     
-    # Bước 1: Trích xuất văn bản thô từ ảnh bằng OCR.
-    print("🔍 Đang thực hiện OCR...")
-    raw_text = extract_text_from_image(image_path)
-    
-    # Bước 2: Sửa lỗi chính tả và lỗi OCR.
-    print("🧠 Đang sửa lỗi văn bản...")
-    corrected_text = correct_text(raw_text)
+    if OCR_MODE == "adaptive":
+        # Bước 1: OCR thích ứng — lượt nhanh, chỉ OCR lại các dòng có độ tin cậy thấp.
+        print("🔍 Đang thực hiện OCR (thích ứng)...")
+        with scheduler.stage("ocr"):
+            ocr_result = extract_text_adaptive(image_path)
+        # Bước 2: Chỉ sửa lỗi các dòng có độ tin cậy thấp.
+        print("🧠 Đang sửa lỗi các dòng có độ tin cậy thấp...")
+        with scheduler.stage("correct"):
+            corrected_text = correct_text_adaptive(ocr_result)
+        ocr_stats.record(image_path, ocr_result)
+        t = ocr_result.timings_ms
+        print(f"📊 OCR: {len(ocr_result.lines)} dòng, OCR lại {ocr_result.escalation_rate:.0%} ({ocr_result.mode}), "
+              f"sửa lỗi {ocr_result.corrected_lines} dòng; nhanh {t['fast_ms']:.0f} ms, "
+              f"OCR lại {t['escalation_ms']:.0f} ms, sửa lỗi {t['correction_ms']:.0f} ms")
+    else:
+        # Bước 1: Trích xuất văn bản thô từ ảnh bằng OCR.
+        print("🔍 Đang thực hiện OCR...")
+        with scheduler.stage("ocr"):
+            raw_text = extract_text_from_image(image_path)
+
+        # Bước 2: Sửa lỗi chính tả và lỗi OCR.
+        print("🧠 Đang sửa lỗi văn bản...")
+        with scheduler.stage("correct"):
+            corrected_text = correct_text(raw_text)
     
     # Bước 3: Trích xuất thông tin có cấu trúc bằng LLM.
+    # Phản hồi được đọc dạng streaming, sửa lỗi JSON, kiểm tra lược đồ và chỉ hỏi lại các trường lỗi.
     print("📦 Đang trích xuất các trường dữ liệu có cấu trúc...")
-    structured_data_str = extract_structured_info(corrected_text)
-    
-    # Bước 4: Làm sạch chuỗi JSON trả về từ LLM.
-    # LLM đôi khi trả về chuỗi JSON nằm trong khối mã markdown (```json ... ```).
-    cleaned_struct_data = structured_data_str.strip()
-    if cleaned_struct_data.startswith("```json"):
-        cleaned_struct_data = cleaned_struct_data.removeprefix("```json").strip()
-    if cleaned_struct_data.endswith("```"):
-        cleaned_struct_data = cleaned_struct_data.removesuffix("```").strip()
-        
-    # Bước 5: Chuyển chuỗi JSON thành đối tượng dict của Python.
-    try:
-        struct_data_dict = json.loads(cleaned_struct_data)
-        print("✅ Dữ liệu có cấu trúc đã được parse thành công.")
-    except json.JSONDecodeError as e:
-        # Nếu LLM trả về một chuỗi không phải là JSON hợp lệ, báo lỗi và trả về chuỗi thô.
-        print(f"❌ Lỗi khi parse JSON: {e}")
-        return cleaned_struct_data
+    struct_data_dict = extract_receipt_fields(corrected_text)
+    if isinstance(struct_data_dict, str):
+        # Không khôi phục được gì: trả về chuỗi thô như trước để nơi gọi báo lỗi.
+        return struct_data_dict
+    print("✅ Dữ liệu có cấu trúc đã được parse thành công.")
         
     # Bước 6 (Tùy chọn): Lưu file JSON xuống đĩa.
     # print("💾 Đang lưu dữ liệu có cấu trúc...")
@@ -0,0 +1,72 @@
+# file: benchmarks/bench_calculator.py
+#
+# Microbenchmark cho safe_calculator.evaluate so với cách cũ (eval sau vài phép replace):
+# - Thời gian trung bình mỗi biểu thức trên các biểu thức thường gặp trong hội thoại.
+# - Thời gian TỪ CHỐI các biểu thức độc hại (eval cũ có thể treo vô hạn với chúng, nên không đo eval).
+#
+# Chạy từ thư mục gốc của dự án:
+#   python -m benchmarks.bench_calculator --repeat 2000
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from safe_calculator import evaluate, CalculatorError  # noqa: E402
+
+# --- II. BỘ BIỂU THỨC ---
+
+# Biểu thức hợp lệ mà cả hai cách đều tính được (dạng số kiểu Python).
+COMMON = [
+    "125000 + 48000 * 2", "(250000 - 12500) / 3", "1500000 * 0.08", "2^10",
+    "189000 * 3 + 25500 * 2 - 10000", "48000 / 4", "12.5 * 4", "(1 + 2) * (3 + 4) / 5",
+]
+# Biểu thức kiểu Việt Nam chỉ bộ tính mới hiểu.
+VIETNAMESE = ["1.250.000 + 12,5", "15% * 200.000", "avg(120.000; 85.500; 230.000)", "sum(1,2,3) x 2"]
+# Biểu thức độc hại: phải bị từ chối gần như ngay lập tức.
+HOSTILE = ["9**9**9", "10**10**10", "-" * 400 + "1", "__import__('os').system('ls')",
+           "().__class__.__bases__[0]", "+".join(["99999"] * 400)]
+
+# --- III. ĐO ĐẠC ---
+
+def _old_calculator(expression: str):
+    safe_expression = expression.replace(':', '/').replace(',', '.').replace('^', '**')
+    return eval(safe_expression, {"__builtins__": {}}, {})
+
+def _per_call_us(fn, expressions, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for expr in expressions:
+            try:
+                fn(expr)
+            except CalculatorError:
+                pass
+    return (time.perf_counter() - start) / (repeat * len(expressions)) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark bộ tính toán an toàn")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'Bộ biểu thức':<22}{'eval cũ (µs)':>14}{'an toàn (µs)':>14}")
+    old = _per_call_us(_old_calculator, COMMON, args.repeat)
+    new = _per_call_us(evaluate, COMMON, args.repeat)
+    print(f"{'Thông dụng':<22}{old:>14.1f}{new:>14.1f}")
+    print(f"{'Kiểu Việt Nam':<22}{'-':>14}{_per_call_us(evaluate, VIETNAMESE, args.repeat):>14.1f}")
+
+    print("\nBiểu thức độc hại (thời gian từ chối):")
+    for expr in HOSTILE:
+        start = time.perf_counter()
+        try:
+            evaluate(expr)
+            outcome = "KHÔNG bị từ chối!"
+        except CalculatorError as e:
+            outcome = str(e)
+        label = expr if len(expr) <= 40 else expr[:37] + "..."
+        print(f"  {label:<42}{(time.perf_counter() - start) * 1000:>8.3f} ms  {outcome}")
+
+if __name__ == "__main__":
+    main()
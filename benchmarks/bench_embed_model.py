@@ -0,0 +1,97 @@
+# file: benchmarks/bench_embed_model.py
+#
+# Đo thông lượng của embed_model.encode_texts (bucket theo độ dài + cache LRU)
+# so với cách cũ (model.encode với batch_size=8 cố định) trên các chuỗi JSON hóa đơn
+# có độ dài thực tế (từ 1 tới vài chục sản phẩm mỗi hóa đơn).
+#
+# Chạy từ thư mục gốc của dự án:
+#   python -m benchmarks.bench_embed_model --n 512 --repeat-ratio 0.3
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import embed_model  # noqa: E402
+
+# --- II. SINH DỮ LIỆU HÓA ĐƠN GIẢ LẬP ---
+
+_STORES = ["BÁCH HÓA XANH", "WinMart+", "Circle K", "Co.op Food", "Siêu thị Mini Hòa Bình"]
+_ITEMS = ["Sữa tươi Vinamilk 1L", "Mì Hảo Hảo tôm chua cay", "Nước mắm Nam Ngư 500ml",
+          "Gạo ST25 5kg", "Trứng gà ta hộp 10", "Rau muống", "Thịt heo xay 500g",
+          "Bột giặt OMO 3kg", "Nước suối Aquafina 500ml", "Bánh mì sandwich"]
+
+def make_invoice_json(rng: random.Random) -> str:
+    """Tạo một chuỗi JSON hóa đơn với số lượng sản phẩm lệch (đa số ít, một số rất nhiều)."""
+    n_items = min(60, int(rng.paretovariate(1.3)) + rng.randint(0, 3))
+    items = []
+    for _ in range(n_items):
+        qty = rng.randint(1, 5)
+        price = rng.choice([5000, 12000, 25500, 48000, 125000, 189000])
+        items.append({"name": rng.choice(_ITEMS), "quantity": qty, "unit_price": price, "total_price": qty * price})
+    total = sum(i["total_price"] for i in items)
+    data = {
+        "store_name": rng.choice(_STORES), "website": None,
+        "address": "123 Nguyễn Văn Linh, Phường Tân Phong, Quận 7, TP.HCM",
+        "payment_method": rng.choice(["Tiền mặt", "Thẻ", "Momo"]),
+        "receipt_number": f"HD{rng.randint(100000, 999999)}",
+        "receipt_datetime": f"2024-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}T1{rng.randint(0, 9)}:30:00",
+        "staff_name": "Nguyễn Thị Lan", "items": items, "total_amount": total,
+        "discount_amount": 0, "paid_amount": total, "customer_paid": None, "change": None,
+    }
+    return json.dumps(data, ensure_ascii=False)
+
+# --- III. ĐO ĐẠC ---
+
+def _baseline(texts):
+    return embed_model.model.encode(texts, batch_size=8, convert_to_numpy=True, show_progress_bar=False)
+
+def _timed(fn, texts):
+    start = time.perf_counter()
+    fn(texts)
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark embed_model.encode_texts")
+    parser.add_argument("--n", type=int, default=512, help="Số hóa đơn mỗi lượt đo")
+    parser.add_argument("--repeat-ratio", type=float, default=0.3,
+                        help="Tỉ lệ văn bản lặp lại ở lượt thứ hai (mô phỏng lưu lại/hỏi lại)")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    texts = [make_invoice_json(rng) for _ in range(args.n)]
+    lengths = sorted(len(t) for t in texts)
+    print(f"📏 {args.n} hóa đơn, độ dài ký tự: min={lengths[0]}, median={lengths[len(lengths) // 2]}, max={lengths[-1]}")
+
+    # Khởi động (warm-up) để loại bỏ chi phí lần gọi đầu tiên.
+    _baseline(texts[:8])
+
+    t_base = _timed(_baseline, texts)
+    embed_model.cache.clear()
+    t_bucket = _timed(embed_model.encode_texts, texts)
+
+    # Lượt thứ hai: một phần văn bản lặp lại, phần còn lại là mới.
+    n_repeat = int(args.n * args.repeat_ratio)
+    second = rng.sample(texts, n_repeat) + [make_invoice_json(rng) for _ in range(args.n - n_repeat)]
+    t_base_2 = _timed(_baseline, second)
+    t_cached_2 = _timed(embed_model.encode_texts, second)
+
+    print(f"{'Cấu hình':<38}{'Thời gian (s)':>15}{'Hóa đơn/giây':>15}")
+    for label, t in [
+        ("Cũ: batch_size=8 cố định", t_base),
+        ("Mới: bucket theo độ dài (cache rỗng)", t_bucket),
+        (f"Cũ: lượt 2 ({args.repeat_ratio:.0%} lặp lại)", t_base_2),
+        (f"Mới: lượt 2 ({args.repeat_ratio:.0%} lặp lại)", t_cached_2),
+    ]:
+        print(f"{label:<38}{t:>15.3f}{args.n / t:>15.1f}")
+    print(f"⚡ Tăng tốc (cache rỗng): x{t_base / t_bucket:.2f} | (có lặp lại): x{t_base_2 / t_cached_2:.2f}")
+    print(f"🗃️ Cache: {embed_model.cache.stats()}")
+
+if __name__ == "__main__":
+    main()
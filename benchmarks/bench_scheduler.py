@@ -0,0 +1,102 @@
+# file: benchmarks/bench_scheduler.py
+#
+# Thông lượng của các bước tốn CPU (OCR -> sửa lỗi -> embedding) theo số lượt tải lên đồng thời,
+# so sánh mặc định của thư viện (mọi bước dùng mọi nhân) với resource_scheduler (chia nhân theo bước).
+# Bước trích xuất bằng Gemini chạy qua mạng nên không được đo.
+#
+# Chạy từ thư mục gốc của dự án (cần GEMINI_KEYS trong .env vì backend kiểm tra khi import):
+#   python -m benchmarks.bench_scheduler img/ --concurrency 1 2 4 8 --images 32
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import argparse
+import json
+import os
+import subprocess  # Mỗi chế độ đo trong một process riêng (xem main).
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ingest import collect_images  # noqa: E402
+
+# --- II. ĐO ĐẠC ---
+
+def _one_receipt(image_path: str) -> float:
+    """Các bước tốn CPU của process_receipt cho một ảnh, cộng embedding của văn bản. Trả về độ trễ (giây)."""
+    import backend
+    from embedding_service import get_embedding_service
+    from resource_scheduler import get_scheduler
+    start = time.perf_counter()
+    scheduler = get_scheduler()
+    with scheduler.stage("ocr"):
+        result = backend.extract_text_adaptive(image_path)
+    with scheduler.stage("correct"):
+        text = backend.correct_text_adaptive(result)
+    get_embedding_service().embed([text])
+    return time.perf_counter() - start
+
+def run(images, concurrency: int):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = sorted(pool.map(_one_receipt, images))
+    elapsed = time.perf_counter() - start
+    p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+    return len(images) / elapsed, p95
+
+def measure(images, concurrency_levels) -> dict:
+    """
+    Đo ở chế độ của process hiện tại (SCHED_ENABLED quyết định bật/tắt bộ lập lịch ngay từ khi khởi tạo).
+    Chạy trong process con: khi bật, bộ lập lịch đặt OMP_THREAD_LIMIT và số luồng torch cho cả process,
+    nên "mặc định" đo chung process sau đó (kể cả lượt làm nóng) sẽ không còn là mặc định của thư viện.
+    """
+    from resource_scheduler import get_scheduler
+    _one_receipt(images[0])  # Làm nóng: tải model, khởi tạo pool luồng.
+    results = {c: run(images, c) for c in concurrency_levels}
+    scheduler = get_scheduler()
+    return {"results": results, "cores": len(scheduler.cores),
+            "split": {k: v["cores"] for k, v in scheduler.stats()["stages"].items()}}
+
+def _measure_in_subprocess(args, enabled: bool) -> dict:
+    env = {**os.environ, "SCHED_ENABLED": "1" if enabled else "0"}
+    cmd = [sys.executable, "-m", "benchmarks.bench_scheduler", args.source, "--images", str(args.images),
+           "--concurrency", *map(str, args.concurrency), "--worker"]
+    out = subprocess.run(cmd, env=env, cwd=ROOT, check=True, stdout=subprocess.PIPE, text=True).stdout
+    # Pipeline in log ra stdout; kết quả là dòng JSON cuối cùng.
+    report = json.loads(out.strip().splitlines()[-1])
+    report["results"] = {int(c): tuple(v) for c, v in report["results"].items()}
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Thông lượng OCR/sửa lỗi/embedding: mặc định so với bộ lập lịch nhân")
+    parser.add_argument("source", help="Thư mục ảnh hoặc file manifest")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--images", type=int, default=32, help="Số ảnh mỗi lần đo (lặp lại nếu thiếu)")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)  # Process con: đo một chế độ.
+    args = parser.parse_args()
+
+    _, paths = collect_images(args.source)
+    if not paths:
+        print(f"❌ Không tìm thấy ảnh trong {args.source}")
+        return
+    images = (paths * (args.images // len(paths) + 1))[:args.images]
+    if args.worker:
+        print(json.dumps(measure(images, args.concurrency)))
+        return
+
+    # Mỗi chế độ chạy trong một process mới (tải model, làm nóng riêng) để không chế độ nào kế thừa
+    # cấu hình luồng của chế độ kia.
+    baseline = _measure_in_subprocess(args, enabled=False)
+    scheduled = _measure_in_subprocess(args, enabled=True)
+
+    print(f"📚 {len(images)} ảnh, {scheduled['cores']} nhân\n")
+    print("| Đồng thời | Mặc định (hóa đơn/s) | p95 (s) | Lập lịch (hóa đơn/s) | p95 (s) | Tăng |")
+    print("|---|---|---|---|---|---|")
+    for c in args.concurrency:
+        (base_tp, base_p95), (tp, p95) = baseline["results"][c], scheduled["results"][c]
+        print(f"| {c} | {base_tp:.2f} | {base_p95:.1f} | {tp:.2f} | {p95:.1f} | {tp / base_tp:.2f}x |")
+    print(f"\nCách chia nhân cuối cùng: {scheduled['split']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# file: benchmarks/embedding_recall_report.py
+#
+# Báo cáo recall và độ trễ của các cấu hình embedding (backend lượng tử hóa, giảm chiều)
+# so với thiết lập hiện tại (torch fp32, đủ chiều, L2).
+#
+# recall@k = tỉ lệ hóa đơn trong top-k của cấu hình thử nghiệm trùng với top-k chính xác
+# của thiết lập gốc, trên cùng một tập truy vấn giữ lại (held-out).
+#
+# Ví dụ (chạy từ thư mục gốc của dự án):
+#   python -m benchmarks.embedding_recall_report --corpus output_structured \
+#       --configs torch_int8/none onnx_int8/none torch/matryoshka:256 torch/pca:256 --fit-pca
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import embed_model  # noqa: E402
+from benchmarks.bench_embed_model import make_invoice_json  # noqa: E402
+
+# --- II. DỮ LIỆU ---
+
+def load_corpus(path: str, n_synthetic: int, seed: int) -> list:
+    """Đọc các file JSON hóa đơn trong thư mục; nếu không có thì sinh dữ liệu giả lập."""
+    texts = []
+    for fp in sorted(glob.glob(os.path.join(path, "*.json"))) if path else []:
+        with open(fp, encoding="utf-8") as f:
+            texts.append(json.dumps(json.load(f), ensure_ascii=False))
+    if not texts:
+        rng = random.Random(seed)
+        texts = [make_invoice_json(rng) for _ in range(n_synthetic)]
+        print(f"ℹ️ Không tìm thấy JSON trong '{path}', dùng {n_synthetic} hóa đơn giả lập.")
+    return texts
+
+def make_queries(corpus: list, n: int, seed: int) -> list:
+    """Sinh câu hỏi ngắn kiểu người dùng từ các hóa đơn ngẫu nhiên (cửa hàng, mặt hàng, tổng tiền)."""
+    rng = random.Random(seed + 1)
+    queries = []
+    for text in rng.sample(corpus, min(n, len(corpus))):
+        data = json.loads(text)
+        items = data.get("items") or [{}]
+        item = rng.choice(items).get("name") or ""
+        queries.append(f"hóa đơn {data.get('store_name') or ''} có {item} tổng {data.get('total_amount')}")
+    return queries
+
+# --- III. ĐO ĐẠC ---
+
+def encode(model, reducer, texts, batch_size=32):
+    start = time.perf_counter()
+    embs = model.encode(texts, batch_size=batch_size, convert_to_numpy=True, show_progress_bar=False)
+    elapsed = time.perf_counter() - start
+    return reducer.apply(np.asarray(embs, dtype=np.float32)), elapsed
+
+def top_k(corpus_embs, query_embs, k, metric):
+    if metric == "IP":
+        scores = query_embs @ corpus_embs.T
+    else:  # L2: khoảng cách càng nhỏ càng tốt -> dùng giá trị âm.
+        scores = -((query_embs ** 2).sum(1)[:, None] - 2 * query_embs @ corpus_embs.T + (corpus_embs ** 2).sum(1)[None, :])
+    return np.argsort(-scores, axis=1)[:, :k]
+
+def recall_at_k(reference, candidate):
+    k = reference.shape[1]
+    return float(np.mean([len(set(r) & set(c)) / k for r, c in zip(reference, candidate)]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Báo cáo recall/độ trễ của các cấu hình embedding")
+    parser.add_argument("--corpus", default="output_structured", help="Thư mục chứa các file JSON hóa đơn")
+    parser.add_argument("--n-synthetic", type=int, default=1000)
+    parser.add_argument("--n-queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--configs", nargs="+", default=["torch_int8/none", "torch/matryoshka:256"],
+                        help="Danh sách cấu hình dạng <backend>/<giảm chiều>")
+    parser.add_argument("--fit-pca", action="store_true",
+                        help="Fit PCA trên embedding gốc của kho hóa đơn trước khi đo (cho cấu hình pca:<d>)")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus, args.n_synthetic, args.seed)
+    queries = make_queries(corpus, args.n_queries, args.seed)
+    print(f"📚 Kho: {len(corpus)} hóa đơn | ❓ Truy vấn: {len(queries)} | k={args.k}")
+
+    # Thiết lập gốc: torch fp32, đủ chiều, L2 (tìm kiếm chính xác bằng brute force).
+    base_model = embed_model.load_model("torch")
+    no_reduction = embed_model.DimReducer()
+    base_corpus, base_time = encode(base_model, no_reduction, corpus)
+    base_queries, _ = encode(base_model, no_reduction, queries)
+    reference = top_k(base_corpus, base_queries, args.k, "L2")
+
+    rows = [("torch/none (hiện tại)", base_corpus.shape[1], "L2", 1.0, base_time / len(corpus) * 1000)]
+    models = {"torch": base_model}
+    for config in args.configs:
+        backend, _, reduction = config.partition("/")
+        reduction = reduction or "none"
+        if reduction.startswith("pca:") and args.fit_pca:
+            dim = int(reduction.split(":")[1])
+            embed_model.fit_pca(base_corpus, dim)
+            print(f"💾 Đã fit PCA {dim} chiều vào {embed_model.EMBED_PCA_PATH}")
+        if backend not in models:
+            models[backend] = embed_model.load_model(backend)
+        reducer = embed_model.DimReducer.from_spec(reduction)
+        metric = "IP" if reducer.active else "L2"
+        cand_corpus, cand_time = encode(models[backend], reducer, corpus)
+        cand_queries, _ = encode(models[backend], reducer, queries)
+        recall = recall_at_k(reference, top_k(cand_corpus, cand_queries, args.k, metric))
+        rows.append((config, cand_corpus.shape[1], metric, recall, cand_time / len(corpus) * 1000))
+
+    print(f"\n| Cấu hình | Số chiều | Metric | Recall@{args.k} | ms/hóa đơn | Tăng tốc |")
+    print("|---|---|---|---|---|---|")
+    base_ms = rows[0][4]
+    for name, dim, metric, recall, ms in rows:
+        print(f"| {name} | {dim} | {metric} | {recall:.3f} | {ms:.2f} | x{base_ms / ms:.2f} |")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# file: benchmarks/tune_milvus_index.py
+#
+# Quét (sweep) các cấu hình index của Milvus trên dữ liệu thật của invoice_collection
+# và báo cáo recall@k cùng QPS cho từng cặp (tham số build, tham số search).
+#
+# - Vector được đọc từ collection nguồn; một phần được giữ lại (held-out) làm truy vấn.
+# - Kết quả đúng (ground truth) được tính bằng tìm kiếm vét cạn với NumPy.
+# - Mỗi cấu hình được dựng trên một collection tạm, đo xong thì xóa.
+#
+# Ví dụ (chạy từ thư mục gốc của dự án):
+#   python -m benchmarks.tune_milvus_index --metric COSINE --k 10 --holdout 200
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from pymilvus import Collection, CollectionSchema, DataType, FieldSchema, connections, utility
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from milvus_index import recommended_nlist  # noqa: E402
+
+# --- II. LƯỚI THAM SỐ CẦN QUÉT ---
+
+def sweep_grid(n: int) -> list:
+    """Danh sách (loại index, tham số build, danh sách tham số search) cần thử."""
+    base_nlist = recommended_nlist(n)
+    nlists = sorted({max(16, base_nlist // 2), base_nlist, base_nlist * 2})
+    grid = [("FLAT", {}, [{}])]
+    for index_type in ("IVF_FLAT", "IVF_SQ8"):
+        for nlist in nlists:
+            nprobes = sorted({p for p in (4, 8, 16, 32, 64) if p <= nlist})
+            grid.append((index_type, {"nlist": nlist}, [{"nprobe": p} for p in nprobes]))
+    for m in (8, 16, 32):
+        grid.append(("HNSW", {"M": m, "efConstruction": 200}, [{"ef": ef} for ef in (16, 32, 64, 128)]))
+    return grid
+
+# --- III. DỮ LIỆU VÀ KẾT QUẢ ĐÚNG ---
+
+def load_vectors(collection_name: str, limit: int) -> np.ndarray:
+    coll = Collection(collection_name)
+    coll.load()
+    vectors = []
+    iterator = coll.query_iterator(batch_size=1000, expr="id >= 0", output_fields=["embedding"], limit=limit)
+    while True:
+        batch = iterator.next()
+        if not batch:
+            break
+        vectors.extend(row["embedding"] for row in batch)
+    iterator.close()
+    return np.asarray(vectors, dtype=np.float32)
+
+def exact_top_k(base: np.ndarray, queries: np.ndarray, k: int, metric: str) -> np.ndarray:
+    if metric == "COSINE":
+        base = base / np.maximum(np.linalg.norm(base, axis=1, keepdims=True), 1e-12)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    if metric in ("COSINE", "IP"):
+        scores = queries @ base.T
+    else:
+        scores = -((queries ** 2).sum(1)[:, None] - 2 * queries @ base.T + (base ** 2).sum(1)[None, :])
+    return np.argsort(-scores, axis=1)[:, :k]
+
+# --- IV. ĐO TỪNG CẤU HÌNH ---
+
+def build_temp_collection(name: str, base: np.ndarray, index_type: str, build: dict, metric: str) -> Collection:
+    if utility.has_collection(name):
+        utility.drop_collection(name)
+    schema = CollectionSchema([
+        FieldSchema("row", dtype=DataType.INT64, is_primary=True, auto_id=False),
+        FieldSchema("embedding", dtype=DataType.FLOAT_VECTOR, dim=base.shape[1]),
+    ])
+    coll = Collection(name, schema)
+    for start in range(0, len(base), 5000):
+        chunk = base[start:start + 5000]
+        coll.insert([list(range(start, start + len(chunk))), chunk])
+    coll.flush()
+    coll.create_index("embedding", {"index_type": index_type, "metric_type": metric, "params": build})
+    coll.load()
+    return coll
+
+def measure(coll: Collection, queries: np.ndarray, truth: np.ndarray, k: int, metric: str, search: dict):
+    param = {"metric_type": metric, "params": search}
+    start = time.perf_counter()
+    found = []
+    for q in queries:  # Mỗi truy vấn một lần gọi, giống cách retriever của chatbot sử dụng.
+        hits = coll.search([q], "embedding", param, limit=k)[0]
+        found.append([hit.id for hit in hits])
+    elapsed = time.perf_counter() - start
+    recall = float(np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)]))
+    return recall, len(queries) / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Quét tham số index Milvus: recall@k và QPS")
+    parser.add_argument("--collection", default="invoice_collection")
+    parser.add_argument("--metric", default="COSINE", choices=["L2", "IP", "COSINE"])
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--holdout", type=int, default=200, help="Số vector giữ lại làm truy vấn")
+    parser.add_argument("--limit", type=int, default=200_000, help="Số vector tối đa đọc từ collection")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    connections.connect("default", host=os.getenv("MILVUS_HOST", "127.0.0.1"), port=os.getenv("MILVUS_PORT", "19530"))
+    vectors = load_vectors(args.collection, args.limit)
+    if len(vectors) <= args.holdout + args.k:
+        print(f"❌ Collection '{args.collection}' chỉ có {len(vectors)} vector, không đủ để đo.")
+        return
+    rng = np.random.default_rng(args.seed)
+    order = rng.permutation(len(vectors))
+    queries, base = vectors[order[:args.holdout]], vectors[order[args.holdout:]]
+    truth = exact_top_k(base, queries, args.k, args.metric)
+    print(f"📚 {len(base)} vector, {len(queries)} truy vấn giữ lại, metric={args.metric}, k={args.k}")
+
+    temp_name = f"{args.collection}_index_tuning"
+    print(f"\n| Index | Build | Search | Recall@{args.k} | QPS | Build (s) |")
+    print("|---|---|---|---|---|---|")
+    try:
+        for index_type, build, searches in sweep_grid(len(base)):
+            start = time.perf_counter()
+            coll = build_temp_collection(temp_name, base, index_type, build, args.metric)
+            build_time = time.perf_counter() - start
+            for search in searches:
+                recall, qps = measure(coll, queries, truth, args.k, args.metric, search)
+                print(f"| {index_type} | {build or '-'} | {search or '-'} | {recall:.3f} | {qps:.0f} | {build_time:.1f} |")
+    finally:
+        if utility.has_collection(temp_name):
+            utility.drop_collection(temp_name)
+
+if __name__ == "__main__":
+    main()
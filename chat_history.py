@@ -0,0 +1,149 @@
+# file: chat_history.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os
+import re
+import logging
+from typing import Callable, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage  # Các loại tin nhắn của LangChain.
+
+from embedding_service import estimate_tokens  # Ước lượng token nhanh (~4 ký tự/token).
+
+logger = logging.getLogger(__name__)
+
+# --- II. CẤU HÌNH ---
+
+# Ngân sách token cho toàn bộ lịch sử chat gửi kèm mỗi lượt (bản tóm tắt + các lượt gần nhất).
+HISTORY_MAX_TOKENS = int(os.getenv("CHAT_HISTORY_MAX_TOKENS", "2000"))
+# Số token tối đa của bản tóm tắt các lượt cũ.
+SUMMARY_MAX_TOKENS = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "400"))
+# Tin nhắn dài hơn ngưỡng này (ví dụ: báo cáo tổng hợp, JSON từ filter_invoices) được thay bằng tham chiếu.
+LARGE_MESSAGE_TOKENS = int(os.getenv("CHAT_LARGE_MESSAGE_TOKENS", "300"))
+# Số ký tự đầu của tin nhắn dài được giữ lại cạnh tham chiếu, để agent biết nội dung là gì.
+_PREVIEW_CHARS = 200
+
+def _message_tokens(message: BaseMessage) -> int:
+    return estimate_tokens(message.content) + 4  # + vài token cho vai trò/định dạng.
+
+# --- III. TÓM TẮT CÁC LƯỢT CŨ ---
+
+def _first_sentence(text: str, max_chars: int = 160) -> str:
+    text = " ".join(text.split())
+    match = re.match(r"(.+?[.!?])(\s|$)", text)
+    sentence = match.group(1) if match else text
+    return sentence if len(sentence) <= max_chars else sentence[:max_chars].rstrip() + "…"
+
+def extractive_summary(previous: str, messages: List[BaseMessage]) -> str:
+    """
+    Tóm tắt không cần LLM: giữ câu đầu của mỗi tin nhắn cũ.
+    Nhanh và không làm chậm lượt chat, nhưng kém súc tích hơn `make_llm_summarizer`.
+    """
+    lines = [previous] if previous else []
+    for msg in messages:
+        who = "Người dùng" if isinstance(msg, HumanMessage) else "Trợ lý"
+        lines.append(f"- {who}: {_first_sentence(msg.content)}")
+    return "\n".join(lines)
+
+def make_llm_summarizer(llm) -> Callable[[str, List[BaseMessage]], str]:
+    """Tạo hàm tóm tắt bằng LLM: gộp các lượt cũ vào bản tóm tắt hiện có."""
+    def summarize(previous: str, messages: List[BaseMessage]) -> str:
+        transcript = "\n".join(
+            f"{'Người dùng' if isinstance(m, HumanMessage) else 'Trợ lý'}: {m.content}" for m in messages
+        )
+        prompt = (
+            "Hãy cập nhật bản tóm tắt cuộc trò chuyện về hóa đơn dưới đây bằng tiếng Việt, ngắn gọn (tối đa 8 gạch đầu dòng), "
+            "giữ lại các con số, mã hóa đơn, tên cửa hàng và yêu cầu quan trọng của người dùng.\n\n"
+            f"Bản tóm tắt hiện có:\n{previous or '(trống)'}\n\nCác lượt mới cần gộp vào:\n{transcript}"
+        )
+        return llm.invoke(prompt).content.strip()
+    return summarize
+
+# --- IV. BỘ QUẢN LÝ LỊCH SỬ CÓ GIỚI HẠN ---
+
+class ChatHistoryManager:
+    """
+    Dựng `chat_history` gửi cho agent trong một ngân sách token cố định.
+    - Các lượt gần nhất được giữ nguyên văn (trong phạm vi ngân sách).
+    - Các lượt cũ hơn được gộp dần vào một bản tóm tắt chạy (mỗi lượt chỉ tóm tắt một lần).
+    - Tin nhắn quá dài được thay bằng tham chiếu `[ref:N]` kèm đoạn mở đầu;
+      nội dung đầy đủ được giữ trong `self.references` (và vẫn hiển thị đầy đủ trên giao diện).
+    Mỗi session chat có một đối tượng riêng (lưu trong session state).
+    """
+
+    def __init__(self, max_tokens: int = HISTORY_MAX_TOKENS, summary_max_tokens: int = SUMMARY_MAX_TOKENS,
+                 large_message_tokens: int = LARGE_MESSAGE_TOKENS,
+                 summarize_fn: Optional[Callable[[str, List[BaseMessage]], str]] = None):
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.large_message_tokens = large_message_tokens
+        self.summarize_fn = summarize_fn or extractive_summary
+        self.reset()
+
+    def reset(self):
+        """Xóa bản tóm tắt và các tham chiếu (khi lịch sử chat bị xóa)."""
+        self.summary = ""
+        self.references: Dict[int, str] = {}
+        self._summarized_upto = 0  # Số tin nhắn đầu tiên đã được gộp vào bản tóm tắt.
+        self._ref_ids: Dict[int, int] = {}  # Vị trí tin nhắn -> mã tham chiếu.
+
+    def _compact(self, index: int, message: BaseMessage) -> BaseMessage:
+        """Thay tin nhắn dài bằng tham chiếu ngắn; tin nhắn ngắn giữ nguyên."""
+        if estimate_tokens(message.content) <= self.large_message_tokens:
+            return message
+        ref = self._ref_ids.get(index)
+        if ref is None:
+            ref = self._ref_ids[index] = len(self.references) + 1
+            self.references[ref] = message.content
+        preview = " ".join(message.content[:_PREVIEW_CHARS].split())
+        stub = (f"[ref:{ref}] (Nội dung dài {estimate_tokens(message.content)} token đã được lược bớt; "
+                f"nếu cần số liệu chi tiết hãy gọi lại công cụ.) Mở đầu: {preview}…")
+        return type(message)(content=stub)
+
+    def _truncate_summary(self):
+        max_chars = self.summary_max_tokens * 4
+        if len(self.summary) > max_chars:
+            # Giữ phần mới nhất của bản tóm tắt.
+            self.summary = "…" + self.summary[-max_chars:].split("\n", 1)[-1]
+
+    def build(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        """
+        Dựng lịch sử gửi cho agent từ toàn bộ tin nhắn của session.
+
+        Args:
+            messages (List[BaseMessage]): Lịch sử đầy đủ (KHÔNG gồm câu hỏi hiện tại).
+
+        Returns:
+            List[BaseMessage]: [bản tóm tắt (nếu có)] + các lượt gần nhất, nằm trong ngân sách token.
+        """
+        if len(messages) < self._summarized_upto:
+            # Lịch sử đã bị xóa/làm mới: bắt đầu lại.
+            self.reset()
+
+        compacted = [self._compact(i, m) for i, m in enumerate(messages)]
+        budget = self.max_tokens - (estimate_tokens(self.summary) if self.summary else 0)
+        start = len(compacted)
+        used = 0
+        while start > self._summarized_upto and used + _message_tokens(compacted[start - 1]) <= budget:
+            start -= 1
+            used += _message_tokens(compacted[start])
+        # Nếu phải cắt, bắt đầu phần nguyên văn ở một câu hỏi của người dùng để không cắt đôi một lượt.
+        if start > self._summarized_upto:
+            while start < len(compacted) and not isinstance(compacted[start], HumanMessage):
+                start += 1
+
+        if start > self._summarized_upto:
+            older = compacted[self._summarized_upto:start]
+            try:
+                self.summary = self.summarize_fn(self.summary, older)
+            except Exception as e:
+                logger.warning(f"Tóm tắt bằng LLM thất bại, dùng tóm tắt rút trích: {e}")
+                self.summary = extractive_summary(self.summary, older)
+            self._truncate_summary()
+            self._summarized_upto = start
+
+        history: List[BaseMessage] = []
+        if self.summary:
+            history.append(SystemMessage(content=f"Tóm tắt các lượt trò chuyện trước đó:\n{self.summary}"))
+        history.extend(compacted[start:])
+        return history
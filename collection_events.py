@@ -0,0 +1,53 @@
+# file: collection_events.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os  # Quản lý thư mục trạng thái và ghi file nguyên tử.
+import json
+import time
+import tempfile
+from typing import Tuple
+
+# --- II. CẤU HÌNH ---
+
+# Thư mục chứa các file "phiên bản" của collection. FastAPI (ghi) và Streamlit (đọc)
+# chạy ở hai process khác nhau nhưng cùng thư mục dự án, nên dùng file làm kênh thông báo.
+STATE_DIR = os.getenv("INVOICE_STATE_DIR", ".invoice_state")
+
+# --- III. PHIÊN BẢN COLLECTION ---
+# Mỗi collection có một cặp (epoch, version):
+# - `version` thay đổi mỗi khi có dữ liệu mới được chèn (ví dụ: qua /save_milvus).
+# - `epoch` thay đổi khi collection bị xóa và tạo lại (dữ liệu cũ không còn hợp lệ).
+# Giá trị được lấy từ time.time_ns() nên không cần khóa đọc-sửa-ghi giữa các process.
+
+def _path(collection_name: str) -> str:
+    return os.path.join(STATE_DIR, f"{collection_name}.version.json")
+
+def get_version(collection_name: str) -> Tuple[int, int]:
+    """Trả về (epoch, version) hiện tại của collection; (0, 0) nếu chưa từng được ghi."""
+    try:
+        with open(_path(collection_name), encoding="utf-8") as f:
+            data = json.load(f)
+        return int(data.get("epoch", 0)), int(data.get("version", 0))
+    except (OSError, ValueError):
+        return 0, 0
+
+def _write(collection_name: str, epoch: int, version: int):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    # Ghi ra file tạm rồi đổi tên để bên đọc không bao giờ thấy file ghi dở.
+    fd, tmp = tempfile.mkstemp(dir=STATE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"epoch": epoch, "version": version}, f)
+    os.replace(tmp, _path(collection_name))
+
+def bump_version(collection_name: str) -> int:
+    """Đánh dấu collection vừa có dữ liệu mới. Trả về version mới."""
+    epoch, _ = get_version(collection_name)
+    version = time.time_ns()
+    _write(collection_name, epoch, version)
+    return version
+
+def reset_collection(collection_name: str) -> int:
+    """Đánh dấu collection vừa bị xóa/tạo lại: mọi bản sao dữ liệu phía người đọc phải tải lại từ đầu."""
+    epoch = time.time_ns()
+    _write(collection_name, epoch, epoch)
+    return epoch
@@ -1,12 +1,19 @@
 # file: custom_tools.py
 
 # --- I. KHAI BÁO THƯ VIỆN ---
+import os
+import asyncio  # Công cụ tìm kiếm web giả lập chạy bất đồng bộ giống công cụ thật.
 from datetime import datetime
 import pytz  # Thư viện để làm việc với các múi giờ phức tạp.
 from langchain.tools import tool  # Decorator để biến một hàm Python thành một "công cụ" cho AI Agent.
 from pydantic import Field  # Dùng để cung cấp mô tả chi tiết cho các tham số của công cụ.
 from typing import Literal, Optional  # Các kiểu dữ liệu giúp định nghĩa tham số rõ ràng hơn cho LLM.
 import json  # Thư viện để làm việc với dữ liệu định dạng JSON.
+from invoice_analytics import get_invoice_table, DEFAULT_TOP_N  # Bảng hóa đơn có kiểu, dùng cho thống kê.
+from safe_calculator import evaluate, format_number, CalculatorError  # Tính biểu thức an toàn, không dùng eval.
+
+# Số dòng tối đa của báo cáo 'summarize' để không làm tràn ngữ cảnh của LLM.
+MAX_SUMMARY_LINES = 20
 
 # --- II. ĐỊNH NGHĨA CÁC CÔNG CỤ (TOOLS) ---
 # Mỗi hàm được đánh dấu bằng `@tool` sẽ được AI Agent "nhìn thấy" và có thể quyết định sử dụng
@@ -30,19 +37,14 @@ def get_vietnam_current_time() -> str:
 
 @tool
 def calculator(expression: str) -> str:
-    """(Công cụ tính toán) Sử dụng khi người dùng yêu cầu thực hiện một phép tính toán học. Có một tham số là 'expression'."""
+    """(Công cụ tính toán) Sử dụng khi người dùng yêu cầu thực hiện một phép tính toán học. Có một tham số là 'expression'.
+    Hỗ trợ + - * / ^ %, số kiểu Việt Nam (1.250.000; 12,5) và các hàm sum/avg/min/max, ví dụ: avg(120.000; 85.500; 230.000)."""
     try:
-        # "Làm sạch" biểu thức đầu vào để xử lý các biến thể phổ biến.
-        # Ví dụ: người dùng có thể nhập '2:2' thay vì '2/2' hoặc dùng dấu phẩy cho số thập phân.
-        safe_expression = expression.replace(':', '/').replace(',', '.').replace('^', '**')
-        
-        # Sử dụng `eval` một cách an toàn.
-        # `eval` là một hàm mạnh nhưng nguy hiểm nếu không được kiểm soát.
-        # Bằng cách truyền các dict rỗng cho `globals` và `locals`, chúng ta ngăn `eval`
-        # truy cập vào các hàm có sẵn hoặc các biến trong môi trường, tránh các lỗ hổng bảo mật.
-        result = eval(safe_expression, {"__builtins__": {}}, {})
-        return f"Kết quả của phép tính '{expression}' là: {result}"
-    except Exception as e:
+        # Tính bằng bộ tính toán trên cây cú pháp (không dùng `eval`): chỉ cho phép số, toán tử và
+        # một số hàm trong danh sách trắng, có giới hạn số mũ, độ lớn kết quả và thời gian tính.
+        result = evaluate(expression)
+        return f"Kết quả của phép tính '{expression}' là: {format_number(result)}"
+    except CalculatorError as e:
         return f"Biểu thức toán học không hợp lệ: {e}"
 
 @tool
@@ -83,7 +85,8 @@ def get_invoice_report(
     # --- Nhánh 3: Tóm tắt tất cả các hóa đơn ---
     if report_type == 'summarize':
         report_lines = []
-        for i, doc in enumerate(all_documents):
+        # Chỉ liệt kê tối đa MAX_SUMMARY_LINES hóa đơn; phần còn lại được gộp thành một dòng.
+        for i, doc in enumerate(all_documents[:MAX_SUMMARY_LINES]):
             try:
                 invoice_data = json.loads(doc.page_content)
                 receipt_id = invoice_data.get("receipt_number", f"Hóa đơn không mã số {i+1}")
@@ -98,10 +101,29 @@ def get_invoice_report(
         # Tạo báo cáo cuối cùng bằng cách ghép các dòng lại với nhau.
         final_report = [f"Đây là báo cáo tóm tắt cho {len(all_documents)} hóa đơn của bạn:"]
         final_report.extend(report_lines)
+        remaining = len(all_documents) - MAX_SUMMARY_LINES
+        if remaining > 0:
+            final_report.append(f"... và {remaining} hóa đơn khác. Dùng công cụ thống kê (aggregate) để xem số liệu tổng hợp.")
         return "\n".join(final_report)
 
     return "Loại báo cáo không hợp lệ. Vui lòng chọn 'count', 'summarize', hoặc 'highest_value'."
 
+@tool
+def aggregate_invoices(
+    all_documents: list,
+    metric: Literal['count', 'sum', 'avg', 'min', 'max', 'top'] = Field("sum", description="Chỉ số cần tính trên tổng tiền, hoặc 'top' để liệt kê hóa đơn lớn nhất."),
+    group_by: Literal['none', 'store', 'payment_method', 'day', 'week', 'month'] = Field("none", description="Chiều nhóm kết quả."),
+    date_from: Optional[str] = Field(None, description="Ngày bắt đầu (YYYY-MM-DD hoặc YYYY-MM)."),
+    date_to: Optional[str] = Field(None, description="Ngày kết thúc (YYYY-MM-DD hoặc YYYY-MM)."),
+    top_n: int = Field(DEFAULT_TOP_N, description="Số dòng tối đa trong kết quả.")
+) -> str:
+    """(Công cụ thống kê) Tính tổng, trung bình, nhỏ nhất, lớn nhất, top-N của tiền hóa đơn, nhóm theo cửa hàng, phương thức thanh toán, ngày, tuần hoặc tháng trong một khoảng thời gian."""
+    # Bảng hóa đơn được parse một lần và cache theo danh sách tài liệu,
+    # việc tính toán chỉ duyệt bảng một lượt và trả về bảng kết quả có kích thước bị chặn.
+    if not all_documents: return "Không có dữ liệu hóa đơn nào để thống kê."
+    table = get_invoice_table(all_documents)
+    return table.aggregate(metric=metric, group_by=group_by, date_from=date_from, date_to=date_to, top_n=top_n)
+
 @tool
 def filter_invoices(
     all_documents: list,
@@ -136,4 +158,51 @@ def filter_invoices(
         # `ensure_ascii=False` để giữ lại ký tự tiếng Việt. `indent=2` để chuỗi JSON dễ đọc hơn.
         return json.dumps(matching_invoices, indent=2, ensure_ascii=False) if matching_invoices else "Không tìm thấy hóa đơn nào khớp với tiêu chí của bạn."
     
-    return "Lỗi: Bạn phải cung cấp ít nhất một tiêu chí (số hóa đơn, tổng tiền, hoặc tên mặt hàng) để lọc."
\ No newline at end of file
+    return "Lỗi: Bạn phải cung cấp ít nhất một tiêu chí (số hóa đơn, tổng tiền, hoặc tên mặt hàng) để lọc."
+
+@tool
+def search_invoices(ranked_documents: list, query: str) -> str:
+    """(Công cụ tìm kiếm) Tìm hóa đơn theo mã hóa đơn, số điện thoại, số tiền, tên cửa hàng hoặc mô tả tự do."""
+    # `ranked_documents` là kết quả của retriever lai (vector + BM25) cho `query`, đã xếp hạng.
+    invoices = []
+    for doc in ranked_documents:
+        try:
+            invoices.append(json.loads(doc.page_content))
+        except (TypeError, ValueError):
+            continue
+    if not invoices:
+        return f"Không tìm thấy hóa đơn nào phù hợp với '{query}'."
+    return json.dumps(invoices, indent=2, ensure_ascii=False)
+
+# --- III. CÔNG CỤ TÌM KIẾM WEB GIẢ LẬP (CHẠY OFFLINE) ---
+# Thay cho TavilySearchResults khi không có mạng hoặc API key (WEB_SEARCH_BACKEND=fake),
+# để thử agent và việc chạy song song nhiều công cụ mà không gọi ra Internet.
+
+# Độ trễ giả lập (giây) của mỗi lần tìm kiếm, mô phỏng thời gian gọi mạng.
+FAKE_WEB_SEARCH_LATENCY_S = float(os.getenv("FAKE_WEB_SEARCH_LATENCY_S", "0.5"))
+
+_FAKE_WEB_RESULTS = [
+    {"url": "https://example.local/gia-xang", "keywords": ["xăng", "dầu", "nhiên liệu"],
+     "content": "Giá xăng RON 95 kỳ điều chỉnh gần nhất khoảng 23.000 đồng/lít (dữ liệu giả lập)."},
+    {"url": "https://example.local/lai-suat", "keywords": ["lãi suất", "ngân hàng", "tiết kiệm"],
+     "content": "Lãi suất tiết kiệm kỳ hạn 12 tháng phổ biến ở mức 4,5% - 5,5%/năm (dữ liệu giả lập)."},
+    {"url": "https://example.local/ty-gia", "keywords": ["tỷ giá", "usd", "đô la"],
+     "content": "Tỷ giá USD/VND tham khảo khoảng 25.400 đồng (dữ liệu giả lập)."},
+    {"url": "https://example.local/gia-thuc-pham", "keywords": ["giá", "thịt", "rau", "gạo", "sữa", "thực phẩm"],
+     "content": "Giá thực phẩm thiết yếu tại các siêu thị ổn định, gạo ST25 khoảng 35.000 đồng/kg (dữ liệu giả lập)."},
+]
+
+@tool("web_search")
+async def fake_web_search(query: str) -> str:
+    """(INTERNET) Tìm kiếm thông tin trên Internet về thị trường, tin tức, kiến thức chung."""
+    await asyncio.sleep(FAKE_WEB_SEARCH_LATENCY_S)  # Không chiếm luồng trong lúc "chờ mạng".
+    q = query.lower()
+    hits = [r for r in _FAKE_WEB_RESULTS if any(k in q for k in r["keywords"])] or _FAKE_WEB_RESULTS[:1]
+    return json.dumps([{"url": r["url"], "content": r["content"]} for r in hits], ensure_ascii=False)
+
+@tool("web_search")
+async def unavailable_web_search(query: str) -> str:
+    """(INTERNET) Tìm kiếm thông tin trên Internet về thị trường, tin tức, kiến thức chung."""
+    # Dùng khi không có TAVILY_API_KEY: báo rõ cho agent thay vì trả dữ liệu giả lập như thể là kết quả thật.
+    return ("Lỗi: Tìm kiếm web hiện không khả dụng (chưa cấu hình TAVILY_API_KEY). "
+            "Hãy cho người dùng biết không thể tra cứu thông tin trên Internet lúc này.")
@@ -4,6 +4,13 @@
 # Import thư viện SentenceTransformer, đây là thư viện phổ biến và mạnh mẽ
 # để làm việc với các mô hình embedding văn bản.
 from sentence_transformers import SentenceTransformer
+import numpy as np  # Kết quả embedding được trả về dưới dạng mảng NumPy float32.
+import os  # Đọc cấu hình backend, giảm chiều, cache và batch từ biến môi trường.
+import hashlib  # Băm văn bản đã chuẩn hóa để làm khóa cache.
+import threading  # Khóa bảo vệ cache khi được gọi từ nhiều luồng.
+import unicodedata  # Chuẩn hóa Unicode (NFC) cho văn bản tiếng Việt trước khi băm.
+from collections import OrderedDict  # Cấu trúc dữ liệu cho cache LRU.
+from embedding_service import estimate_tokens  # Ước lượng số token để chia batch theo độ dài.
 
 # --- II. KHỞI TẠO MODEL ---
 
@@ -12,45 +19,265 @@ from sentence_transformers import SentenceTransformer
 # chuyên biệt cho việc tạo ra các vector đại diện cho văn bản tiếng Việt.
 _MODEL_NAME = "dangvantuan/vietnamese-document-embedding"
 
+# Backend suy luận:
+# - "torch": fp32 như ban đầu (mặc định).
+# - "torch_int8": lượng tử hóa động (dynamic quantization) các lớp Linear sang int8, chạy trên CPU.
+# - "onnx_int8": ONNX Runtime với model đã lượng tử hóa int8 (xuất một lần vào EMBED_ONNX_DIR).
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+EMBED_ONNX_DIR = os.getenv("EMBED_ONNX_DIR", os.path.join("models", "embedding_onnx"))
+# Cấu hình lượng tử hóa ONNX theo tập lệnh CPU ("avx2", "avx512", "avx512_vnni", "arm64").
+EMBED_ONNX_QCONFIG = os.getenv("EMBED_ONNX_QCONFIG", "avx2")
+
+# Giảm số chiều vector đầu ra:
+# - "none": giữ nguyên số chiều của model (mặc định).
+# - "matryoshka:<d>": giữ <d> chiều đầu tiên rồi chuẩn hóa L2.
+# - "pca:<d>": chiếu PCA (đã fit trên dữ liệu hóa đơn, lưu ở EMBED_PCA_PATH) rồi chuẩn hóa L2.
+EMBED_DIM_REDUCTION = os.getenv("EMBED_DIM_REDUCTION", "none")
+EMBED_PCA_PATH = os.getenv("EMBED_PCA_PATH", os.path.join("models", "embedding_pca.npz"))
+
+def _load_onnx_int8() -> SentenceTransformer:
+    """Tải model ONNX int8; nếu chưa có thì xuất từ model gốc và lượng tử hóa một lần."""
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+    file_name = f"model_qint8_{EMBED_ONNX_QCONFIG}.onnx"
+    quantized_path = os.path.join(EMBED_ONNX_DIR, "onnx", file_name)
+    if not os.path.exists(quantized_path):
+        print(f"⏳ Đang xuất model ONNX int8 vào {EMBED_ONNX_DIR} (chỉ làm một lần)...")
+        onnx_model = SentenceTransformer(_MODEL_NAME, backend="onnx", trust_remote_code=True)
+        onnx_model.save_pretrained(EMBED_ONNX_DIR)
+        export_dynamic_quantized_onnx_model(onnx_model, EMBED_ONNX_QCONFIG, EMBED_ONNX_DIR)
+    return SentenceTransformer(EMBED_ONNX_DIR, backend="onnx", trust_remote_code=True,
+                               model_kwargs={"file_name": f"onnx/{file_name}"})
+
+def load_model(backend: str = "torch") -> SentenceTransformer:
+    """
+    Tải model embedding với backend suy luận được chọn.
+    Nếu backend lượng tử hóa không khả dụng (thiếu thư viện, model không xuất được ONNX),
+    tự động quay về backend kế tiếp an toàn hơn.
+    """
+    if backend == "onnx_int8":
+        try:
+            return _load_onnx_int8()
+        except Exception as e:
+            print(f"⚠️ Không dùng được ONNX int8 ({e}), chuyển sang torch_int8.")
+            backend = "torch_int8"
+    fp32_model = SentenceTransformer(_MODEL_NAME, trust_remote_code=True)
+    if backend == "torch_int8":
+        import torch
+        # Lượng tử hóa động chỉ hỗ trợ CPU: trọng số Linear lưu ở int8, activation lượng tử hóa khi chạy.
+        return torch.quantization.quantize_dynamic(fp32_model.to("cpu"), {torch.nn.Linear}, dtype=torch.qint8)
+    if backend != "torch":
+        print(f"⚠️ Backend không hợp lệ '{backend}', dùng 'torch'.")
+    return fp32_model
+
+class DimReducer:
+    """
+    Giảm số chiều vector embedding sau khi mã hóa (Matryoshka hoặc PCA).
+    Vector đã giảm chiều được chuẩn hóa L2, nên dùng metric IP (tương đương cosine) trong Milvus.
+    """
+
+    def __init__(self, method: str = "none", dim: int = 0, mean=None, components=None):
+        self.method = method
+        self.dim = dim
+        self.mean = mean
+        self.components = components
+
+    @classmethod
+    def from_spec(cls, spec: str, pca_path: str = EMBED_PCA_PATH) -> "DimReducer":
+        """Tạo bộ giảm chiều từ chuỗi cấu hình, ví dụ "none", "matryoshka:256", "pca:256"."""
+        method, _, dim = (spec or "none").partition(":")
+        if method == "none":
+            return cls()
+        if method == "matryoshka":
+            return cls("matryoshka", int(dim))
+        if method == "pca":
+            params = np.load(pca_path)
+            components = params["components"][:int(dim)].astype(np.float32)
+            return cls("pca", components.shape[0], params["mean"].astype(np.float32), components)
+        raise ValueError(f"Cấu hình giảm chiều không hợp lệ: '{spec}'")
+
+    @property
+    def active(self) -> bool:
+        return self.method != "none"
+
+    def output_dim(self, full_dim: int) -> int:
+        return min(self.dim, full_dim) if self.active else full_dim
+
+    def apply(self, embs: np.ndarray) -> np.ndarray:
+        if not self.active:
+            return embs
+        if self.method == "matryoshka":
+            reduced = embs[:, :self.dim]
+        else:
+            reduced = (embs - self.mean) @ self.components.T
+        norms = np.linalg.norm(reduced, axis=1, keepdims=True)
+        return (reduced / np.maximum(norms, 1e-12)).astype(np.float32)
+
+def fit_pca(embs: np.ndarray, dim: int, path: str = EMBED_PCA_PATH) -> str:
+    """
+    Fit phép chiếu PCA trên các embedding của kho hóa đơn và lưu ra file .npz
+    (dùng với EMBED_DIM_REDUCTION="pca:<dim>").
+    """
+    embs = np.asarray(embs, dtype=np.float32)
+    mean = embs.mean(axis=0)
+    # Các vector riêng của ma trận hiệp phương sai = các hàng của Vt trong SVD của dữ liệu đã trừ trung bình.
+    _, _, vt = np.linalg.svd(embs - mean, full_matrices=False)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    np.savez(path, mean=mean, components=vt[:dim])
+    return path
+
 # 2. Tải mô hình từ Hugging Face Hub.
 # - SentenceTransformer sẽ tự động tải model về và lưu vào cache cho các lần chạy sau.
 # - `trust_remote_code=True`: Một số mô hình yêu cầu cờ này để cho phép thực thi
 #   code đi kèm với mô hình trên Hub. Đây là một yêu cầu bảo mật.
 # - Biến `model` này sẽ được khởi tạo một lần duy nhất khi module được import,
 #   giúp tiết kiệm thời gian và tài nguyên vì không phải tải lại model mỗi lần gọi hàm.
-print(f"Đang tải model embedding: {_MODEL_NAME}...")
-model = SentenceTransformer(_MODEL_NAME, trust_remote_code=True)
+print(f"Đang tải model embedding: {_MODEL_NAME} (backend={EMBED_BACKEND})...")
+model = load_model(EMBED_BACKEND)
+reducer = DimReducer.from_spec(EMBED_DIM_REDUCTION)
 print("✅ Model embedding đã được tải xong.")
 
 
-# --- III. CÁC HÀM CHỨC NĂNG ---
+# --- III. CACHE EMBEDDING VÀ CHIA BATCH THEO ĐỘ DÀI ---
+
+# Ngân sách bộ nhớ cho cache embedding (MB). Đặt 0 để tắt cache.
+_CACHE_MAX_BYTES = int(float(os.getenv("EMBED_CACHE_MAX_MB", "64")) * 1024 * 1024)
+# Ngân sách token cho một batch (số văn bản × văn bản dài nhất) và số văn bản tối đa mỗi batch.
+_MAX_BATCH_TOKENS = int(os.getenv("EMBED_BUCKET_MAX_TOKENS", "8192"))
+_MAX_BATCH_SIZE = int(os.getenv("EMBED_BUCKET_MAX_SIZE", "64"))
 
-def encode_texts(texts: list[str]) -> list[list[float]]:
+def _cache_key(text: str) -> bytes:
+    """Khóa cache: băm của văn bản đã chuẩn hóa (NFC, gộp khoảng trắng)."""
+    normalized = " ".join(unicodedata.normalize("NFC", text).split())
+    return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).digest()
+
+class EmbeddingCache:
+    """
+    Cache LRU cho vector embedding, giới hạn theo tổng số byte thay vì số phần tử.
+    Câu hỏi chat lặp lại hoặc hóa đơn được lưu lại nhiều lần sẽ không phải mã hóa lại.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: bytes):
+        with self._lock:
+            vec = self._data.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put(self, key: bytes, vec: np.ndarray):
+        if vec.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.used_bytes -= old.nbytes
+            self._data[key] = vec
+            self.used_bytes += vec.nbytes
+            # Loại bỏ các phần tử ít được dùng nhất cho tới khi về dưới ngân sách.
+            while self.used_bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.used_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.used_bytes = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"entries": len(self._data), "bytes": self.used_bytes, "hits": self.hits,
+                "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+cache = EmbeddingCache(_CACHE_MAX_BYTES)
+
+def _length_buckets(texts: list[str]) -> list[list[int]]:
+    """
+    Sắp xếp chỉ số văn bản theo độ dài rồi chia thành các "bucket".
+    Mỗi bucket chứa các văn bản có độ dài gần nhau và không vượt quá ngân sách token,
+    nên phần padding tới văn bản dài nhất trong batch là nhỏ nhất.
+    """
+    order = sorted(range(len(texts)), key=lambda i: estimate_tokens(texts[i]))
+    buckets, current = [], []
+    for i in order:
+        longest = estimate_tokens(texts[i])  # Do đã sắp xếp tăng dần, văn bản mới luôn là dài nhất.
+        if current and ((len(current) + 1) * longest > _MAX_BATCH_TOKENS or len(current) >= _MAX_BATCH_SIZE):
+            buckets.append(current)
+            current = []
+        current.append(i)
+    if current:
+        buckets.append(current)
+    return buckets
+
+def _encode_bucketed(texts: list[str]) -> np.ndarray:
+    """Mã hóa theo từng bucket độ dài và trả kết quả về đúng thứ tự ban đầu."""
+    out = None
+    for bucket in _length_buckets(texts):
+        embs = model.encode(
+            [texts[i] for i in bucket],
+            batch_size=len(bucket),  # Cả bucket là một batch: các văn bản đã có độ dài tương đương.
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        embs = reducer.apply(embs)  # Giảm chiều (nếu được cấu hình) trước khi lưu cache.
+        if out is None:
+            out = np.empty((len(texts), embs.shape[1]), dtype=np.float32)
+        out[bucket] = embs
+    return out
+
+# --- IV. CÁC HÀM CHỨC NĂNG ---
+
+def encode_texts(texts: list[str]) -> np.ndarray:
     """
     Hàm này nhận một danh sách các chuỗi văn bản và chuyển đổi chúng thành các vector embedding.
+    Trong ứng dụng, nên gọi qua `embedding_service.get_embedding_service()` để các yêu cầu
+    đồng thời được gom batch và dùng chung một bản model.
 
     Args:
         texts (list[str]): Một danh sách các chuỗi văn bản cần được mã hóa.
                            Ví dụ: ["tôi là sinh viên", "bạn tên là gì?"]
 
     Returns:
-        list[list[float]]: Một danh sách chứa các vector embedding. Mỗi vector là một
-                           danh sách các số thực (float).
-                           Ví dụ: [[0.1, 0.2, ...], [0.4, 0.5, ...]]
-    """
-    # Gọi phương thức `encode` của model để thực hiện việc chuyển đổi.
-    # Đây là một hoạt động tốn nhiều tài nguyên tính toán, thường được tăng tốc bởi GPU nếu có.
-    embs = model.encode(
-        texts,
-        batch_size=8,           # Xử lý 8 câu một lúc. Điều chỉnh số này có thể ảnh hưởng
-                                # đến tốc độ và lượng VRAM sử dụng.
-        convert_to_numpy=True,  # Trả về kết quả dưới dạng một mảng NumPy để xử lý hiệu quả.
-        show_progress_bar=False # Ẩn thanh tiến trình khi mã hóa, hữu ích khi chạy trong môi trường server.
-    )
-    # Kết quả `embs` là một mảng NumPy có hình dạng (số_lượng_văn_bản, số_chiều_embedding).
-    # Chuyển đổi mảng NumPy này thành một danh sách lồng nhau của Python (list of lists)
-    # để dễ dàng serialize (ví dụ: gửi qua API dưới dạng JSON) hoặc chèn vào Milvus.
-    return embs.tolist()
+        np.ndarray: Mảng float32 có hình dạng (số_lượng_văn_bản, số_chiều_embedding).
+    """
+    # 1. Tra cache trước: chỉ những văn bản chưa có (và không trùng nhau) mới cần mã hóa.
+    keys = [_cache_key(t) for t in texts]
+    found, missing = {}, {}
+    for text, key in zip(texts, keys):
+        if key in found or key in missing:
+            continue
+        vec = cache.get(key) if cache.max_bytes > 0 else None
+        if vec is not None:
+            found[key] = vec
+        else:
+            missing[key] = text
+
+    # 2. Mã hóa phần còn thiếu theo bucket độ dài (tốn tài nguyên nhất, được tăng tốc bởi GPU nếu có).
+    if missing:
+        miss_keys = list(missing)
+        embs = _encode_bucketed([missing[k] for k in miss_keys])
+        for key, vec in zip(miss_keys, embs):
+            # Sao chép để cache không giữ tham chiếu tới cả mảng batch.
+            vec = vec.copy()
+            found[key] = vec
+            if cache.max_bytes > 0:
+                cache.put(key, vec)
+
+    # 3. Ghép kết quả theo đúng thứ tự đầu vào.
+    # Giữ nguyên dạng mảng float32: pymilvus nhận trực tiếp mảng NumPy khi chèn,
+    # nên không cần chuyển qua list Python (tốn bộ nhớ và thời gian).
+    if not texts:
+        return np.empty((0, get_embedding_dim()), dtype=np.float32)
+    return np.stack([found[k] for k in keys]).astype(np.float32, copy=False)
 
 def get_embedding_dim() -> int:
     """
@@ -63,4 +290,17 @@ def get_embedding_dim() -> int:
     # Gọi phương thức có sẵn của model để lấy thông tin này.
     # Việc dùng hàm này đảm bảo rằng số chiều luôn đồng bộ với model đang được tải,
     # tránh việc phải "hard-code" một con số có thể bị sai lệch trong tương lai.
-    return model.get_sentence_embedding_dimension()
+    # Nếu có cấu hình giảm chiều, trả về số chiều SAU khi giảm.
+    return reducer.output_dim(model.get_sentence_embedding_dimension())
+
+def get_index_profile() -> dict:
+    """
+    Trả về metric và loại index phù hợp với vector mà model hiện tại tạo ra.
+    - Vector gốc (fp32, đủ chiều): COSINE + IVF_SQ8 (cosine phù hợp với sentence embedding hơn L2).
+    - Vector đã giảm chiều và chuẩn hóa L2: IP (tương đương cosine) + IVF_FLAT,
+      vì vector đã nhỏ nên không cần nén thêm bằng SQ8 (tránh mất recall chồng chất).
+    Đây chỉ là giá trị mặc định; có thể ghi đè bằng biến môi trường (xem `milvus_index.IndexSettings`).
+    """
+    if reducer.active:
+        return {"index_type": "IVF_FLAT", "metric_type": "IP", "params": {"nlist": 128}}
+    return {"index_type": "IVF_SQ8", "metric_type": "COSINE", "params": {"nlist": 128}}
@@ -0,0 +1,187 @@
+# file: embedding_service.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os  # Đọc cấu hình từ biến môi trường.
+import queue  # Hàng đợi yêu cầu embedding giữa các luồng.
+import threading  # Luồng worker duy nhất sở hữu model.
+import time  # Tính hạn chót (deadline) cho việc gom batch.
+import logging
+from concurrent.futures import Future  # Kết quả trả về bất đồng bộ cho từng yêu cầu.
+from typing import List
+
+import numpy as np  # Kết quả embedding là mảng NumPy float32.
+import requests  # Gọi sidecar embedding qua HTTP khi chạy ở process khác.
+from langchain_core.embeddings import Embeddings  # Giao diện embedding của LangChain.
+
+logger = logging.getLogger(__name__)
+
+# --- II. CẤU HÌNH ---
+
+# Nếu đặt biến này (ví dụ: http://localhost:8000), process hiện tại KHÔNG tải model
+# mà gửi yêu cầu tới endpoint /embed của ứng dụng FastAPI (nơi đang giữ model).
+# Nhờ vậy FastAPI và Streamlit chỉ dùng MỘT bản model trong bộ nhớ.
+EMBEDDING_SERVICE_URL = os.getenv("EMBEDDING_SERVICE_URL", "").rstrip("/")
+
+# Thời gian tối đa (ms) một yêu cầu chờ để được gom chung batch với các yêu cầu khác.
+MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "10"))
+# Ngân sách token cho một lần gọi model (số văn bản × độ dài văn bản dài nhất sau khi padding).
+MAX_BATCH_TOKENS = int(os.getenv("EMBED_MAX_BATCH_TOKENS", "16384"))
+# Thời gian chờ tối đa khi gọi sidecar qua HTTP.
+REMOTE_TIMEOUT_S = float(os.getenv("EMBED_REMOTE_TIMEOUT_S", "60"))
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng nhanh số token của một văn bản (khoảng 4 ký tự/token), đủ để gom batch."""
+    return max(1, len(text) // 4)
+
+# --- III. DỊCH VỤ EMBEDDING TRONG PROCESS ---
+
+class _Request:
+    __slots__ = ("texts", "tokens", "future")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        # Chi phí sau padding: số văn bản × văn bản dài nhất.
+        self.tokens = len(texts) * max((estimate_tokens(t) for t in texts), default=1)
+        self.future: Future = Future()
+
+class EmbeddingService:
+    """
+    Dịch vụ embedding dùng chung trong một process.
+    - Mọi yêu cầu được đưa vào hàng đợi; một luồng worker duy nhất gọi model.
+    - Worker gom các yêu cầu đến gần nhau thành một batch, cho tới khi hết ngân sách token
+      hoặc tới hạn chót `max_wait_ms`, rồi chia kết quả lại cho từng yêu cầu.
+    - Kết quả là mảng NumPy float32, không chuyển qua list Python.
+    """
+
+    def __init__(self, encode_fn, max_wait_ms: float = MAX_WAIT_MS, max_batch_tokens: int = MAX_BATCH_TOKENS):
+        self._encode_fn = encode_fn
+        self._max_wait = max_wait_ms / 1000.0
+        self._max_batch_tokens = max_batch_tokens
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="embedding-service", daemon=True)
+        self._worker.start()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Mã hóa danh sách văn bản (chặn cho tới khi có kết quả).
+
+        Returns:
+            np.ndarray: Mảng float32 có hình dạng (len(texts), số_chiều).
+        """
+        if not texts:
+            import embed_model  # Import lười: đã được nạp sẵn khi process chạy dịch vụ trong process.
+            # Giữ đúng số chiều để /embed báo X-Embedding-Shape "0,dim" và phía client reshape đúng.
+            return np.zeros((0, embed_model.get_embedding_dim()), dtype=np.float32)
+        request = _Request(list(texts))
+        self._queue.put(request)
+        return request.future.result()
+
+    def embed_query(self, text: str) -> np.ndarray:
+        """Mã hóa một câu truy vấn, trả về vector 1 chiều float32."""
+        return self.embed([text])[0]
+
+    def _collect(self) -> List[_Request]:
+        """Lấy yêu cầu đầu tiên rồi gom thêm cho tới khi hết ngân sách token hoặc tới hạn chót."""
+        batch = [self._queue.get()]
+        tokens = batch[0].tokens
+        deadline = time.monotonic() + self._max_wait
+        while tokens < self._max_batch_tokens:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            tokens += request.tokens
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [t for request in batch for t in request.texts]
+            try:
+                embs = np.asarray(self._encode_fn(texts), dtype=np.float32)
+            except Exception as e:
+                logger.error(f"❌ Lỗi khi tạo embedding cho batch {len(texts)} văn bản: {e}", exc_info=True)
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            offset = 0
+            for request in batch:
+                n = len(request.texts)
+                request.future.set_result(embs[offset:offset + n])
+                offset += n
+
+# --- IV. CLIENT CHO SIDECAR (PROCESS KHÁC) ---
+
+class RemoteEmbeddingClient:
+    """
+    Client gọi endpoint /embed của ứng dụng FastAPI.
+    Dữ liệu trả về là byte float32 thô (kèm header X-Embedding-Shape), không qua JSON.
+    """
+
+    def __init__(self, base_url: str, timeout: float = REMOTE_TIMEOUT_S):
+        self._url = f"{base_url}/embed"
+        self._timeout = timeout
+        self._session = requests.Session()
+        self._dim = None  # Số chiều biết được từ lần gọi trước (để trả về mảng rỗng đúng hình dạng).
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        if not texts and self._dim is not None:
+            return np.zeros((0, self._dim), dtype=np.float32)
+        # Chưa biết số chiều: vẫn hỏi sidecar (trả về "0,dim" cho danh sách rỗng).
+        resp = self._session.post(self._url, json={"texts": list(texts)}, timeout=self._timeout)
+        resp.raise_for_status()
+        rows, dim = (int(x) for x in resp.headers["X-Embedding-Shape"].split(","))
+        self._dim = dim
+        return np.frombuffer(resp.content, dtype=np.float32).reshape(rows, dim)
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self.embed([text])[0]
+
+# --- V. ĐIỂM TRUY CẬP DUY NHẤT ---
+
+_service = None
+_service_lock = threading.Lock()
+
+def get_embedding_service():
+    """
+    Trả về dịch vụ embedding dùng chung của process (khởi tạo lười, chỉ một lần).
+    - Có EMBEDDING_SERVICE_URL: dùng sidecar qua HTTP, không tải model.
+    - Không có: tải model qua `embed_model` và chạy worker trong process.
+    """
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                if EMBEDDING_SERVICE_URL:
+                    logger.info(f"Sử dụng sidecar embedding tại: {EMBEDDING_SERVICE_URL}")
+                    _service = RemoteEmbeddingClient(EMBEDDING_SERVICE_URL)
+                else:
+                    import embed_model  # Import lười để process dùng sidecar không phải tải model.
+                    from resource_scheduler import get_scheduler
+                    # Worker embedding chạy trên nhóm nhân "embed", không tranh nhân với OCR / sửa lỗi.
+                    _service = EmbeddingService(get_scheduler().wrap("embed", embed_model.encode_texts))
+    return _service
+
+class ServiceEmbeddings(Embeddings):
+    """
+    Bộ chuyển đổi để LangChain (ví dụ: vector store Milvus) dùng dịch vụ embedding chung
+    thay vì tự tải một bản model khác qua HuggingFaceEmbeddings.
+    """
+
+    def __init__(self, service=None):
+        self._service = service
+
+    @property
+    def service(self):
+        return self._service or get_embedding_service()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # Giao diện LangChain yêu cầu list[float].
+        return self.service.embed(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.service.embed_query(text).tolist()
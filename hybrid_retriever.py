@@ -0,0 +1,87 @@
+# file: hybrid_retriever.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os
+import json
+import logging
+from typing import Any, Dict, List
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from lexical_index import LexicalIndex  # Chỉ mục BM25 cập nhật khi chèn hóa đơn.
+
+logger = logging.getLogger(__name__)
+
+# --- II. CẤU HÌNH ---
+# Số kết quả trả về sau khi kết hợp.
+HYBRID_TOP_K = int(os.getenv("HYBRID_TOP_K", "5"))
+# Số ứng viên lấy từ MỖI nhánh (vector và BM25) trước khi kết hợp.
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", "50"))
+# Hằng số k của Reciprocal Rank Fusion: điểm = Σ 1 / (k + thứ hạng). 60 là giá trị thông dụng.
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+
+# --- III. KẾT HỢP THỨ HẠNG ---
+
+def reciprocal_rank_fusion(rankings: Dict[str, List[int]], k: int = HYBRID_RRF_K) -> List[tuple]:
+    """
+    Kết hợp nhiều danh sách id đã xếp hạng (thứ hạng bắt đầu từ 1).
+    Chỉ dùng thứ hạng, không dùng điểm, nên không cần chuẩn hóa điểm cosine và điểm BM25 về cùng thang.
+
+    Returns:
+        List[tuple]: (id, điểm RRF, {tên nhánh: thứ hạng}) giảm dần theo điểm.
+    """
+    fused: Dict[int, list] = {}
+    for source, ids in rankings.items():
+        for rank, doc_id in enumerate(ids, start=1):
+            entry = fused.setdefault(doc_id, [0.0, {}])
+            entry[0] += 1.0 / (k + rank)
+            entry[1][source] = rank
+    return sorted(((doc_id, score, ranks) for doc_id, (score, ranks) in fused.items()),
+                  key=lambda item: item[1], reverse=True)
+
+# --- IV. RETRIEVER ---
+
+class HybridRetriever(BaseRetriever):
+    """
+    Tìm kiếm lai: vector (Milvus) + từ vựng (BM25), kết hợp bằng Reciprocal Rank Fusion.
+
+    Tìm kiếm vector tốt cho câu hỏi theo nghĩa ("hóa đơn mua rau"), nhưng bỏ lỡ các tra cứu chính xác
+    như mã hóa đơn, số điện thoại hay số tiền; BM25 thì ngược lại. Sau khi kết hợp, một lần truy vấn top-k
+    trả về đúng hóa đơn cho cả hai loại câu hỏi.
+    """
+
+    vector_store: Any
+    lexical_index: LexicalIndex
+    collection: Any  # pymilvus Collection: lấy nội dung của các hóa đơn chỉ có trong kết quả BM25.
+    k: int = HYBRID_TOP_K
+    fetch_k: int = HYBRID_FETCH_K
+    rrf_k: int = HYBRID_RRF_K
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        dense_docs = self.vector_store.similarity_search(query, k=self.fetch_k)
+        by_id = {int(doc.metadata["id"]): doc for doc in dense_docs if "id" in doc.metadata}
+        lexical_ids = [doc_id for doc_id, _ in self.lexical_index.search(query, k=self.fetch_k)]
+
+        fused = reciprocal_rank_fusion({"dense": list(by_id), "lexical": lexical_ids}, k=self.rrf_k)[:self.k]
+        missing = [doc_id for doc_id, _, _ in fused if doc_id not in by_id]
+        if missing:
+            rows = self.collection.query(expr=f"id in {json.dumps(missing)}",
+                                         output_fields=["id", "filename", "content"])
+            for row in rows:
+                by_id[int(row["id"])] = Document(page_content=row["content"],
+                                                 metadata={"id": row["id"], "filename": row["filename"]})
+
+        results = []
+        for doc_id, score, ranks in fused:
+            doc = by_id.get(doc_id)
+            if doc is None:
+                continue  # Đã bị xóa khỏi Milvus nhưng còn trong chỉ mục BM25.
+            metadata = {key: value for key, value in doc.metadata.items() if key != "embedding"}
+            metadata.update(rrf_score=round(score, 5), dense_rank=ranks.get("dense"), lexical_rank=ranks.get("lexical"))
+            results.append(Document(page_content=doc.page_content, metadata=metadata))
+        return results
@@ -0,0 +1,165 @@
+# file: image_derivatives.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os
+import io
+import gzip
+import shutil
+import hashlib  # Tên file theo nội dung: cùng nội dung -> cùng URL, cache trình duyệt không bao giờ lỗi thời.
+import logging
+import threading
+from datetime import datetime
+from typing import Optional
+
+from PIL import Image, ImageOps, features  # Pillow: resize, xoay theo EXIF, mã hóa WebP/JPEG.
+
+logger = logging.getLogger(__name__)
+
+# --- II. CẤU HÌNH ---
+# Trang kết quả từng hiển thị thẳng ảnh gốc từ điện thoại (vài MB mỗi ảnh) qua /static/uploads:
+# một lần duyệt 30 hóa đơn tải về hàng trăm MB. Khi tải lên, mỗi ảnh được tạo thêm hai bản nhỏ:
+# - "thumb":   ảnh thu nhỏ hiển thị trong trang (vài chục KB).
+# - "preview": ảnh xem chi tiết, mở khi bấm vào ảnh thu nhỏ (đủ rõ để đọc hóa đơn).
+# Tên file là mã băm nội dung, nên được phục vụ với Cache-Control "immutable" (xem main.py).
+
+# Thư mục chứa ảnh đã tạo, phục vụ tại /derived.
+DERIVED_DIR = os.getenv("DERIVED_DIR", "derived")
+# Định dạng: "webp" (nhỏ hơn) hoặc "jpeg"; Pillow không hỗ trợ WebP thì tự dùng JPEG.
+DERIVATIVE_FORMAT = os.getenv("DERIVATIVE_FORMAT", "webp").lower()
+# Cạnh dài tối đa (pixel) và chất lượng nén của từng loại.
+PREVIEW_MAX_PX = int(os.getenv("PREVIEW_MAX_PX", "1600"))
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", "75"))
+THUMB_MAX_PX = int(os.getenv("THUMB_MAX_PX", "360"))
+THUMB_QUALITY = int(os.getenv("THUMB_QUALITY", "70"))
+# Chuyển ảnh gốc (đã xử lý xong) sang kho lưu trữ lạnh dạng nén gzip, xóa khỏi static/uploads.
+ARCHIVE_ORIGINALS = os.getenv("ARCHIVE_ORIGINALS", "0") == "1"
+COLD_STORAGE_DIR = os.getenv("COLD_STORAGE_DIR", "cold_storage")
+
+_EXTENSIONS = {"webp": "webp", "jpeg": "jpg"}
+
+def _output_format() -> str:
+    if DERIVATIVE_FORMAT == "webp" and features.check("webp"):
+        return "webp"
+    return "jpeg"
+
+# --- III. THỐNG KÊ ---
+
+class DerivativeStats:
+    """Tổng dung lượng ảnh gốc so với ảnh đã tạo kể từ khi khởi động (an toàn luồng)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.images = 0
+        self.failed = 0
+        self.archived = 0
+        self.original_bytes = 0
+        self.preview_bytes = 0
+        self.thumb_bytes = 0
+
+    def record(self, original: int, preview: int, thumb: int):
+        with self._lock:
+            self.images += 1
+            self.original_bytes += original
+            self.preview_bytes += preview
+            self.thumb_bytes += thumb
+
+    def record_failure(self):
+        with self._lock:
+            self.failed += 1
+
+    def record_archive(self):
+        with self._lock:
+            self.archived += 1
+
+    def report(self) -> dict:
+        with self._lock:
+            n = self.images
+            return {
+                "format": _output_format(),
+                "images": n,
+                "failed": self.failed,
+                "archived_originals": self.archived,
+                "avg_original_kb": round(self.original_bytes / n / 1024, 1) if n else None,
+                "avg_preview_kb": round(self.preview_bytes / n / 1024, 1) if n else None,
+                "avg_thumb_kb": round(self.thumb_bytes / n / 1024, 1) if n else None,
+                # Dung lượng trang kết quả: ảnh thu nhỏ thay cho ảnh gốc.
+                "page_weight_ratio": round(self.thumb_bytes / self.original_bytes, 4) if self.original_bytes else None,
+            }
+
+derivative_stats = DerivativeStats()
+
+# --- IV. TẠO ẢNH ---
+
+def _encode(image: Image.Image, max_px: int, quality: int, fmt: str) -> bytes:
+    copy = image.copy()
+    copy.thumbnail((max_px, max_px), Image.LANCZOS)  # Giữ tỉ lệ, không phóng to ảnh nhỏ.
+    buf = io.BytesIO()
+    if fmt == "webp":
+        copy.save(buf, "WEBP", quality=quality, method=4)
+    else:
+        copy.save(buf, "JPEG", quality=quality, optimize=True, progressive=True)
+    return buf.getvalue()
+
+def _store(data: bytes, ext: str, out_dir: str) -> str:
+    """Ghi nội dung vào file đặt tên theo mã băm (bỏ qua nếu đã có); trả về tên file."""
+    name = f"{hashlib.sha256(data).hexdigest()[:20]}.{ext}"
+    path = os.path.join(out_dir, name[:2], name)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)  # Đổi tên nguyên tử: không bao giờ phục vụ file ghi dở.
+    return f"{name[:2]}/{name}"
+
+def make_derivatives(image_path: str, out_dir: str = DERIVED_DIR) -> Optional[dict]:
+    """
+    Tạo ảnh xem trước và ảnh thu nhỏ cho một ảnh tải lên.
+
+    Returns:
+        dict | None: {"preview", "thumb"} (đường dẫn tương đối trong `out_dir`), kích thước ảnh thu nhỏ
+        ("thumb_width", "thumb_height"); None nếu không đọc được ảnh (trang kết quả dùng ảnh gốc).
+    """
+    fmt = _output_format()
+    try:
+        with Image.open(image_path) as img:
+            # Ảnh điện thoại thường lưu hướng xoay trong EXIF; áp dụng luôn vì bản nhỏ không giữ EXIF.
+            image = ImageOps.exif_transpose(img).convert("RGB")
+        preview = _encode(image, PREVIEW_MAX_PX, PREVIEW_QUALITY, fmt)
+        thumb = _encode(image, THUMB_MAX_PX, THUMB_QUALITY, fmt)
+        with Image.open(io.BytesIO(thumb)) as t:
+            thumb_size = t.size
+    except Exception as e:
+        logger.warning(f"Không tạo được ảnh thu nhỏ cho {image_path}: {e}")
+        derivative_stats.record_failure()
+        return None
+    derivative_stats.record(os.path.getsize(image_path), len(preview), len(thumb))
+    return {
+        "preview": _store(preview, _EXTENSIONS[fmt], out_dir),
+        "thumb": _store(thumb, _EXTENSIONS[fmt], out_dir),
+        "thumb_width": thumb_size[0],
+        "thumb_height": thumb_size[1],
+    }
+
+# --- V. KHO LƯU TRỮ LẠNH ---
+
+def archive_original(image_path: str, cold_dir: str = COLD_STORAGE_DIR) -> str:
+    """
+    Nén gzip ảnh gốc vào kho lạnh (chia thư mục theo tháng) rồi xóa bản trong thư mục tải lên.
+    Dùng sau khi ảnh đã được OCR và đã có ảnh thu nhỏ. Trả về đường dẫn file nén.
+    """
+    target_dir = os.path.join(cold_dir, datetime.now().strftime("%Y-%m"))
+    os.makedirs(target_dir, exist_ok=True)
+    target = os.path.join(target_dir, os.path.basename(image_path) + ".gz")
+    with open(image_path, "rb") as src, gzip.open(target + ".tmp", "wb", compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(target + ".tmp", target)
+    os.remove(image_path)
+    derivative_stats.record_archive()
+    return target
+
+def restore_original(archived_path: str, dest_path: str) -> str:
+    """Giải nén một ảnh gốc từ kho lạnh (ví dụ để OCR lại)."""
+    with gzip.open(archived_path, "rb") as src, open(dest_path, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    return dest_path
@@ -0,0 +1,354 @@
+# file: ingest.py
+#
+# Nạp hàng loạt (offline) ảnh hóa đơn vào Milvus, không cần giao diện web:
+#   python ingest.py path/to/images --workers 4
+#   python ingest.py manifest.txt --batch-size 512
+#
+# - Các bước OCR -> sửa lỗi -> trích xuất (process_receipt) chạy song song trên một process pool;
+#   mỗi process tự tải model của backend đúng một lần.
+# - Kết quả JSON được ghi vào output_structured/ (save_json_from_image_path), theo cấu trúc đường dẫn tuyệt đối
+#   của ảnh, nên ảnh cùng tên ở các thư mục nguồn khác nhau không ghi đè nhau.
+# - Embedding và chèn vào Milvus theo lô lớn ở process chính.
+# - Ảnh chụp lại của hóa đơn đã có trong collection bị phát hiện bằng perceptual hash (receipt_dedup)
+#   và không được chèn lại; nếu xác nhận được ngay bằng OCR nhanh thì bỏ qua luôn sửa lỗi và LLM.
+# - Tiến độ được ghi vào file checkpoint (JSONL, chỉ ghi nối): chạy lại cùng lệnh sau khi bị dừng giữa chừng
+#   sẽ bỏ qua ảnh đã chèn, chèn lại từ file JSON các ảnh đã trích xuất nhưng chưa chèn, và không OCR lại.
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, Optional, Tuple
+
+# --- II. CẤU HÌNH ---
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+# Số process xử lý ảnh. Mỗi process giữ một bản model sửa lỗi chính tả, nên mặc định không dùng hết số nhân.
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Số hóa đơn mỗi lần embedding + chèn vào Milvus.
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+# Thư mục chứa file checkpoint (cùng thư mục trạng thái với collection_events, đã nằm trong .gitignore).
+INGEST_STATE_DIR = os.path.join(os.getenv("INVOICE_STATE_DIR", ".invoice_state"), "ingest")
+
+# --- III. DANH SÁCH ẢNH ĐẦU VÀO ---
+
+def _image_key(path: str) -> str:
+    """
+    Khóa của một ảnh (lưu vào trường `filename` của Milvus và checkpoint): đường dẫn tuyệt đối.
+    Đường dẫn tương đối so với thư mục nguồn không đủ: "2024/01/a.jpg" của hai thư mục nguồn khác nhau
+    sẽ trùng khóa, ảnh thứ hai bị bỏ qua như đã chèn.
+    """
+    return os.path.abspath(path).replace(os.sep, "/")
+
+def collect_images(source: str) -> Tuple[str, List[str]]:
+    """
+    Liệt kê ảnh từ một thư mục (đệ quy) hoặc từ file manifest.
+
+    Manifest: mỗi dòng là một đường dẫn ảnh (tương đối so với thư mục chứa manifest), hoặc một đối tượng
+    JSON có khóa "path". Dòng trống và dòng bắt đầu bằng '#' được bỏ qua.
+
+    Returns:
+        Tuple[str, List[str]]: (thư mục gốc, danh sách đường dẫn ảnh đã sắp xếp).
+    """
+    if os.path.isdir(source):
+        base_dir = os.path.abspath(source)
+        paths = []
+        for root, _, files in os.walk(base_dir):
+            paths.extend(os.path.join(root, name) for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+        return base_dir, sorted(paths)
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                line = json.loads(line)["path"]
+            paths.append(line if os.path.isabs(line) else os.path.join(base_dir, line))
+    # Giữ thứ tự của manifest, bỏ trùng lặp.
+    return base_dir, list(dict.fromkeys(paths))
+
+# --- IV. CHECKPOINT ---
+
+class IngestCheckpoint:
+    """
+    Nhật ký tiến độ dạng JSONL (chỉ ghi nối, mỗi dòng được flush ngay), một trong bốn trạng thái cho mỗi ảnh:
+    - "extracted": đã trích xuất và ghi file JSON, chưa chèn vào Milvus.
+    - "inserted":  đã chèn vào Milvus.
+    - "duplicate": trùng với một hóa đơn đã có, không chèn.
+    - "failed":    pipeline không trả về JSON hợp lệ.
+    Dòng sau ghi đè dòng trước của cùng một ảnh; dòng cuối ghi dở (do bị dừng đột ngột) được bỏ qua.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.records: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[record["key"]] = record
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def status(self, key: str) -> Optional[str]:
+        record = self.records.get(key)
+        return record["status"] if record else None
+
+    def mark(self, key: str, status: str, **fields):
+        record = {"key": key, "status": status, **fields}
+        self.records[key] = record
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def sync(self):
+        """Đảm bảo nhật ký đã xuống đĩa (gọi sau mỗi lô chèn vào Milvus)."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+# --- V. PROCESS XỬ LÝ ẢNH ---
+
+_backend = None
+
+def _init_worker(quiet: bool, counter, workers: int):
+    """Chạy một lần trong mỗi process: nhận phần nhân CPU riêng rồi tải backend (OCR, model sửa lỗi, Gemini)."""
+    global _backend
+    from resource_scheduler import available_cores
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    # Chia các nhân thành các phần rời nhau cho từng process; bộ lập lịch trong process chỉ chia tiếp
+    # phần của mình giữa OCR / sửa lỗi / embedding, nên các process không tranh nhân của nhau.
+    cores = available_cores()
+    per_worker = max(1, len(cores) // max(1, workers))
+    start = (index * per_worker) % len(cores)
+    mine = cores[start:start + per_worker]
+    os.environ["SCHED_CORES"] = ",".join(map(str, mine))
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, mine)  # Các luồng tạo sau (torch, Tesseract) kế thừa affinity này.
+    if quiet:
+        # Pipeline in rất nhiều dòng cho mỗi ảnh; khi chạy hàng nghìn ảnh chỉ giữ lại báo cáo của process chính.
+        sys.stdout = open(os.devnull, "w")
+    import backend
+    _backend = backend
+
+def _process_one(path: str, json_dir: str, candidates: list) -> Tuple[Optional[dict], Optional[str], Optional[dict], float]:
+    """
+    OCR + sửa lỗi + trích xuất một ảnh và ghi file JSON.
+    `candidates` là các hóa đơn có hash gần (tra ở process chính); trùng thì không ghi JSON.
+    Trả về (dữ liệu, lỗi, bản trùng, thời gian xử lý).
+    """
+    import receipt_dedup
+    start = time.perf_counter()
+    try:
+        data, duplicate = receipt_dedup.process_with_dedup(path, candidates, _backend.process_receipt,
+                                                           _backend.extract_text_fast)
+        if duplicate is not None:
+            return None, None, duplicate.to_dict(), time.perf_counter() - start
+        if not isinstance(data, dict):
+            return None, "Không trích xuất được JSON hợp lệ", None, time.perf_counter() - start
+        _backend.save_json_from_image_path(path, data, output_root=json_dir)
+        return data, None, None, time.perf_counter() - start
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}", None, time.perf_counter() - start
+
+def _json_dir(output_root: str, key: str) -> str:
+    """Thư mục JSON của một ảnh: lặp lại đường dẫn tuyệt đối của ảnh để các ảnh cùng tên không ghi đè nhau."""
+    sub = os.path.splitdrive(os.path.dirname(key))[1].lstrip("/\\")
+    return os.path.join(output_root, sub)
+
+def _json_path(output_root: str, key: str) -> str:
+    # Cùng quy tắc đặt tên với backend.save_json_from_image_path.
+    name = os.path.splitext(os.path.basename(key))[0] + ".json"
+    return os.path.join(_json_dir(output_root, key), name)
+
+# --- VI. CHƯƠNG TRÌNH CHÍNH ---
+
+class _Progress:
+    def __init__(self, total: int, every_s: float):
+        self.total = total
+        self.every_s = every_s
+        self.start = time.perf_counter()
+        self._last = self.start
+        self.extracted = self.failed = self.inserted = self.already_present = self.duplicates = 0
+        self.worker_s = 0.0
+        self.insert_s = 0.0
+
+    @property
+    def rate(self) -> float:
+        return (self.extracted + self.failed + self.duplicates) / max(time.perf_counter() - self.start, 1e-9)
+
+    def maybe_report(self, force: bool = False):
+        now = time.perf_counter()
+        if not force and now - self._last < self.every_s:
+            return
+        self._last = now
+        done = self.extracted + self.failed + self.duplicates
+        eta = (self.total - done) / self.rate if self.rate else 0.0
+        print(f"⏱️ {done}/{self.total} ảnh | lỗi {self.failed} | trùng {self.duplicates} | đã chèn {self.inserted} | "
+              f"{self.rate:.2f} hóa đơn/giây | còn ~{eta / 60:.1f} phút", flush=True)
+
+def _flush_batch(coll, batch: List[Tuple[str, dict]], checkpoint: IngestCheckpoint, progress: _Progress):
+    """Embedding + chèn một lô vào Milvus rồi ghi checkpoint. Bỏ qua ảnh đã có trong collection."""
+    import invoice_store
+    if not batch:
+        return
+    start = time.perf_counter()
+    # Nếu lần chạy trước bị dừng sau khi chèn nhưng trước khi kịp ghi checkpoint, đừng chèn trùng.
+    existing = invoice_store.existing_filenames(coll, [key for key, _ in batch])
+    fresh = [(key, data) for key, data in batch if key not in existing]
+    ids = invoice_store.insert_invoices(coll, [key for key, _ in fresh], [data for _, data in fresh])
+    for (key, _), pk in zip(fresh, ids):
+        checkpoint.mark(key, "inserted", id=pk)
+    for key in existing:
+        checkpoint.mark(key, "inserted")
+    checkpoint.sync()
+    progress.inserted += len(fresh)
+    progress.already_present += len(existing)
+    progress.insert_s += time.perf_counter() - start
+    batch.clear()
+
+def main():
+    parser = argparse.ArgumentParser(description="Nạp hàng loạt ảnh hóa đơn: OCR -> trích xuất -> JSON -> Milvus")
+    parser.add_argument("source", help="Thư mục ảnh (quét đệ quy) hoặc file manifest")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS, help="Số process xử lý ảnh")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="Số hóa đơn mỗi lần chèn vào Milvus")
+    parser.add_argument("--output-dir", default="output_structured", help="Thư mục ghi file JSON")
+    parser.add_argument("--collection", default=None, help="Tên collection Milvus (mặc định: invoice_collection)")
+    parser.add_argument("--checkpoint", default=None, help="File checkpoint (mặc định: .invoice_state/ingest/<collection>.jsonl)")
+    parser.add_argument("--retry-failed", action="store_true", help="Xử lý lại các ảnh đã lỗi ở lần chạy trước")
+    parser.add_argument("--no-milvus", action="store_true", help="Chỉ trích xuất và ghi JSON, không chèn vào Milvus")
+    parser.add_argument("--no-dedup", action="store_true", help="Không kiểm tra hóa đơn chụp trùng")
+    parser.add_argument("--rebuild-index", action="store_true",
+                        help="Bảo trì offline: rebuild index IVF nếu nlist không còn phù hợp (tìm kiếm gián đoạn trong lúc rebuild)")
+    parser.add_argument("--report-every", type=float, default=10.0, help="Chu kỳ in tiến độ (giây)")
+    parser.add_argument("--verbose", action="store_true", help="Giữ log chi tiết của pipeline trong các process")
+    args = parser.parse_args()
+
+    collection_name = args.collection or "invoice_collection"
+    checkpoint = IngestCheckpoint(args.checkpoint or os.path.join(INGEST_STATE_DIR, f"{collection_name}.jsonl"))
+    _, paths = collect_images(args.source)
+
+    # Phân loại theo checkpoint: chưa làm / đã trích xuất nhưng chưa chèn / đã xong.
+    todo, pending_insert = [], []
+    for path in paths:
+        key = _image_key(path)
+        status = checkpoint.status(key)
+        if status is None or (status == "failed" and args.retry_failed):
+            todo.append((key, path))
+        elif status == "extracted" and not args.no_milvus:
+            pending_insert.append(key)
+    done_before = len(paths) - len(todo) - len(pending_insert)
+    print(f"📂 {len(paths)} ảnh | cần xử lý {len(todo)} | chờ chèn {len(pending_insert)} | đã xong/bỏ qua {done_before}")
+
+    coll = None
+    if not args.no_milvus:
+        import invoice_store  # Tải model embedding và kết nối Milvus chỉ khi cần chèn.
+        # KHÔNG xóa collection đã có (khác với khi khởi động ứng dụng web).
+        coll = invoice_store.ensure_collection(collection_name, drop_existing=False)
+
+    dedup_index = None
+    if coll is not None and not args.no_dedup:
+        import receipt_dedup
+        # Chỉ mục gắn với dữ liệu thật trong collection, nên chỉ dùng khi có chèn vào Milvus.
+        dedup_index = receipt_dedup.get_duplicate_index(collection_name) if receipt_dedup.DEDUP_ENABLED else None
+
+    progress = _Progress(total=len(todo), every_s=args.report_every)
+    batch: List[Tuple[str, dict]] = []
+
+    # Ảnh đã trích xuất ở lần chạy trước: đọc lại file JSON thay vì OCR lại.
+    for key in pending_insert:
+        with open(checkpoint.records[key]["json"], encoding="utf-8") as f:
+            batch.append((key, json.load(f)))
+        if len(batch) >= args.batch_size:
+            _flush_batch(coll, batch, checkpoint, progress)
+
+    if todo:
+        # "spawn": mỗi process tự khởi tạo torch/Tesseract sạch sẽ thay vì kế thừa trạng thái luồng của process chính.
+        ctx = multiprocessing.get_context("spawn")
+        # Giới hạn số việc đang chờ để bộ nhớ không tăng theo số ảnh và checkpoint tiến đều.
+        max_in_flight = max(1, args.workers) * 4
+        queue = iter(todo)
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=ctx,
+                                 initializer=_init_worker,
+                                 initargs=(not args.verbose, ctx.Value("i", 0), args.workers)) as pool:
+            in_flight = {}
+
+            def submit_more():
+                for key, path in queue:
+                    h, candidates = None, []
+                    if dedup_index is not None:
+                        # Hash ở process chính (vài chục ms/ảnh) để tra chỉ mục trước khi tốn công OCR.
+                        h = receipt_dedup.image_hash(path)
+                        candidates = dedup_index.candidates(h)
+                    future = pool.submit(_process_one, path, _json_dir(args.output_dir, key), candidates)
+                    in_flight[future] = (key, h, len(candidates))
+                    if len(in_flight) >= max_in_flight:
+                        return
+
+            submit_more()
+            while in_flight:
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key, h, n_candidates = in_flight.pop(future)
+                    data, error, duplicate, seconds = future.result()
+                    progress.worker_s += seconds
+                    if dedup_index is not None and not error:
+                        dedup_index.record(duplicate["stage"] if duplicate else None, n_candidates)
+                    if error:
+                        progress.failed += 1
+                        checkpoint.mark(key, "failed", error=error)
+                        continue
+                    if duplicate:
+                        progress.duplicates += 1
+                        checkpoint.mark(key, "duplicate", duplicate_of=duplicate)
+                        continue
+                    progress.extracted += 1
+                    if dedup_index is not None:
+                        # Ghi nhận ngay (trước khi chèn) để ảnh chụp lại ở phía sau trong cùng lần chạy cũng bị phát hiện.
+                        dedup_index.add(key, h, data)
+                    checkpoint.mark(key, "extracted", json=_json_path(args.output_dir, key))
+                    if coll is not None:
+                        batch.append((key, data))
+                if coll is not None and len(batch) >= args.batch_size:
+                    _flush_batch(coll, batch, checkpoint, progress)
+                submit_more()
+                progress.maybe_report()
+
+    if coll is not None:
+        _flush_batch(coll, batch, checkpoint, progress)
+        import milvus_index
+        if args.rebuild_index:
+            milvus_index.rebuild_index(coll)
+        elif progress.inserted:
+            # Dữ liệu có thể đã tăng vượt khoảng mà nlist được thiết kế (mặc định chỉ cảnh báo).
+            milvus_index.maybe_rebuild_index(coll)
+    checkpoint.close()
+
+    elapsed = time.perf_counter() - progress.start
+    processed = progress.extracted + progress.failed + progress.duplicates
+    print("\n" + "=" * 50)
+    print(f"✅ Trích xuất {progress.extracted} | lỗi {progress.failed} | chèn {progress.inserted} "
+          f"(bỏ qua {progress.already_present} đã có) | trùng lặp {progress.duplicates} trong {elapsed:.1f} giây")
+    if processed:
+        print(f"📊 {processed / elapsed:.2f} hóa đơn/giây với {args.workers} process "
+              f"(trung bình {progress.worker_s / processed:.2f} giây/ảnh trong mỗi process); "
+              f"embedding + chèn Milvus: {progress.insert_s:.1f} giây")
+    if progress.failed:
+        print(f"⚠️ Xem lỗi trong {checkpoint.path}; chạy lại với --retry-failed để thử lại.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# file: intent_router.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import re  # Các luật nhận diện ý định dựa trên biểu thức chính quy.
+import json
+import unicodedata  # Bỏ dấu tiếng Việt để luật khớp cả khi người dùng gõ không dấu.
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+# Gọi thẳng các hàm công cụ (không qua LLM).
+from custom_tools import get_vietnam_current_time, calculator, get_invoice_report, filter_invoices
+from invoice_analytics import parse_amount, format_vnd
+
+# --- II. CHUẨN HÓA CÂU HỎI ---
+
+def normalize(text: str) -> str:
+    """Chữ thường, bỏ dấu tiếng Việt (kể cả 'đ' -> 'd') và gộp khoảng trắng."""
+    text = unicodedata.normalize("NFD", text.lower()).replace("đ", "d")
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    return " ".join(text.split())
+
+# --- III. CÁC LUẬT NHẬN DIỆN Ý ĐỊNH ---
+# Luật chỉ khớp những câu hỏi ĐƠN GIẢN, không mơ hồ. Mỗi luật là một MẪU CẢ CÂU (khớp từ đầu tới cuối):
+# câu có thêm bất kỳ từ hay con số nào ngoài mẫu (thời gian, số tiền, "top 3", "chưa thanh toán", so sánh...)
+# đều không khớp và được chuyển cho LLM xử lý như trước.
+
+_INVOICE = r"(?:hoa don|hd|bill|phieu)"
+# Phần mở đầu / kết thúc lịch sự không làm đổi nghĩa câu hỏi.
+_LEAD = r"(?:(?:cho (?:toi|minh|em) (?:hoi|biet)|cho hoi|xin hoi|hay cho (?:toi |minh )?biet|ban oi) )?"
+_TAIL = r"(?: (?:vay|the|a|nhi|nhe|roi|ha|khong))*"
+_TRAILING_PUNCT = re.compile(r"[\s?!.,]+$")
+
+def _sentence(*templates: str) -> re.Pattern:
+    """Ghép các mẫu thành một regex khớp CẢ CÂU (đã chuẩn hóa)."""
+    return re.compile(rf"{_LEAD}(?:{'|'.join(templates)}){_TAIL}")
+
+_TIME = _sentence(
+    r"(?:bay gio|hien tai) (?:la )?may gio",
+    r"may gio",
+    r"(?:gio|thoi gian) hien tai(?: la)?(?: may gio| bao nhieu)?",
+    r"hom nay (?:la )?(?:ngay (?:bao nhieu|may|gi)|thu may)",
+    r"ngay bao nhieu",
+)
+# Các cụm chỉ phạm vi "toàn bộ" được phép đứng sau câu đếm (không phải điều kiện lọc).
+_ALL = r"(?: (?:tat ca|tong cong|hien co|da luu|trong he thong|trong co so du lieu))?"
+_COUNT = _sentence(
+    rf"(?:co )?(?:tat ca |tong cong )?(?:bao nhieu|may)(?: cai| to| cac)? {_INVOICE}{_ALL}",
+    rf"(?:dem|tong so|so luong) (?:cac )?{_INVOICE}{_ALL}(?: (?:la|co) bao nhieu)?",
+    rf"{_INVOICE} (?:co )?(?:tat ca |tong cong )?(?:bao nhieu|may)(?: cai| to)?",
+)
+_HIGHEST = _sentence(
+    rf"(?:cho (?:toi )?xem |tim )?(?:cai )?{_INVOICE} (?:nao )?(?:co )?(?:gia tri |tong tien |so tien )?"
+    rf"(?:cao nhat|lon nhat|dat nhat|nhieu tien nhat)(?: la (?:cai nao|gi|{_INVOICE} nao))?",
+)
+# Đúng MỘT mã hóa đơn (có ít nhất một chữ số); câu nhắc tới hai mã trở lên không khớp mẫu.
+_RECEIPT_TOKEN = r"((?:[a-z0-9][a-z0-9\-/\.]*)?\d[a-z0-9\-/\.]*)"
+# Từ "hóa đơn" thừa (như "số hd 123") chỉ được bỏ qua khi đứng riêng; "HD123", "BILL01" là một phần của mã.
+# Sau từ khóa luôn phải có dấu cách hoặc ":"/"#", để "mã hd123" không bị cắt thành "hd" + "123".
+_RECEIPT_SEP = r"(?: ?[:#] ?| )"
+_RECEIPT = _sentence(
+    rf"(?:(?:tim|tra cuu|xem|cho (?:toi )?xem|thong tin)(?: cua)? )?{_INVOICE} (?:so|ma)(?: {_INVOICE}(?= ))?"
+    rf"{_RECEIPT_SEP}{_RECEIPT_TOKEN}(?: (?:la gi|the nao|o dau))?",
+    rf"(?:ma|so) {_INVOICE}{_RECEIPT_SEP}{_RECEIPT_TOKEN}",
+)
+
+# Biểu thức toán: chỉ gồm số, toán tử, ngoặc, dấu phần trăm, có ít nhất một toán tử.
+_CALC_PREFIX = re.compile(r"^(hay |giup toi |cho toi biet )?(tinh|tinh giup|tinh toan|ket qua cua|ket qua)\s*:?\s*", re.IGNORECASE)
+_CALC_SUFFIX = re.compile(r"\s*(=\s*\??|bang bao nhieu\s*\??|bang may\s*\??|la bao nhieu\s*\??|\?)\s*$")
+_CALC_BODY = re.compile(r"^[\d\s\.,+\-*/x×:^()%]+$")
+_CALC_OPERATOR = re.compile(r"\d\s*[+\-*/x×:^%]")
+# Ngày tháng ("2024-05-01", "01/05/2024") trông giống phép trừ/chia nhưng không phải biểu thức toán.
+_CALC_DATE = re.compile(r"^(?:\d{4}([-/.])\d{1,2}\1\d{1,2}|\d{1,2}([-/.])\d{1,2}\2\d{4})$")
+
+@dataclass
+class Intent:
+    """Ý định đã nhận diện: tên và tham số cho công cụ tương ứng."""
+    name: str
+    args: dict = field(default_factory=dict)
+
+def _extract_expression(message: str) -> Optional[str]:
+    raw = message.strip()
+    norm_prefix = _CALC_PREFIX.match(normalize(raw))
+    if norm_prefix:
+        # Tiền tố không chứa chữ số nên có thể cắt theo số từ trên chuỗi gốc.
+        raw = " ".join(raw.split()[len(norm_prefix.group(0).split()):])
+    raw = _CALC_SUFFIX.sub("", normalize(raw))
+    if raw and _CALC_BODY.match(raw) and _CALC_OPERATOR.search(raw) and not _CALC_DATE.match(raw):
+        return raw.replace("×", "*").replace("x", "*")
+    return None
+
+def route(message: str) -> Optional[Intent]:
+    """
+    Nhận diện ý định của câu hỏi bằng luật. Trả về None nếu câu hỏi cần LLM xử lý.
+    Thứ tự ưu tiên giống quy trình ra quyết định trong system prompt của agent.
+
+    >>> route("Hóa đơn số HD123456").args
+    {'receipt_number': 'HD123456'}
+    >>> route("mã hóa đơn BILL01?").args
+    {'receipt_number': 'BILL01'}
+    >>> route("tra cứu hóa đơn số hóa đơn HD00123").args
+    {'receipt_number': 'HD00123'}
+    >>> route("hoa don ma: PHIEU99").args
+    {'receipt_number': 'PHIEU99'}
+    >>> route("hóa đơn số 001").args
+    {'receipt_number': '001'}
+    >>> route("2024-05-01") is None
+    True
+    >>> route("tính 12 - 5").args
+    {'expression': '12 - 5'}
+    """
+    expression = _extract_expression(message)
+    if expression:
+        return Intent("calculator", {"expression": expression})
+
+    text = _TRAILING_PUNCT.sub("", normalize(message))
+    if _TIME.fullmatch(text):
+        return Intent("time")
+    if _COUNT.fullmatch(text):
+        return Intent("count")
+    if _HIGHEST.fullmatch(text):
+        return Intent("highest_value")
+    receipt = _RECEIPT.fullmatch(text)
+    if receipt:
+        # Lấy lại mã hóa đơn nguyên gốc (giữ chữ hoa) từ câu hỏi của người dùng.
+        token = next(group for group in receipt.groups() if group)
+        original = next((w.strip("?.,!:#") for w in message.split() if normalize(w.strip("?.,!:#")) == token), token)
+        return Intent("receipt_lookup", {"receipt_number": original})
+    return None
+
+# --- IV. TRẢ LỜI THEO MẪU ---
+
+def _format_receipt(result: str, receipt_number: str) -> str:
+    try:
+        invoices = json.loads(result)
+    except ValueError:
+        return result  # Thông báo "không tìm thấy" từ công cụ.
+    lines = [f"Tìm thấy {len(invoices)} hóa đơn mã '{receipt_number}':"]
+    for inv in invoices[:5]:
+        total = parse_amount(inv.get("total_amount"))
+        items = inv.get("items") or []
+        lines.append(
+            f"- {inv.get('store_name') or 'Không rõ cửa hàng'}, ngày {inv.get('receipt_datetime') or 'không rõ'}, "
+            f"{len(items)} sản phẩm, tổng {format_vnd(total) if total is not None else 'không rõ'}, "
+            f"thanh toán: {inv.get('payment_method') or 'không rõ'}."
+        )
+    return "\n".join(lines)
+
+def answer(intent: Intent, get_docs: Callable[[], list]) -> str:
+    """Gọi thẳng hàm công cụ tương ứng với ý định và định dạng câu trả lời theo mẫu."""
+    if intent.name == "calculator":
+        return calculator.func(expression=intent.args["expression"])
+    if intent.name == "time":
+        return get_vietnam_current_time.func()
+    if intent.name in ("count", "highest_value"):
+        return get_invoice_report.func(all_documents=get_docs(), report_type=intent.name)
+    if intent.name == "receipt_lookup":
+        receipt_number = intent.args["receipt_number"]
+        result = filter_invoices.func(all_documents=get_docs(), receipt_number=receipt_number,
+                                      total_amount=None, item_name=None)
+        return _format_receipt(result, receipt_number)
+    raise ValueError(f"Ý định không được hỗ trợ: {intent.name}")
+
+def route_and_answer(message: str, get_docs: Callable[[], list]) -> Optional[str]:
+    """Trả lời ngay nếu câu hỏi đơn giản (không cần LLM); ngược lại trả về None."""
+    intent = route(message)
+    return answer(intent, get_docs) if intent else None
@@ -0,0 +1,375 @@
+# file: invoice_analytics.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import json  # Đọc nội dung JSON của hóa đơn lưu trong Milvus.
+import heapq  # Lấy top-N trong một lượt duyệt mà không cần sắp xếp toàn bộ.
+import re  # Chuẩn hóa chuỗi số tiền và ngày giờ.
+import threading  # Khóa cache bảng: các công cụ của agent chạy song song.
+from dataclasses import dataclass  # Định nghĩa bản ghi hóa đơn có kiểu dữ liệu rõ ràng.
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Sequence
+
+# --- II. HẰNG SỐ CẤU HÌNH ---
+
+# Các chỉ số và chiều nhóm mà công cụ tổng hợp hỗ trợ.
+METRICS = ("count", "sum", "avg", "min", "max", "top")
+GROUP_BYS = ("none", "store", "payment_method", "day", "week", "month")
+
+# Giới hạn số dòng trả về cho LLM. Kết quả luôn có kích thước bị chặn,
+# dù collection có hàng nghìn hóa đơn.
+DEFAULT_TOP_N = 10
+MAX_TOP_N = 50
+
+# Số bảng hóa đơn được giữ trong cache (mỗi bảng ứng với một danh sách tài liệu).
+_TABLE_CACHE_SIZE = 4
+
+# Các định dạng ngày giờ thường gặp trên hóa đơn Việt Nam (ngoài ISO 8601).
+_DATETIME_FORMATS = (
+    "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d/%m/%Y",
+    "%d-%m-%Y %H:%M:%S", "%d-%m-%Y %H:%M", "%d-%m-%Y",
+    "%H:%M:%S %d/%m/%Y", "%H:%M %d/%m/%Y",
+    "%Y/%m/%d %H:%M:%S", "%Y/%m/%d",
+)
+
+# --- III. CHUẨN HÓA DỮ LIỆU ---
+
+def parse_amount(value) -> Optional[float]:
+    """
+    Chuyển một giá trị tiền tệ (số hoặc chuỗi) thành float.
+    Hiểu được định dạng Việt Nam: "1.250.000", "125.000 VND", "12,5".
+    Trả về None nếu không thể chuyển đổi.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    s = re.sub(r"[^\d.,\-]", "", str(value))
+    if not s or s in {"-", ".", ","}:
+        return None
+    if "." in s and "," in s:
+        # Dấu xuất hiện sau cùng là dấu thập phân, dấu còn lại là phân cách hàng nghìn.
+        if s.rfind(",") > s.rfind("."):
+            s = s.replace(".", "").replace(",", ".")
+        else:
+            s = s.replace(",", "")
+    elif "." in s:
+        # "1.250.000" hoặc "125.000" -> phân cách hàng nghìn; "12.5" -> thập phân.
+        if re.fullmatch(r"-?\d{1,3}(\.\d{3})+", s):
+            s = s.replace(".", "")
+    elif "," in s:
+        if re.fullmatch(r"-?\d{1,3}(,\d{3})+", s):
+            s = s.replace(",", "")
+        else:
+            s = s.replace(",", ".")
+    try:
+        return float(s)
+    except ValueError:
+        return None
+
+def parse_datetime(value) -> Optional[datetime]:
+    """
+    Chuyển chuỗi ngày giờ trên hóa đơn thành đối tượng datetime.
+    Ưu tiên ISO 8601 (định dạng mà prompt Gemini yêu cầu), sau đó thử các định dạng phổ biến.
+    """
+    if not value:
+        return None
+    s = str(value).strip()
+    try:
+        return datetime.fromisoformat(s)
+    except ValueError:
+        pass
+    for fmt in _DATETIME_FORMATS:
+        try:
+            return datetime.strptime(s, fmt)
+        except ValueError:
+            continue
+    return None
+
+def parse_date_bound(value: Optional[str], end: bool = False) -> Optional[datetime]:
+    """
+    Chuyển tham số khoảng thời gian ("2024-05", "2024-05-31", "31/05/2024") thành mốc datetime.
+    Với `end=True`, mốc được đẩy tới cuối ngày/tháng để khoảng lọc là khoảng đóng.
+    """
+    if not value:
+        return None
+    s = str(value).strip()
+    month_match = re.fullmatch(r"(\d{4})-(\d{1,2})", s)
+    if month_match:
+        year, month = int(month_match.group(1)), int(month_match.group(2))
+        start = datetime(year, month, 1)
+        if not end:
+            return start
+        next_month = datetime(year + month // 12, month % 12 + 1, 1)
+        return next_month - timedelta(microseconds=1)
+    dt = parse_datetime(s)
+    if dt is None:
+        raise ValueError(f"Không hiểu mốc thời gian '{value}'. Hãy dùng dạng YYYY-MM-DD hoặc YYYY-MM.")
+    if end and dt.time() == datetime.min.time():
+        dt = dt + timedelta(days=1) - timedelta(microseconds=1)
+    return dt
+
+def format_vnd(value: float) -> str:
+    """Định dạng số tiền theo kiểu Việt Nam, ví dụ: 1.200.000 VND."""
+    return f"{value:,.0f} VND".replace(',', '.')
+
+# --- IV. BẢNG HÓA ĐƠN CÓ KIỂU ---
+
+@dataclass(frozen=True)
+class InvoiceRow:
+    """Một hóa đơn đã được chuẩn hóa, chỉ giữ các trường cần cho thống kê."""
+    receipt_number: Optional[str]
+    store_name: Optional[str]
+    payment_method: Optional[str]
+    receipt_datetime: Optional[datetime]
+    total_amount: Optional[float]
+    item_count: int
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "InvoiceRow":
+        items = data.get("items") or []
+        receipt_number = data.get("receipt_number")
+        return cls(
+            receipt_number=str(receipt_number) if receipt_number is not None else None,
+            store_name=(data.get("store_name") or None),
+            payment_method=(data.get("payment_method") or None),
+            receipt_datetime=parse_datetime(data.get("receipt_datetime")),
+            total_amount=parse_amount(data.get("total_amount")),
+            item_count=len(items) if isinstance(items, list) else 0,
+        )
+
+    def group_key(self, group_by: str) -> str:
+        """Trả về khóa nhóm của hóa đơn theo chiều `group_by`."""
+        if group_by == "store":
+            return (self.store_name or "Không rõ").strip()
+        if group_by == "payment_method":
+            return (self.payment_method or "Không rõ").strip()
+        if self.receipt_datetime is None:
+            return "Không rõ ngày"
+        if group_by == "day":
+            return self.receipt_datetime.strftime("%Y-%m-%d")
+        if group_by == "week":
+            year, week, _ = self.receipt_datetime.isocalendar()
+            return f"{year}-W{week:02d}"
+        if group_by == "month":
+            return self.receipt_datetime.strftime("%Y-%m")
+        return "Tất cả"
+
+class _Accumulator:
+    """Bộ cộng dồn cho một nhóm: đủ để tính count/sum/avg/min/max trong một lượt."""
+    __slots__ = ("count", "valued", "total", "minimum", "maximum")
+
+    def __init__(self):
+        self.count = 0
+        self.valued = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, amount: Optional[float]):
+        self.count += 1
+        if amount is None:
+            return
+        self.valued += 1
+        self.total += amount
+        self.minimum = amount if self.minimum is None else min(self.minimum, amount)
+        self.maximum = amount if self.maximum is None else max(self.maximum, amount)
+
+    def value(self, metric: str) -> Optional[float]:
+        if metric == "count":
+            return float(self.count)
+        if metric == "sum":
+            return self.total
+        if metric == "avg":
+            return self.total / self.valued if self.valued else None
+        if metric == "min":
+            return self.minimum
+        if metric == "max":
+            return self.maximum
+        return None
+
+class InvoiceTable:
+    """
+    Bảng hóa đơn đã được parse sẵn (mỗi dòng là một `InvoiceRow`).
+    Việc parse JSON chỉ làm một lần; các truy vấn thống kê sau đó chỉ duyệt bảng một lượt.
+    """
+
+    def __init__(self, rows: Optional[List[InvoiceRow]] = None):
+        self.rows: List[InvoiceRow] = list(rows or [])
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @classmethod
+    def from_documents(cls, documents: Iterable) -> "InvoiceTable":
+        table = cls()
+        table.extend(documents)
+        return table
+
+    def extend(self, documents: Iterable) -> int:
+        """
+        Thêm các tài liệu LangChain (nội dung JSON trong `page_content`) vào bảng.
+        Bỏ qua tài liệu có JSON không hợp lệ. Trả về số dòng đã thêm.
+        """
+        added = 0
+        for doc in documents:
+            try:
+                data = json.loads(doc.page_content)
+            except (TypeError, ValueError, AttributeError):
+                continue
+            if not isinstance(data, dict):
+                continue
+            self.rows.append(InvoiceRow.from_dict(data))
+            added += 1
+        return added
+
+    def aggregate(
+        self,
+        metric: str = "sum",
+        group_by: str = "none",
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+        top_n: int = DEFAULT_TOP_N,
+    ) -> str:
+        """
+        Tính thống kê trên bảng trong MỘT lượt duyệt và trả về bảng văn bản gọn.
+
+        Args:
+            metric (str): 'count', 'sum', 'avg', 'min', 'max' trên `total_amount`,
+                          hoặc 'top' để liệt kê N hóa đơn có giá trị lớn nhất.
+            group_by (str): 'none', 'store', 'payment_method', 'day', 'week', 'month'.
+            date_from, date_to (str): Khoảng thời gian lọc (YYYY-MM-DD hoặc YYYY-MM), có thể bỏ trống.
+            top_n (int): Số dòng tối đa trong kết quả (bị chặn bởi MAX_TOP_N).
+
+        Returns:
+            str: Bảng kết quả có số dòng bị chặn, LLM có thể dùng trực tiếp.
+        """
+        if metric not in METRICS:
+            return f"Chỉ số không hợp lệ '{metric}'. Hãy chọn một trong: {', '.join(METRICS)}."
+        if group_by not in GROUP_BYS:
+            return f"Chiều nhóm không hợp lệ '{group_by}'. Hãy chọn một trong: {', '.join(GROUP_BYS)}."
+        try:
+            start = parse_date_bound(date_from)
+            end = parse_date_bound(date_to, end=True)
+        except ValueError as e:
+            return str(e)
+        top_n = max(1, min(int(top_n or DEFAULT_TOP_N), MAX_TOP_N))
+
+        groups = {}
+        top_heap = []  # Heap kích thước top_n cho metric='top'.
+        matched = 0
+        skipped_no_date = 0
+        for idx, row in enumerate(self.rows):
+            if start or end:
+                if row.receipt_datetime is None:
+                    skipped_no_date += 1
+                    continue
+                if start and row.receipt_datetime < start:
+                    continue
+                if end and row.receipt_datetime > end:
+                    continue
+            matched += 1
+            if metric == "top":
+                if row.total_amount is None:
+                    continue
+                entry = (row.total_amount, -idx, row)
+                if len(top_heap) < top_n:
+                    heapq.heappush(top_heap, entry)
+                elif entry > top_heap[0]:
+                    heapq.heapreplace(top_heap, entry)
+                continue
+            key = row.group_key(group_by)
+            acc = groups.get(key)
+            if acc is None:
+                acc = groups[key] = _Accumulator()
+            acc.add(row.total_amount)
+
+        scope = _describe_scope(date_from, date_to, matched)
+        notes = []
+        if skipped_no_date:
+            notes.append(f"(Bỏ qua {skipped_no_date} hóa đơn không có ngày khi lọc theo thời gian.)")
+        if matched == 0:
+            return "\n".join([scope, "Không có hóa đơn nào trong phạm vi yêu cầu."] + notes)
+
+        if metric == "top":
+            lines = [scope, f"Top {len(top_heap)} hóa đơn có giá trị cao nhất:",
+                     "| # | Mã hóa đơn | Cửa hàng | Ngày | Tổng tiền |", "|---|---|---|---|---|"]
+            for rank, (_, _, row) in enumerate(sorted(top_heap, reverse=True), start=1):
+                day = row.receipt_datetime.strftime("%Y-%m-%d") if row.receipt_datetime else "Không rõ"
+                lines.append(f"| {rank} | {row.receipt_number or 'Không có mã'} | {row.store_name or 'Không rõ'} "
+                             f"| {day} | {format_vnd(row.total_amount)} |")
+            return "\n".join(lines + notes)
+
+        # Các chiều không phải thời gian được sắp theo giá trị giảm dần.
+        # Với chiều thời gian, giữ N mốc gần nhất (theo thứ tự thời gian).
+        ranked = list(groups.items())
+        if group_by in ("day", "week", "month"):
+            ranked.sort(key=lambda kv: kv[0])
+            shown, rest = ranked[-top_n:], ranked[:-top_n]
+        else:
+            ranked.sort(key=lambda kv: (kv[1].value(metric) is None, -(kv[1].value(metric) or 0.0)))
+            shown, rest = ranked[:top_n], ranked[top_n:]
+
+        label = {"count": "Số hóa đơn", "sum": "Tổng tiền", "avg": "Trung bình",
+                 "min": "Nhỏ nhất", "max": "Lớn nhất"}[metric]
+        lines = [scope, f"| Nhóm ({group_by}) | {label} | Số hóa đơn |", "|---|---|---|"]
+        for key, acc in shown:
+            lines.append(f"| {key} | {_format_metric(metric, acc.value(metric))} | {acc.count} |")
+        if rest:
+            merged = _Accumulator()
+            for _, acc in rest:
+                merged.count += acc.count
+                merged.valued += acc.valued
+                merged.total += acc.total
+                for bound in (acc.minimum, acc.maximum):
+                    if bound is not None:
+                        merged.minimum = bound if merged.minimum is None else min(merged.minimum, bound)
+                        merged.maximum = bound if merged.maximum is None else max(merged.maximum, bound)
+            lines.append(f"| Khác ({len(rest)} nhóm) | {_format_metric(metric, merged.value(metric))} | {merged.count} |")
+        return "\n".join(lines + notes)
+
+def _format_metric(metric: str, value: Optional[float]) -> str:
+    if value is None:
+        return "Không rõ"
+    if metric == "count":
+        return str(int(value))
+    return format_vnd(value)
+
+def _describe_scope(date_from: Optional[str], date_to: Optional[str], matched: int) -> str:
+    if date_from or date_to:
+        return f"Phạm vi: {date_from or '...'} → {date_to or '...'} ({matched} hóa đơn)."
+    return f"Phạm vi: toàn bộ ({matched} hóa đơn)."
+
+# --- V. CACHE BẢNG THEO DANH SÁCH TÀI LIỆU ---
+
+# Lưu bộ (danh sách tài liệu, số tài liệu, bảng). Giữ tham chiếu tới danh sách để `id()` không bị tái sử dụng.
+# Các công cụ chạy song song (tool_runtime) cùng đọc cache, nên mọi thao tác trên cache đều giữ khóa,
+# và bảng đã trả ra không bao giờ bị sửa: phần tài liệu mới được thêm vào một bảng MỚI.
+_table_cache: List[tuple] = []
+_table_cache_lock = threading.Lock()
+
+def _extends(documents: Sequence, docs: Sequence, size: int) -> bool:
+    """`documents` là `docs` (kích thước `size`) được nối thêm, ví dụ hai phiên bản liên tiếp của snapshot hóa đơn."""
+    if documents is docs:
+        return len(documents) >= size
+    return 0 < size <= len(documents) and documents[0] is docs[0] and documents[size - 1] is docs[size - 1]
+
+def get_invoice_table(documents: Sequence) -> InvoiceTable:
+    """
+    Trả về bảng hóa đơn đã parse cho danh sách tài liệu, dùng lại bảng cũ nếu đã có.
+    Nhờ vậy các lần gọi công cụ liên tiếp trong cùng một agent không phải parse lại JSON.
+    Nếu danh sách chỉ được nối thêm (ví dụ: snapshot hóa đơn cập nhật tăng dần),
+    chỉ phần tài liệu mới được parse; bảng mới dùng lại các dòng đã parse của bảng cũ.
+    """
+    with _table_cache_lock:
+        for i, (docs, size, table) in enumerate(_table_cache):
+            if not _extends(documents, docs, size):
+                continue
+            if len(documents) > size:
+                table = InvoiceTable(table.rows)  # Sao chép danh sách dòng: bảng cũ có thể đang được luồng khác đọc.
+                table.extend(documents[size:])
+                _table_cache[i] = (documents, len(documents), table)
+            return table
+        table = InvoiceTable.from_documents(documents)
+        _table_cache.insert(0, (documents, len(documents), table))
+        del _table_cache[_TABLE_CACHE_SIZE:]
+        return table
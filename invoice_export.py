@@ -0,0 +1,310 @@
+# file: invoice_export.py
+#
+# Xuất hóa đơn trong Milvus ra bảng cho phân tích (không cần đi qua chatbot hay Attu):
+#   python invoice_export.py --format parquet --out exports/invoices
+#   python invoice_export.py --format csv --incremental        # chỉ các hóa đơn mới từ lần xuất trước
+#   python invoice_export.py --format ndjson --table items --since-date 2024-05-01 --out -
+#
+# Hai bảng: "invoices" (mỗi hóa đơn một dòng) và "items" (mỗi sản phẩm một dòng, trải phẳng từ mảng `items`).
+# Dữ liệu được đọc bằng query_iterator theo từng trang và ghi ngay ra luồng, nên bộ nhớ không tăng theo
+# số hóa đơn. Cũng được dùng bởi các endpoint GET /export/{table}.{format} trong main.py.
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os
+import io
+import sys
+import csv
+import json
+import argparse
+import tempfile
+from datetime import datetime
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from invoice_analytics import parse_amount, parse_datetime, parse_date_bound  # Chuẩn hóa số tiền và ngày giờ.
+from receipt_parser import STRING_FIELDS, AMOUNT_FIELDS, parse_quantity  # Lược đồ hóa đơn của prompt Gemini.
+
+# --- II. CẤU HÌNH VÀ LƯỢC ĐỒ BẢNG ---
+
+# Số bản ghi mỗi trang khi đọc từ Milvus (cũng là số dòng mỗi row group Parquet).
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+# Nơi lưu khóa chính lớn nhất đã xuất, cho chế độ --incremental.
+EXPORT_STATE_DIR = os.path.join(os.getenv("INVOICE_STATE_DIR", ".invoice_state"), "export")
+
+FORMATS = ("ndjson", "csv", "parquet")
+TABLES = ("invoices", "items")
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8",
+               "parquet": "application/vnd.apache.parquet"}
+
+# Kiểu cột: "int64", "float64", "string", "timestamp" (ngày giờ không múi giờ, như trên hóa đơn).
+INVOICE_COLUMNS: List[Tuple[str, str]] = (
+    [("id", "int64"), ("filename", "string")]
+    + [(name, "timestamp" if name == "receipt_datetime" else "string") for name in STRING_FIELDS]
+    + [(name, "float64") for name in AMOUNT_FIELDS]
+    + [("item_count", "int64")]
+)
+ITEM_COLUMNS: List[Tuple[str, str]] = [
+    ("invoice_id", "int64"), ("line_no", "int64"), ("receipt_number", "string"), ("receipt_datetime", "timestamp"),
+    ("store_name", "string"), ("name", "string"), ("quantity", "float64"), ("unit_price", "float64"),
+    ("total_price", "float64"),
+]
+COLUMNS = {"invoices": INVOICE_COLUMNS, "items": ITEM_COLUMNS}
+
+# --- III. ĐỌC VÀ TRẢI PHẲNG HÓA ĐƠN ---
+
+def _text(value) -> Optional[str]:
+    if value is None or value == "":
+        return None
+    return value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+
+def flatten_invoice(row_id: int, filename: str, data: dict) -> Tuple[dict, List[dict]]:
+    """Một bản ghi Milvus -> (dòng của bảng invoices, các dòng của bảng items), đã chuẩn hóa kiểu."""
+    dt = parse_datetime(data.get("receipt_datetime"))
+    items = data.get("items") if isinstance(data.get("items"), list) else []
+    invoice = {"id": row_id, "filename": filename}
+    for name in STRING_FIELDS:
+        invoice[name] = dt if name == "receipt_datetime" else _text(data.get(name))
+    for name in AMOUNT_FIELDS:
+        invoice[name] = parse_amount(data.get(name))
+    invoice["item_count"] = len(items)
+
+    lines = []
+    for line_no, item in enumerate(items, start=1):
+        item = item if isinstance(item, dict) else {"name": item}
+        quantity = parse_quantity(item.get("quantity")) if item.get("quantity") not in (None, "") else None
+        lines.append({
+            "invoice_id": row_id, "line_no": line_no, "receipt_number": invoice["receipt_number"],
+            "receipt_datetime": dt, "store_name": invoice["store_name"], "name": _text(item.get("name")),
+            "quantity": float(quantity) if quantity is not None else None,
+            "unit_price": parse_amount(item.get("unit_price")), "total_price": parse_amount(item.get("total_price")),
+        })
+    return invoice, lines
+
+def iter_batches(collection_name: str, since_id: Optional[int] = None, since_date: Optional[str] = None,
+                 batch_size: int = EXPORT_BATCH_SIZE, db_name: str = "default") -> Iterator[Tuple[List[dict], List[dict]]]:
+    """
+    Đọc collection theo từng trang bằng query_iterator, trả về (các hóa đơn, các dòng sản phẩm) cho mỗi trang.
+
+    Args:
+        since_id (int, optional): Chỉ lấy bản ghi có khóa chính lớn hơn (auto_id tăng theo thời gian chèn).
+        since_date (str, optional): Chỉ lấy hóa đơn có ngày giờ trên hóa đơn từ mốc này ("2024-05", "2024-05-01").
+            Ngày giờ nằm trong JSON nên được lọc sau khi đọc; hóa đơn không có ngày giờ bị loại.
+    """
+    from pymilvus import Collection  # Import lười: phần chuyển đổi/ghi dùng được mà không cần pymilvus.
+    from milvus_connection import get_connection_manager
+
+    date_from = parse_date_bound(since_date) if since_date else None
+    coll = Collection(collection_name, using=get_connection_manager().get(db_name))
+    iterator = coll.query_iterator(
+        batch_size=batch_size,
+        expr=f"id > {since_id if since_id is not None else -1}",
+        output_fields=["id", "filename", "content"],
+        consistency_level="Strong",
+    )
+    try:
+        while rows := iterator.next():
+            invoices, items = [], []
+            for row in rows:
+                try:
+                    data = json.loads(row["content"])
+                except ValueError:
+                    data = {}
+                invoice, lines = flatten_invoice(int(row["id"]), row["filename"], data if isinstance(data, dict) else {})
+                if date_from and (invoice["receipt_datetime"] is None or invoice["receipt_datetime"] < date_from):
+                    continue
+                invoices.append(invoice)
+                items.extend(lines)
+            yield invoices, items
+    finally:
+        iterator.close()
+
+# --- IV. BỘ GHI THEO ĐỊNH DẠNG ---
+# Mỗi bộ ghi nhận từng lô dòng và trả về các byte cần đẩy ra ngay (cho HTTP streaming hoặc file).
+
+def _cell(value, kind: str):
+    if value is None:
+        return None
+    if kind == "timestamp":
+        return value.isoformat(sep=" ") if isinstance(value, datetime) else value
+    return value
+
+class NdjsonWriter:
+    def __init__(self, columns: List[Tuple[str, str]]):
+        self.columns = columns
+
+    def header(self) -> bytes:
+        return b""
+
+    def write(self, rows: List[dict]) -> bytes:
+        return "".join(json.dumps({name: _cell(row[name], kind) for name, kind in self.columns}, ensure_ascii=False) + "\n"
+                       for row in rows).encode("utf-8")
+
+    def close(self) -> bytes:
+        return b""
+
+class CsvWriter:
+    """CSV có dòng tiêu đề; số thực không có dấu phân cách hàng nghìn, ngày giờ dạng ISO, rỗng là NULL."""
+
+    def __init__(self, columns: List[Tuple[str, str]]):
+        self.columns = columns
+
+    def _render(self, rows) -> bytes:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerows(rows)
+        return buffer.getvalue().encode("utf-8")
+
+    def header(self) -> bytes:
+        # BOM để Excel nhận đúng UTF-8 (tiếng Việt).
+        return "\ufeff".encode("utf-8") + self._render([[name for name, _ in self.columns]])
+
+    def write(self, rows: List[dict]) -> bytes:
+        return self._render([["" if (v := _cell(row[name], kind)) is None else
+                              (repr(v) if kind == "float64" else v) for name, kind in self.columns] for row in rows])
+
+    def close(self) -> bytes:
+        return b""
+
+class _ChunkSink(io.RawIOBase):
+    """Đích ghi chỉ nối: gom byte do pyarrow ghi ra để trả về theo từng lô."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+class ParquetWriter:
+    """Parquet với kiểu cột rõ ràng; mỗi lô là một row group. Cần pyarrow (`pip install pyarrow`)."""
+
+    def __init__(self, columns: List[Tuple[str, str]]):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise RuntimeError("Xuất Parquet cần thư viện pyarrow: pip install pyarrow") from e
+        types = {"int64": pa.int64(), "float64": pa.float64(), "string": pa.string(), "timestamp": pa.timestamp("s")}
+        self._pa = pa
+        self.columns = columns
+        self.schema = pa.schema([(name, types[kind]) for name, kind in columns])
+        self._sink = _ChunkSink()
+        self._writer = pq.ParquetWriter(self._sink, self.schema, compression="zstd")
+
+    def header(self) -> bytes:
+        return self._sink.drain()
+
+    def write(self, rows: List[dict]) -> bytes:
+        if rows:
+            columns = {name: [row[name] for row in rows] for name, _ in self.columns}
+            self._writer.write_table(self._pa.Table.from_pydict(columns, schema=self.schema))
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        self._writer.close()
+        return self._sink.drain()
+
+WRITERS: Dict[str, Callable] = {"ndjson": NdjsonWriter, "csv": CsvWriter, "parquet": ParquetWriter}
+
+# --- V. LUỒNG XUẤT ---
+
+def export_stream(collection_name: str, table: str = "invoices", fmt: str = "ndjson",
+                  since_id: Optional[int] = None, since_date: Optional[str] = None,
+                  batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[bytes]:
+    """Luồng byte của một bảng ở một định dạng (dùng cho StreamingResponse của FastAPI)."""
+    if table not in TABLES or fmt not in FORMATS:
+        raise ValueError(f"Bảng phải thuộc {TABLES}, định dạng phải thuộc {FORMATS}.")
+    if since_date:
+        parse_date_bound(since_date)  # Báo lỗi mốc thời gian ngay, trước khi gửi byte nào.
+    writer = WRITERS[fmt](COLUMNS[table])  # Lỗi thiếu pyarrow cũng vậy.
+
+    def generate():
+        yield writer.header()
+        for invoices, items in iter_batches(collection_name, since_id, since_date, batch_size):
+            if chunk := writer.write(invoices if table == "invoices" else items):
+                yield chunk
+        yield writer.close()
+    return generate()
+
+def _state_path(collection_name: str) -> str:
+    return os.path.join(EXPORT_STATE_DIR, f"{collection_name}.json")
+
+def load_last_id(collection_name: str) -> Optional[int]:
+    try:
+        with open(_state_path(collection_name), encoding="utf-8") as f:
+            return int(json.load(f)["max_id"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_last_id(collection_name: str, max_id: int):
+    os.makedirs(EXPORT_STATE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=EXPORT_STATE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump({"max_id": max_id, "exported_at": datetime.now().isoformat(timespec="seconds")}, f)
+    os.replace(tmp, _state_path(collection_name))
+
+def main():
+    parser = argparse.ArgumentParser(description="Xuất hóa đơn và dòng sản phẩm từ Milvus ra NDJSON / CSV / Parquet")
+    parser.add_argument("--collection", default="invoice_collection")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--table", choices=TABLES + ("both",), default="both")
+    parser.add_argument("--out", default="exports/invoices",
+                        help="Tiền tố file đầu ra (thêm _<bảng>.<định dạng>), hoặc '-' để ghi ra stdout (một bảng)")
+    parser.add_argument("--since-id", type=int, default=None, help="Chỉ xuất bản ghi có khóa chính lớn hơn")
+    parser.add_argument("--since-date", default=None, help="Chỉ xuất hóa đơn từ ngày này (YYYY-MM-DD hoặc YYYY-MM)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Tiếp tục từ khóa chính lớn nhất của lần xuất --incremental trước")
+    parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    tables = TABLES if args.table == "both" else (args.table,)
+    if args.out == "-" and len(tables) > 1:
+        parser.error("Ghi ra stdout chỉ hỗ trợ một bảng (--table invoices hoặc --table items).")
+    since_id = args.since_id
+    if args.incremental and since_id is None:
+        since_id = load_last_id(args.collection)
+
+    # Một lượt đọc Milvus ghi đồng thời cả hai bảng.
+    writers = {table: WRITERS[args.format](COLUMNS[table]) for table in tables}
+    if args.out == "-":
+        outputs = {tables[0]: sys.stdout.buffer}
+    else:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        outputs = {table: open(f"{args.out}_{table}.{args.format}", "wb") for table in tables}
+    counts = {table: 0 for table in tables}
+    max_id = since_id
+    try:
+        for table in tables:
+            outputs[table].write(writers[table].header())
+        for invoices, items in iter_batches(args.collection, since_id, args.since_date, args.batch_size):
+            rows = {"invoices": invoices, "items": items}
+            for table in tables:
+                outputs[table].write(writers[table].write(rows[table]))
+                counts[table] += len(rows[table])
+            if invoices:
+                max_id = max(max_id if max_id is not None else -1, max(inv["id"] for inv in invoices))
+        for table in tables:
+            outputs[table].write(writers[table].close())
+    finally:
+        if args.out != "-":
+            for f in outputs.values():
+                f.close()
+
+    if args.incremental and max_id is not None:
+        save_last_id(args.collection, max_id)
+    summary = ", ".join(f"{table}: {count} dòng" for table, count in counts.items())
+    print(f"✅ Đã xuất {summary} (khóa chính lớn nhất: {max_id})", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
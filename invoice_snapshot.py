@@ -0,0 +1,120 @@
+# file: invoice_snapshot.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os
+import time
+import logging
+import threading  # Nhiều session Streamlit có thể cùng gọi refresh.
+from typing import List, Tuple
+
+from pymilvus import Collection  # Đọc trực tiếp các bản ghi mới từ Milvus.
+from langchain_core.documents import Document  # Định dạng tài liệu mà các công cụ hóa đơn đang dùng.
+
+import collection_events  # Thông báo thay đổi từ /save_milvus (qua file phiên bản).
+from milvus_connection import get_connection_manager
+
+logger = logging.getLogger(__name__)
+
+# --- II. CẤU HÌNH ---
+
+# Sau khoảng thời gian này (giây), snapshot sẽ hỏi Milvus có bản ghi mới không,
+# kể cả khi không nhận được thông báo thay đổi (ví dụ: dữ liệu được chèn bởi công cụ khác).
+SNAPSHOT_TTL_S = float(os.getenv("INVOICE_SNAPSHOT_TTL", "30"))
+# Số bản ghi mỗi trang khi đọc các bản ghi mới.
+SNAPSHOT_BATCH_SIZE = int(os.getenv("INVOICE_SNAPSHOT_BATCH_SIZE", "1000"))
+
+# --- III. SNAPSHOT HÓA ĐƠN CẬP NHẬT TĂNG DẦN ---
+
+class InvoiceSnapshot:
+    """
+    Bản sao danh sách hóa đơn của một collection, được cập nhật TĂNG DẦN.
+    - Ghi nhớ khóa chính (id) lớn nhất đã đọc; mỗi lần làm mới chỉ kéo các bản ghi có id lớn hơn.
+      (Milvus cấp auto_id tăng dần theo thời gian chèn.)
+    - Chỉ làm mới khi có thông báo thay đổi từ /save_milvus hoặc khi đã quá TTL.
+    - `documents()` trả về một tuple bất biến cho mỗi phiên bản dữ liệu: luồng khác làm mới snapshot
+      cũng không đổi danh sách mà một công cụ đang duyệt. Phiên bản sau chỉ nối thêm vào phiên bản trước,
+      nên các bảng thống kê dựng trên nó (xem `invoice_analytics.get_invoice_table`) chỉ cần parse phần mới.
+    """
+
+    def __init__(self, collection_name: str, db_name: str = "default", ttl: float = SNAPSHOT_TTL_S,
+                 batch_size: int = SNAPSHOT_BATCH_SIZE):
+        self.collection_name = collection_name
+        self.db_name = db_name
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._docs: List[Document] = []
+        self._frozen: Tuple[Document, ...] = ()  # Bản bất biến của `_docs` ở phiên bản hiện tại.
+        self.max_id = -1
+        self._epoch = None
+        self._version = None
+        self._last_refresh = float("-inf")
+
+    def documents(self) -> Tuple[Document, ...]:
+        """Trả về danh sách hóa đơn (tuple bất biến), làm mới trước nếu dữ liệu có thể đã cũ."""
+        self.refresh()
+        with self._lock:
+            return self._frozen
+
+    def state_key(self) -> tuple:
+        """
+        Khóa trạng thái dữ liệu hiện tại (làm mới trước nếu cần). Hai lần gọi trả về cùng khóa
+        nghĩa là danh sách hóa đơn không đổi, nên kết quả của các công cụ thuần túy vẫn dùng lại được.
+        """
+        self.refresh()
+        with self._lock:
+            return self.collection_name, self._epoch, self.max_id, len(self._frozen)
+
+    def refresh(self, force: bool = False) -> int:
+        """
+        Kéo các bản ghi mới (id > max_id) từ Milvus nếu cần.
+
+        Args:
+            force (bool): Bỏ qua TTL và thông báo thay đổi, luôn hỏi Milvus.
+
+        Returns:
+            int: Số hóa đơn mới được thêm vào snapshot.
+        """
+        epoch, version = collection_events.get_version(self.collection_name)
+        with self._lock:
+            if self._epoch is not None and epoch != self._epoch:
+                # Collection đã bị xóa và tạo lại: bỏ toàn bộ dữ liệu cũ, dùng danh sách mới.
+                logger.info(f"Collection '{self.collection_name}' đã được tạo lại, tải lại snapshot từ đầu.")
+                self._reset()
+            fresh = (time.monotonic() - self._last_refresh) < self.ttl
+            if not force and fresh and version == self._version:
+                return 0
+            added = self._pull_new_rows()
+            if added or len(self._frozen) != len(self._docs):
+                self._frozen = tuple(self._docs)
+            self._epoch, self._version = epoch, version
+            self._last_refresh = time.monotonic()
+            return added
+
+    def _pull_new_rows(self) -> int:
+        alias = get_connection_manager().get(self.db_name)
+        coll = Collection(self.collection_name, using=alias)
+        iterator = coll.query_iterator(
+            batch_size=self.batch_size,
+            expr=f"id > {self.max_id}",
+            output_fields=["id", "content"],
+            consistency_level="Strong",  # Thấy ngay các bản ghi vừa được flush bởi /save_milvus.
+        )
+        added = 0
+        try:
+            while True:
+                rows = iterator.next()
+                if not rows:
+                    break
+                for row in rows:
+                    self._docs.append(Document(page_content=row["content"], metadata={"id": row["id"]}))
+                    self.max_id = max(self.max_id, int(row["id"]))
+                added += len(rows)
+        finally:
+            iterator.close()
+        if added:
+            logger.info(f"Snapshot '{self.collection_name}': +{added} hóa đơn mới (tổng {len(self._docs)}).")
+        return added
@@ -0,0 +1,107 @@
+# file: invoice_store.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import json
+from typing import List, Sequence
+
+from pymilvus import FieldSchema, CollectionSchema, DataType, Collection, utility
+
+import embed_model  # Số chiều embedding và cấu hình index mặc định.
+import milvus_index  # Cấu hình index vector (loại index, metric, tham số build/search).
+import collection_events  # Thông báo thay đổi dữ liệu cho ứng dụng chat (snapshot hóa đơn).
+from embedding_service import get_embedding_service  # Dịch vụ embedding dùng chung (gom batch động).
+from milvus_connection import get_connection_manager  # Bộ quản lý kết nối Milvus dùng chung.
+from lexical_index import get_lexical_index  # Chỉ mục BM25 cho tìm kiếm lai.
+
+# --- II. CẤU HÌNH ---
+
+# Tên của collection chứa hóa đơn trong Milvus.
+COLLECTION_NAME = "invoice_collection"
+
+# --- III. TẠO COLLECTION ---
+# Dùng chung cho ứng dụng FastAPI (main.py) và công cụ nạp hàng loạt (ingest.py).
+
+def build_schema() -> CollectionSchema:
+    """Cấu trúc (schema) của collection hóa đơn."""
+    fields = [
+        # Trường ID: Khóa chính, kiểu số nguyên, tự động tăng.
+        FieldSchema("id", dtype=DataType.INT64, is_primary=True, auto_id=True),
+        # Trường filename: Lưu tên file gốc, kiểu chuỗi, giới hạn 512 ký tự.
+        FieldSchema("filename", dtype=DataType.VARCHAR, max_length=512),
+        # Trường content: Lưu toàn bộ nội dung JSON của hóa đơn dưới dạng chuỗi.
+        # max_length lớn để chứa được các hóa đơn phức tạp.
+        FieldSchema("content", dtype=DataType.VARCHAR, max_length=65_535),
+        # Trường embedding: Lưu vector embedding của nội dung hóa đơn.
+        # `dim` (số chiều) PHẢI khớp với số chiều của model embedding.
+        FieldSchema("embedding", dtype=DataType.FLOAT_VECTOR, dim=embed_model.get_embedding_dim())
+    ]
+    return CollectionSchema(fields, description="Hóa đơn đã được OCR và vector hóa")
+
+def ensure_collection(name: str = COLLECTION_NAME, drop_existing: bool = False, db_name: str = "default") -> Collection:
+    """
+    Trả về collection hóa đơn đã được tải vào bộ nhớ, tạo mới (kèm index) nếu chưa có.
+
+    Args:
+        name (str): Tên collection.
+        drop_existing (bool): Xóa collection cũ và tạo lại từ đầu (hành vi khi khởi động ứng dụng web).
+            Để False khi nạp hàng loạt, để không mất dữ liệu đã có.
+        db_name (str): Database Milvus.
+    """
+    # Lấy kết nối dùng chung từ bộ quản lý (tự kết nối lại với backoff nếu server chưa sẵn sàng).
+    alias = get_connection_manager().get(db_name)
+    exists = utility.has_collection(name, using=alias)
+    if exists and drop_existing:
+        utility.drop_collection(name, using=alias)
+        exists = False
+    if exists:
+        coll = Collection(name, using=alias)
+        coll.load()
+        return coll
+
+    # Tạo collection trong Milvus với tên và schema đã cho.
+    coll = Collection(name=name, schema=build_schema(), using=alias)
+    # Tạo chỉ mục (index) cho trường embedding để tăng tốc độ tìm kiếm.
+    # Mặc định theo cấu hình embedding hiện tại (IVF_SQ8 + COSINE cho vector gốc,
+    # IVF_FLAT + IP cho vector đã giảm chiều), có thể ghi đè bằng biến môi trường MILVUS_INDEX_*.
+    index_settings = milvus_index.IndexSettings.from_env(defaults=embed_model.get_index_profile())
+    milvus_index.create_index(coll, index_settings)
+    # Tải collection vào bộ nhớ để sẵn sàng cho việc tìm kiếm và chèn dữ liệu.
+    coll.load()
+    # Báo cho các snapshot hóa đơn (ứng dụng chat) rằng collection vừa được tạo lại.
+    collection_events.reset_collection(name)
+    return coll
+
+# --- IV. CHÈN HÓA ĐƠN ---
+
+def insert_invoices(coll: Collection, filenames: Sequence[str], invoices: Sequence[dict]) -> List[int]:
+    """
+    Tạo embedding cho một lô hóa đơn, chèn vào Milvus và thông báo cho ứng dụng chat.
+
+    Returns:
+        List[int]: ID của các bản ghi vừa được chèn.
+    """
+    if not invoices:
+        return []
+    # Chuyển đổi dict JSON thành chuỗi (`ensure_ascii=False` để giữ ký tự tiếng Việt);
+    # dùng chính chuỗi này để tạo embedding.
+    contents = [json.dumps(inv, ensure_ascii=False) for inv in invoices]
+    # 1. Tạo embeddings cho tất cả các văn bản cùng một lúc (mảng float32, chèn trực tiếp vào Milvus).
+    embs = get_embedding_service().embed(contents)
+    # 2. Chèn dữ liệu (filename, content, embedding) vào Milvus.
+    mr = coll.insert([list(filenames), contents, embs])
+    # 3. Flush collection để đảm bảo dữ liệu được ghi và có thể tìm kiếm ngay lập tức.
+    coll.flush()
+    ids = [int(pk) for pk in mr.primary_keys]
+    # 4. Đánh chỉ mục BM25 (tìm mã hóa đơn, số điện thoại, số tiền chính xác) trước khi báo cho ứng dụng chat.
+    get_lexical_index(coll.name).add_many(ids, contents)
+    # 5. Thông báo cho ứng dụng chat: snapshot hóa đơn sẽ kéo các bản ghi mới ở lần truy vấn tiếp theo.
+    collection_events.bump_version(coll.name)
+    return ids
+
+def existing_filenames(coll: Collection, filenames: Sequence[str]) -> set:
+    """Các filename trong danh sách đã có trong collection (để việc nạp lại không tạo bản ghi trùng)."""
+    if not filenames:
+        return set()
+    rows = coll.query(expr=f"filename in {json.dumps(list(filenames), ensure_ascii=False)}",
+                      output_fields=["filename"], consistency_level="Strong")
+    return {row["filename"] for row in rows}
@@ -0,0 +1,244 @@
+# file: lexical_index.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os
+import re
+import json
+import math
+import heapq  # Lấy top-k điểm BM25 mà không sắp xếp toàn bộ.
+import logging
+import threading
+import unicodedata  # Bỏ dấu tiếng Việt để "Bách Hóa" và "bach hoa" là cùng một từ.
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import collection_events  # Epoch của collection: collection bị tạo lại thì chỉ mục cũng mất hiệu lực.
+
+logger = logging.getLogger(__name__)
+
+# --- II. CẤU HÌNH ---
+# Embedding của cả khối JSON hóa đơn gần như "không thấy" các token chính xác như mã hóa đơn,
+# số điện thoại hay số tiền "125.000". Chỉ mục từ vựng (BM25) bổ sung cho tìm kiếm vector:
+# được cập nhật ngay khi chèn (invoice_store.insert_invoices), lưu trên đĩa, và được kết hợp với
+# kết quả vector bằng Reciprocal Rank Fusion (xem hybrid_retriever).
+
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+LEXICAL_STATE_DIR = os.path.join(os.getenv("INVOICE_STATE_DIR", ".invoice_state"), "lexical")
+# Phiên bản cách tách từ; file chỉ mục ghi bằng phiên bản khác bị làm mới (và được bổ sung lại từ Milvus).
+TOKENIZER_VERSION = 2
+
+# --- III. TÁCH TỪ ---
+
+# Số điện thoại Việt Nam viết tách nhóm: "0901 234 567", "090.123.4567", "+84 901 234 567".
+_PHONE = re.compile(r"(?<![\d])(?:\+?84[\s.\-]?|0)\d{2,3}(?:[\s.\-]\d{3,4}){2}(?![\d])")
+# Số tiền có phân cách hàng nghìn: "125.000", "1,250,000", "1 250 000" (không nhầm "0.125" là hàng nghìn).
+# Khoảng trắng được coi là dấu phân cách, nên các giá trị khác nhau phải được ngăn bằng " | " (xem invoice_text).
+_THOUSANDS = re.compile(r"(?<![\d.,])(?!0[.,])\d{1,3}(?:[.,\s]\d{3})+(?![.,]?\d)")
+# Số thực có phần thập phân bằng 0 trong JSON: "125000.0" -> "125000".
+_TRAILING_ZEROS = re.compile(r"(?<![\d.])(\d+)\.0+(?![\d])")
+_CHUNK_SPLIT = re.compile(r"[\s\"'{}\[\]():;,|]+")
+_PART = re.compile(r"[a-z]+|\d+")
+
+def _fold(text: str) -> str:
+    """Chữ thường, bỏ dấu tiếng Việt (kể cả 'đ' -> 'd')."""
+    text = unicodedata.normalize("NFD", text.lower()).replace("đ", "d")
+    return "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+
+def _phone_digits(raw: str) -> str:
+    """Bỏ dấu cách/chấm/gạch của số điện thoại; đầu số quốc tế +84 đưa về 0."""
+    digits = re.sub(r"\D", "", raw)
+    return "0" + digits[2:] if digits.startswith("84") else digits
+
+def tokenize(text: str) -> List[str]:
+    """
+    Tách từ cho cả văn bản hóa đơn và câu truy vấn, chuẩn hóa để các cách viết khác nhau trùng token:
+    - "125.000", "125,000", "125000.0", "125.000đ" -> "125000".
+    - "0901 234 567" -> "0901234567".
+    - Mã ghép "HD-00123" -> "hd", "00123" và cả "hd00123".
+    """
+    s = _fold(text)
+    s = _PHONE.sub(lambda m: _phone_digits(m.group(0)), s)
+    s = _THOUSANDS.sub(lambda m: re.sub(r"[.,\s]", "", m.group(0)), s)
+    s = _TRAILING_ZEROS.sub(r"\1", s)
+    tokens = []
+    for chunk in _CHUNK_SPLIT.split(s):
+        parts = _PART.findall(chunk)
+        tokens.extend(parts)
+        if len(parts) > 1:
+            tokens.append("".join(parts))
+    return tokens
+
+def invoice_text(content: str) -> str:
+    """
+    Chỉ lấy GIÁ TRỊ của JSON hóa đơn (tên trường giống nhau ở mọi hóa đơn nên không giúp phân biệt).
+    Các giá trị được ngăn bằng " | " để hai số đứng cạnh nhau không bị ghép thành một số hàng nghìn:
+
+    >>> tokenize(invoice_text('{"quantity": 3, "unit_price": 500}'))
+    ['3', '500']
+    >>> tokenize(invoice_text('{"total_amount": "125.000", "paid_amount": "250.000"}'))
+    ['125000', '250000']
+    >>> tokenize(invoice_text('{"items": [{"quantity": 2.0, "total_price": 125000.0}], "phone": "0901 234 567"}'))
+    ['2', '125000', '0901234567']
+    """
+    try:
+        data = json.loads(content)
+    except (TypeError, ValueError):
+        return content or ""
+    values = []
+
+    def walk(node):
+        if isinstance(node, dict):
+            for value in node.values():
+                walk(value)
+        elif isinstance(node, list):
+            for value in node:
+                walk(value)
+        elif node is not None and not isinstance(node, bool):
+            values.append(str(int(node)) if isinstance(node, float) and node.is_integer() else str(node))
+
+    walk(data)
+    return " | ".join(values)
+
+# --- IV. CHỈ MỤC BM25 ---
+
+class LexicalIndex:
+    """
+    Chỉ mục đảo (inverted index) BM25 của một collection.
+
+    Lưu dạng JSONL chỉ ghi nối trong .invoice_state/lexical/<collection>.jsonl (dòng đầu là epoch của collection
+    và phiên bản cách tách từ), mỗi dòng là tần suất từ của một hóa đơn. Process ghi (FastAPI, ingest.py) và process đọc (ứng dụng chat)
+    dùng chung file; mỗi lần tìm kiếm đọc thêm các dòng mới. Collection bị tạo lại thì chỉ mục làm mới từ đầu.
+    """
+
+    def __init__(self, collection_name: str, path: Optional[str] = None):
+        self.collection_name = collection_name
+        self.path = path or os.path.join(LEXICAL_STATE_DIR, f"{collection_name}.jsonl")
+        self._lock = threading.Lock()
+        self._epoch = None
+        self._offset = 0
+        self._clear()
+
+    def _clear(self):
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._doc_len: Dict[int, int] = {}
+        self._total_len = 0
+        self.max_id = -1
+
+    # -- Đồng bộ với file --
+
+    def _reset(self, epoch: int):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"epoch": epoch, "tokenizer": TOKENIZER_VERSION}) + "\n")
+        self._epoch, self._offset = epoch, 0
+        self._clear()
+
+    def _sync(self):
+        epoch = collection_events.get_version(self.collection_name)[0]
+        if epoch != self._epoch:
+            self._epoch, self._offset = None, 0
+            self._clear()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                if self._offset == 0:
+                    header = json.loads(f.readline() or "{}")
+                    if header.get("epoch") != epoch or header.get("tokenizer") != TOKENIZER_VERSION:
+                        raise FileNotFoundError
+                    self._epoch = epoch
+                else:
+                    f.seek(self._offset)
+                while line := f.readline():
+                    if not line.endswith("\n"):
+                        break  # Dòng đang được process khác ghi dở: đọc lại ở lần sau.
+                    record = json.loads(line)
+                    self._apply(int(record["id"]), record["tf"])
+                self._offset = f.tell()
+        except (FileNotFoundError, ValueError):
+            self._reset(epoch)
+
+    def _apply(self, doc_id: int, tf: Dict[str, int]):
+        if doc_id in self._doc_len:
+            return
+        length = sum(tf.values())
+        self._doc_len[doc_id] = length
+        self._total_len += length
+        self.max_id = max(self.max_id, doc_id)
+        for term, count in tf.items():
+            self._postings.setdefault(term, {})[doc_id] = count
+
+    # -- Ghi --
+
+    def add_many(self, ids: Sequence[int], contents: Sequence[str]):
+        """Đánh chỉ mục các hóa đơn vừa được chèn (nội dung JSON như trong trường `content`)."""
+        records = [{"id": int(doc_id), "tf": dict(Counter(tokenize(invoice_text(content))))}
+                   for doc_id, content in zip(ids, contents)]
+        if not records:
+            return
+        with self._lock:
+            self._sync()
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records))
+            self._sync()
+
+    def backfill(self, collection, batch_size: int = 1000) -> int:
+        """
+        Đánh chỉ mục các bản ghi có trong Milvus nhưng chưa có trong chỉ mục.
+        So theo TẬP id (không chỉ id lớn nhất): process ghi có thể đã thêm hóa đơn mới vào chỉ mục vừa được
+        làm mới trước khi các hóa đơn cũ được bổ sung.
+        """
+        with self._lock:
+            self._sync()
+            known = set(self._doc_len)
+        missing = []
+        iterator = collection.query_iterator(batch_size=batch_size, expr="id > -1",
+                                             output_fields=["id"], consistency_level="Strong")
+        try:
+            while rows := iterator.next():
+                missing.extend(int(row["id"]) for row in rows if int(row["id"]) not in known)
+        finally:
+            iterator.close()
+        for start in range(0, len(missing), batch_size):
+            rows = collection.query(expr=f"id in {json.dumps(missing[start:start + batch_size])}",
+                                    output_fields=["id", "content"], consistency_level="Strong")
+            self.add_many([row["id"] for row in rows], [row["content"] for row in rows])
+        if missing:
+            logger.info(f"Chỉ mục từ vựng '{self.collection_name}': +{len(missing)} hóa đơn (bổ sung từ Milvus).")
+        return len(missing)
+
+    # -- Tìm kiếm --
+
+    def search(self, query: str, k: int = 20) -> List[Tuple[int, float]]:
+        """Top-k hóa đơn theo điểm BM25: danh sách (id, điểm) giảm dần."""
+        terms = set(tokenize(query))
+        with self._lock:
+            self._sync()
+            n = len(self._doc_len)
+            if not n or not terms:
+                return []
+            avg_len = self._total_len / n
+            scores: Dict[int, float] = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * self._doc_len[doc_id] / avg_len)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        return heapq.nlargest(k, scores.items(), key=lambda pair: pair[1])
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._sync()
+            return {"documents": len(self._doc_len), "terms": len(self._postings), "max_id": self.max_id}
+
+_indexes: Dict[str, LexicalIndex] = {}
+_indexes_lock = threading.Lock()
+
+def get_lexical_index(collection_name: str) -> LexicalIndex:
+    """Chỉ mục dùng chung trong process cho một collection."""
+    with _indexes_lock:
+        if collection_name not in _indexes:
+            _indexes[collection_name] = LexicalIndex(collection_name)
+        return _indexes[collection_name]
@@ -1,19 +1,24 @@
 # file: main.py 
 
 # --- I. KHAI BÁO THƯ VIỆN ---
-from fastapi import FastAPI, Request, File, UploadFile
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi import FastAPI, Request, File, UploadFile, BackgroundTasks
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-import os, uuid, shutil, json
-from typing import List
-from backend import process_receipt  # Import hàm xử lý OCR từ file backend.py
-import embed_model  # Import module xử lý embedding
-# Import các thành phần cần thiết từ thư viện pymilvus
-from pymilvus import (
-    connections, FieldSchema, CollectionSchema,
-    DataType, Collection, utility
-)
+from fastapi.concurrency import run_in_threadpool
+import os, uuid, shutil, asyncio
+from typing import List, Optional
+from backend import process_receipt, extract_text_fast, ocr_stats  # Import hàm xử lý OCR và thống kê OCR từ file backend.py
+from resource_scheduler import get_scheduler  # Chia nhân CPU giữa OCR / sửa lỗi / embedding
+import invoice_export  # Xuất hóa đơn / dòng sản phẩm ra NDJSON, CSV, Parquet
+import receipt_dedup  # Phát hiện hóa đơn chụp trùng (perceptual hash + xác nhận theo các trường)
+import lexical_index  # Chỉ mục BM25 của tìm kiếm lai (cập nhật khi chèn hóa đơn)
+import image_derivatives  # Ảnh xem trước / ảnh thu nhỏ nén cho trang kết quả, kho lạnh cho ảnh gốc
+from receipt_parser import extraction_stats  # Thống kê sửa JSON / hỏi lại Gemini
+from embedding_service import get_embedding_service  # Dịch vụ embedding dùng chung (gom batch động)
+import milvus_index  # Cấu hình index vector (loại index, metric, tham số build/search)
+import invoice_store  # Schema collection hóa đơn, tạo collection và chèn hóa đơn (dùng chung với ingest.py)
+from invoice_store import COLLECTION_NAME  # Tên collection hóa đơn trong Milvus
 
 # --- II. KHỞI TẠO ỨNG DỤNG VÀ CẤU HÌNH ---
 
@@ -24,6 +29,18 @@ app = FastAPI()
 # thông qua đường dẫn URL "/static". Ví dụ: /static/uploads/my_image.jpg
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+class ImmutableStaticFiles(StaticFiles):
+    """StaticFiles cho file đặt tên theo mã băm nội dung: nội dung không bao giờ đổi nên được cache một năm."""
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+# Ảnh xem trước / ảnh thu nhỏ tạo lúc tải lên (xem image_derivatives), phục vụ tại "/derived".
+os.makedirs(image_derivatives.DERIVED_DIR, exist_ok=True)
+app.mount("/derived", ImmutableStaticFiles(directory=image_derivatives.DERIVED_DIR), name="derived")
+
 # 2. Cấu hình Jinja2 Templates: Chỉ định rằng các file template HTML nằm trong thư mục "templates".
 templates = Jinja2Templates(directory="templates")
 
@@ -37,58 +54,25 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # --- III. CẤU HÌNH VÀ KHỞI TẠO MILVUS ---
 
-# Lấy thông tin kết nối từ biến môi trường, nếu không có thì dùng giá trị mặc định.
-MILVUS_HOST = os.getenv("MILVUS_HOST", "127.0.0.1")
-MILVUS_PORT = os.getenv("MILVUS_PORT", "19530")
-# Tên của collection sẽ được tạo trong Milvus.
-COLLECTION_NAME = "invoice_collection"
+# Thông tin kết nối (MILVUS_HOST, MILVUS_PORT hoặc MILVUS_URI) được đọc bởi `milvus_connection`.
+# Tên collection, schema và index được định nghĩa trong `invoice_store` (dùng chung với công cụ nạp hàng loạt `ingest.py`).
 
 def init_milvus():
     """
     Hàm khởi tạo kết nối và thiết lập collection trong Milvus.
     Hàm này sẽ được chạy một lần khi ứng dụng FastAPI khởi động.
     """
-    # Kết nối đến server Milvus với alias là "default".
-    connections.connect("default", host=MILVUS_HOST, port=MILVUS_PORT)
-
     # Để đảm bảo môi trường sạch cho mỗi lần chạy (hữu ích cho việc phát triển),
-    # kiểm tra nếu collection đã tồn tại thì xóa đi để tạo mới.
-    if utility.has_collection(COLLECTION_NAME):
-        utility.drop_collection(COLLECTION_NAME)
-
-    # Định nghĩa cấu trúc (schema) cho collection.
-    # Mỗi bản ghi trong collection sẽ có các trường này.
-    fields = [
-        # Trường ID: Khóa chính, kiểu số nguyên, tự động tăng.
-        FieldSchema("id", dtype=DataType.INT64, is_primary=True, auto_id=True),
-        # Trường filename: Lưu tên file gốc, kiểu chuỗi, giới hạn 512 ký tự.
-        FieldSchema("filename", dtype=DataType.VARCHAR, max_length=512),
-        # Trường content: Lưu toàn bộ nội dung JSON của hóa đơn dưới dạng chuỗi.
-        # max_length lớn để chứa được các hóa đơn phức tạp.
-        FieldSchema("content", dtype=DataType.VARCHAR, max_length=65_535),
-        # Trường embedding: Lưu vector embedding của nội dung hóa đơn.
-        # `dim` (số chiều) PHẢI khớp với số chiều của model embedding.
-        FieldSchema("embedding", dtype=DataType.FLOAT_VECTOR, dim=embed_model.get_embedding_dim())
-    ]
-    # Tạo đối tượng schema từ danh sách các trường đã định nghĩa.
-    schema = CollectionSchema(fields, description="Hóa đơn đã được OCR và vector hóa")
-    # Tạo collection trong Milvus với tên và schema đã cho.
-    coll = Collection(name=COLLECTION_NAME, schema=schema)
-
-    # Tạo chỉ mục (index) cho trường embedding để tăng tốc độ tìm kiếm.
-    index_params = {
-        "index_type": "IVF_SQ8",  # Loại index phổ biến, cân bằng giữa tốc độ và độ chính xác.
-        "metric_type": "L2",      # Loại thước đo khoảng cách (Euclidean L2).
-        "params": {"nlist": 128}  # Số lượng cluster, ảnh hưởng đến hiệu năng.
-    }
-    coll.create_index("embedding", index_params)
-    # Tải collection vào bộ nhớ để sẵn sàng cho việc tìm kiếm và chèn dữ liệu.
-    coll.load()
-    return coll
+    # collection cũ bị xóa và tạo mới. Đặt MILVUS_KEEP_COLLECTION=1 để giữ dữ liệu đã có
+    # (ví dụ: sau khi nạp hàng loạt bằng `python ingest.py`).
+    keep = os.getenv("MILVUS_KEEP_COLLECTION", "0") == "1"
+    return invoice_store.ensure_collection(COLLECTION_NAME, drop_existing=not keep)
 
 # Gọi hàm init_milvus() ngay khi ứng dụng khởi động.
 # `milvus_coll` sẽ là một đối tượng collection toàn cục, sẵn sàng để sử dụng trong các endpoint.
 milvus_coll = init_milvus()
+# Chỉ mục hóa đơn trùng lặp của collection (None nếu tắt bằng DEDUP_ENABLED=0).
+dedup_index = receipt_dedup.get_duplicate_index(COLLECTION_NAME) if receipt_dedup.DEDUP_ENABLED else None
 
 
 # --- IV. CÁC API ENDPOINTS ---
@@ -107,7 +91,7 @@ async def post_upload(request: Request, images: List[UploadFile] = File(...)):
     Endpoint xử lý việc tải lên file (POST /upload).
     Nhận một hoặc nhiều file ảnh, xử lý OCR và hiển thị kết quả.
     """
-    results = []
+    saved = []
     # Lặp qua từng file ảnh được tải lên.
     for img in images:
         # Tạo một tên file duy nhất để tránh trùng lặp.
@@ -117,18 +101,11 @@ async def post_upload(request: Request, images: List[UploadFile] = File(...)):
         # Lưu file ảnh vào thư mục UPLOAD_DIR.
         with open(fp, "wb") as f:
             shutil.copyfileobj(img.file, f)
+        saved.append((fn, fp))
 
-        # Gọi hàm xử lý OCR từ backend để trích xuất thông tin từ ảnh.
-        data = process_receipt(fp)
-        # Xử lý trường hợp OCR thất bại (hàm trả về chuỗi lỗi thay vì dict).
-        if not isinstance(data, dict):
-            data = {"_error": data}
-
-        # Thêm kết quả xử lý vào danh sách.
-        results.append({
-            "filename": fn,
-            "json": data
-        })
+    # Xử lý các ảnh song song trong threadpool (không chặn event loop của /stats, /embed, /export).
+    # Bộ lập lịch nhân (resource_scheduler) giới hạn số ảnh cùng ở mỗi bước OCR / sửa lỗi / embedding.
+    results = await asyncio.gather(*(run_in_threadpool(_process_upload, fn, fp) for fn, fp in saved))
 
     # Trả về trang kết quả, truyền dữ liệu đã xử lý vào template.
     return templates.TemplateResponse(
@@ -136,8 +113,41 @@ async def post_upload(request: Request, images: List[UploadFile] = File(...)):
         {"request": request, "results": results}
     )
 
+def _process_upload(fn: str, fp: str) -> dict:
+    """Xử lý một ảnh đã lưu (đồng bộ, chạy trong threadpool): OCR + trích xuất, kiểm tra trùng, tạo ảnh nhỏ."""
+    duplicate, h = None, None
+    if dedup_index is not None:
+        # Tra perceptual hash trong chỉ mục: ảnh chụp lại của hóa đơn đã lưu được xác nhận bằng OCR nhanh
+        # và dừng sớm (không sửa lỗi, không gọi LLM), hoặc được xác nhận sau khi trích xuất.
+        h = receipt_dedup.image_hash(fp)
+        candidates = dedup_index.candidates(h)
+        data, duplicate = receipt_dedup.process_with_dedup(fp, candidates, process_receipt, extract_text_fast)
+        dedup_index.record(duplicate.stage if duplicate else None, len(candidates))
+    else:
+        # Gọi hàm xử lý OCR từ backend để trích xuất thông tin từ ảnh.
+        data = process_receipt(fp)
+    # Xử lý trường hợp OCR thất bại (hàm trả về chuỗi lỗi thay vì dict).
+    if data is None:
+        data = {}
+    elif not isinstance(data, dict):
+        data = {"_error": data}
+
+    # Ảnh nhỏ cho trang kết quả; ảnh gốc (đã xử lý xong) có thể được chuyển sang kho lạnh.
+    derivatives = image_derivatives.make_derivatives(fp)
+    if derivatives is not None and image_derivatives.ARCHIVE_ORIGINALS:
+        image_derivatives.archive_original(fp)
+
+    return {
+        "filename": fn,
+        "json": data,
+        "duplicate_of": duplicate.to_dict() if duplicate else None,
+        "images": derivatives,
+        # Dạng hex: số nguyên 64 bit vượt quá độ chính xác của số trong JavaScript.
+        "image_hash": f"{h:016x}" if h is not None else None,
+    }
+
 @app.post("/save_milvus")
-async def save_milvus(invoices: List[dict]):
+async def save_milvus(invoices: List[dict], background_tasks: BackgroundTasks):
     """
     Endpoint để lưu dữ liệu hóa đơn đã được xử lý vào Milvus (POST /save_milvus).
     Dữ liệu được gửi từ frontend sau khi người dùng xác nhận.
@@ -147,25 +157,144 @@ async def save_milvus(invoices: List[dict]):
       ...
     ]
     """
-    filenames, contents, texts = [], [], []
-    # Chuẩn bị dữ liệu để chèn hàng loạt (batch insert).
+    # 0. Bỏ qua hóa đơn trùng với hóa đơn đã lưu (hoặc với hóa đơn trước đó trong cùng lần lưu).
+    invoices, duplicates = await run_in_threadpool(_drop_duplicates, invoices)
+    # 1-4. Tạo embedding, chèn hàng loạt (batch insert), flush và thông báo cho ứng dụng chat.
+    try:
+        inserted_ids = await run_in_threadpool(
+            invoice_store.insert_invoices, milvus_coll,
+            [inv["filename"] for inv in invoices], [inv["json"] for inv in invoices],
+        )
+    except Exception:
+        if dedup_index is not None:
+            dedup_index.discard([inv["filename"] for inv in invoices])
+        raise
+    # 5. Nếu dữ liệu đã tăng vượt khoảng mà nlist được thiết kế: cảnh báo (hoặc rebuild nền khi MILVUS_AUTO_REBUILD=1).
+    background_tasks.add_task(milvus_index.maybe_rebuild_index, milvus_coll)
+    # 6. Trả về thông báo thành công và danh sách ID.
+    message = "Thêm dữ liệu vào Milvus thành công"
+    if duplicates:
+        message += f" (bỏ qua {len(duplicates)} hóa đơn trùng lặp)"
+    return JSONResponse({"message": message, "ids": inserted_ids, "duplicates": duplicates})
+
+def _drop_duplicates(invoices: List[dict]):
+    """
+    Tách các hóa đơn trùng lặp ra khỏi danh sách cần lưu; hóa đơn còn lại được ghi nhận ngay vào chỉ mục
+    để ảnh chụp lại nằm trong cùng một lần lưu cũng bị phát hiện. Trả về (hóa đơn cần lưu, danh sách bản trùng).
+    """
+    if dedup_index is None:
+        return invoices, []
+    accepted, duplicates = [], []
     for inv in invoices:
-        filenames.append(inv["filename"])
-        # Chuyển đổi dict JSON thành một chuỗi. `ensure_ascii=False` để giữ lại ký tự tiếng Việt.
-        s = json.dumps(inv["json"], ensure_ascii=False)
-        contents.append(s)
-        texts.append(s) # Dùng chính chuỗi JSON này để tạo embedding.
-
-    # 1. Tạo embeddings cho tất cả các văn bản cùng một lúc.
-    embs = embed_model.encode_texts(texts)
-    # 2. Chèn dữ liệu (filename, content, embedding) vào Milvus.
-    mr = milvus_coll.insert([filenames, contents, embs])
-    # 3. Flush collection để đảm bảo dữ liệu được ghi và có thể tìm kiếm ngay lập tức.
-    milvus_coll.flush()
-    # 4. Lấy danh sách các ID của các bản ghi vừa được chèn.
-    inserted_ids = [int(pk) for pk in mr.primary_keys]
-    # 5. Trả về thông báo thành công và danh sách ID.
-    return JSONResponse({"message": "Thêm dữ liệu vào Milvus thành công", "ids": inserted_ids})
+        # Đã được đánh dấu trùng ở bước tải lên (có thể đã dừng sớm, không có dữ liệu trích xuất).
+        duplicate = inv.get("duplicate_of")
+        if not duplicate and isinstance(inv.get("json"), dict):
+            # Kiểm tra lại với dữ liệu người dùng đã chỉnh sửa và các hóa đơn được lưu sau lúc tải lên.
+            # Dùng mã băm tính lúc tải lên: ảnh gốc có thể đã được chuyển sang kho lạnh.
+            h = (int(inv["image_hash"], 16) if inv.get("image_hash")
+                 else receipt_dedup.image_hash(os.path.join(UPLOAD_DIR, inv["filename"])))
+            match = receipt_dedup.match_fields(inv["json"], dedup_index.candidates(h))
+            if match is None:
+                dedup_index.add(inv["filename"], h, inv["json"])
+                accepted.append(inv)
+                continue
+            duplicate = match.to_dict()
+        elif not duplicate:
+            accepted.append(inv)
+            continue
+        duplicates.append({"filename": inv["filename"], "duplicate_of": duplicate})
+    return accepted, duplicates
+
+
+@app.post("/embed")
+async def embed(payload: dict):
+    """
+    Endpoint sidecar embedding (POST /embed).
+    Cho phép các process khác (ví dụ: ứng dụng chat Streamlit với EMBEDDING_SERVICE_URL)
+    dùng chung bản model đã tải trong process này thay vì tự tải thêm một bản.
+    Đầu vào: {"texts": ["...", ...]}. Đầu ra: byte float32 thô, hình dạng nằm trong header X-Embedding-Shape.
+    """
+    texts = payload.get("texts") or []
+    # Chạy trong threadpool để không chặn event loop khi chờ worker embedding.
+    embs = await run_in_threadpool(get_embedding_service().embed, texts)
+    rows, dim = embs.shape
+    return Response(
+        content=embs.tobytes(),
+        media_type="application/octet-stream",
+        headers={"X-Embedding-Shape": f"{rows},{dim}"},
+    )
+
+
+@app.get("/export/{table}")
+async def export_table(table: str, format: str = "csv", since_id: Optional[int] = None, since_date: Optional[str] = None):
+    """
+    Endpoint xuất dữ liệu (GET /export/invoices hoặc /export/items).
+    Đọc collection theo từng trang và gửi dần về client, nên bộ nhớ không tăng theo số hóa đơn.
+    Tham số: format = ndjson | csv | parquet; since_id: chỉ các bản ghi có khóa chính lớn hơn
+    (xuất tăng dần); since_date: chỉ các hóa đơn từ ngày này (YYYY-MM-DD hoặc YYYY-MM).
+    """
+    try:
+        stream = invoice_export.export_stream(COLLECTION_NAME, table, format, since_id, since_date)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except RuntimeError as e:  # Thiếu pyarrow cho Parquet.
+        return JSONResponse({"error": str(e)}, status_code=501)
+    return StreamingResponse(
+        stream,
+        media_type=invoice_export.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'},
+    )
+
+
+@app.get("/stats/extraction")
+async def get_extraction_stats():
+    """
+    Endpoint (GET /stats/extraction): thống kê bước trích xuất bằng Gemini kể từ khi khởi động —
+    tỉ lệ phản hồi phải sửa JSON, bị cắt ngang, phải hỏi lại, và số token tiết kiệm nhờ chỉ hỏi lại các trường lỗi.
+    """
+    return JSONResponse(extraction_stats.report())
+
+
+@app.get("/stats/ocr")
+async def get_ocr_stats():
+    """
+    Endpoint (GET /stats/ocr): thống kê OCR thích ứng của các hóa đơn gần nhất —
+    tỉ lệ dòng phải OCR lại, tỉ lệ phải chạy pipeline đầy đủ và độ trễ từng bước.
+    """
+    return JSONResponse(ocr_stats.report())
+
+
+@app.get("/stats/scheduler")
+async def get_scheduler_stats():
+    """
+    Endpoint (GET /stats/scheduler): cách chia nhân CPU hiện tại giữa OCR / sửa lỗi / embedding,
+    số worker, số luồng mỗi worker, độ dài hàng đợi và thời gian chờ / xử lý trung bình của từng bước.
+    """
+    return JSONResponse(get_scheduler().stats())
+
+
+@app.get("/stats/dedup")
+async def get_dedup_stats():
+    """
+    Endpoint (GET /stats/dedup): số hóa đơn trong chỉ mục trùng lặp, số bản trùng bị dừng sớm
+    ở lượt ảnh, số bản trùng phát hiện sau khi trích xuất và số ứng viên bị loại khi xác nhận.
+    """
+    return JSONResponse(dedup_index.stats() if dedup_index is not None else {"enabled": False})
+
+
+@app.get("/stats/images")
+async def get_image_stats():
+    """
+    Endpoint (GET /stats/images): dung lượng trung bình của ảnh gốc, ảnh xem trước và ảnh thu nhỏ,
+    tỉ lệ dung lượng trang kết quả so với khi hiển thị ảnh gốc, và số ảnh gốc đã chuyển sang kho lạnh.
+    """
+    return JSONResponse(image_derivatives.derivative_stats.report())
+
+
+@app.get("/stats/lexical")
+async def get_lexical_stats():
+    """Endpoint (GET /stats/lexical): số hóa đơn và số từ trong chỉ mục BM25 của tìm kiếm lai."""
+    return JSONResponse(lexical_index.get_lexical_index(COLLECTION_NAME).stats())
 
 
 @app.get("/chat", response_class=HTMLResponse)
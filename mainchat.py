@@ -5,14 +5,21 @@ import os  # Tương tác với hệ điều hành, chủ yếu để đọc bi
 import streamlit as st  # Thư viện chính để xây dựng giao diện người dùng web.
 from dotenv import load_dotenv  # Tải các biến môi trường từ file .env.
 import re  # Thư viện cho biểu thức chính quy (Regular Expressions), dùng để xử lý văn bản.
-from milvus_utils import get_milvus_retriever  # Hàm tiện ích tự định nghĩa để lấy retriever từ Milvus.
-from modelchat import create_chat_agent_executor  # Hàm tự định nghĩa để tạo ra AI agent.
-from pymilvus import utility, connections  # Các công cụ để tương tác trực tiếp với Milvus (kiểm tra kết nối, liệt kê collections).
+from milvus_utils import get_milvus_retriever, get_hybrid_retriever  # Hàm tiện ích tự định nghĩa để lấy retriever từ Milvus.
+from modelchat import create_chat_agent_executor, AgentTraceHandler, stream_agent_events  # Tạo AI agent và chạy agent dạng streaming.
+import asyncio  # Chạy vòng lặp streaming bất đồng bộ của agent trong script Streamlit.
+from invoice_snapshot import InvoiceSnapshot  # Danh sách hóa đơn cập nhật tăng dần từ Milvus.
+from pymilvus import utility  # Các công cụ để tương tác trực tiếp với Milvus (liệt kê collections).
+from milvus_connection import get_connection_manager  # Bộ quản lý kết nối Milvus dùng chung.
+import intent_router  # Trả lời các câu hỏi đơn giản bằng luật, không cần gọi LLM.
+import time  # Đo thời gian trả lời của agent (thời gian tiết kiệm được khi trúng cache).
+from answer_cache import SemanticAnswerCache, is_cacheable, depends_on_history  # Cache câu trả lời theo ngữ nghĩa câu hỏi.
+from embedding_service import get_embedding_service  # Embedding câu hỏi bằng model embedding dùng chung.
+from chat_history import ChatHistoryManager, make_llm_summarizer  # Giới hạn lịch sử chat gửi cho agent.
+from langchain_ollama import ChatOllama  # LLM dùng để tóm tắt các lượt chat cũ (khi bật chế độ "llm").
 
 # Thư viện để quản lý lịch sử trò chuyện, tích hợp với session state của Streamlit.
 from langchain_community.chat_message_histories import StreamlitChatMessageHistory
-import io  # Dùng để tạo một bộ đệm (buffer) trong bộ nhớ, hoạt động như một file văn bản.
-import contextlib  # Cung cấp các tiện ích, ở đây là để chuyển hướng luồng đầu ra (stdout).
 
 # --- II. CẤU HÌNH BAN ĐẦU VÀ BIẾN TOÀN CỤC ---
 
@@ -29,7 +36,74 @@ pattern = r"\b(" + "|".join(re.escape(keyword) for keyword in GREETING_KEYWORDS)
 # Biên dịch (compile) regex trước để tăng tốc độ tìm kiếm khi hàm được gọi nhiều lần.
 GREETING_REGEX = re.compile(pattern, re.IGNORECASE)  # IGNORECASE để không phân biệt chữ hoa/thường.
 
-# --- III. CÁC HÀM CHỨC NĂNG ---
+# Cho agent công cụ tìm kiếm lai (vector + BM25) để tra cứu hóa đơn theo mã, số điện thoại, số tiền.
+HYBRID_SEARCH_ENABLED = os.getenv("HYBRID_SEARCH_ENABLED", "1") == "1"
+# Câu trả lời AgentExecutor trả về khi vượt max_iterations / max_execution_time (early_stopping_method="force").
+AGENT_STOPPED_OUTPUT = "Agent stopped due to iteration limit or time limit."
+
+# --- III. TÀI NGUYÊN DÙNG CHUNG CỦA PROCESS ---
+# Các tài nguyên nặng (vector store, danh sách hóa đơn, agent) được cache MỘT LẦN cho cả process
+# bằng `st.cache_resource`, theo khóa (collection, model LLM), và dùng chung giữa mọi session và mọi lần rerun.
+# Session state của từng người dùng chỉ còn giữ lịch sử chat, nên bộ nhớ không tăng theo số người dùng.
+# Model embedding đã là singleton của process (xem `embedding_service.get_embedding_service`).
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def get_shared_retriever(collection_name: str):
+    """Retriever (vector store Milvus) dùng chung cho một collection."""
+    retriever = get_milvus_retriever(collection_name)
+    if retriever is None:
+        # Ném lỗi để Streamlit KHÔNG cache kết quả thất bại; lần sau sẽ thử lại.
+        raise RuntimeError(f"Không thể khởi tạo retriever cho '{collection_name}'.")
+    return retriever
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def get_shared_search_retriever(collection_name: str):
+    """Retriever lai (vector + BM25) dùng chung cho một collection."""
+    retriever = get_hybrid_retriever(collection_name)
+    if retriever is None:
+        # Ném lỗi để Streamlit KHÔNG cache kết quả thất bại; lần sau sẽ thử lại.
+        raise RuntimeError(f"Không thể khởi tạo retriever lai cho '{collection_name}'.")
+    return retriever
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def get_invoice_snapshot(collection_name: str) -> InvoiceSnapshot:
+    """
+    Snapshot hóa đơn của collection, dùng chung cho mọi agent của collection đó.
+    Snapshot tự kéo các hóa đơn mới (chỉ phần mới) khi /save_milvus báo có thay đổi hoặc khi quá TTL.
+    """
+    snapshot = InvoiceSnapshot(collection_name)
+    snapshot.refresh(force=True)
+    return snapshot
+
+@st.cache_resource(show_spinner=False, max_entries=16)
+def get_shared_agent_executor(collection_name: str, llm_model: str, with_search: bool = False):
+    """
+    AgentExecutor dùng chung theo (collection, model LLM, có công cụ tìm kiếm hay không).
+    Lịch sử chat được truyền vào mỗi lượt nên agent không có trạng thái riêng. `with_search` nằm trong khóa cache,
+    nên khi retriever lai khởi tạo được ở lần sau, agent có công cụ tìm kiếm được tạo thay cho agent tạm.
+    """
+    return create_chat_agent_executor(
+        get_shared_retriever(collection_name), llm_model,
+        snapshot=get_invoice_snapshot(collection_name),
+        search_retriever=get_shared_search_retriever(collection_name) if with_search else None,
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_answer_cache() -> SemanticAnswerCache:
+    """Cache câu trả lời dùng chung cho mọi session của process (khóa theo collection + phiên bản dữ liệu)."""
+    return SemanticAnswerCache(get_embedding_service().embed_query)
+
+# Cách tóm tắt các lượt chat cũ: "extractive" (nhanh, không gọi LLM) hoặc "llm".
+CHAT_SUMMARY_MODE = os.getenv("CHAT_SUMMARY_MODE", "extractive")
+
+def get_history_manager(llm_model: str) -> ChatHistoryManager:
+    """Bộ quản lý lịch sử của session hiện tại (mỗi session một bản tóm tắt riêng)."""
+    if "history_manager" not in st.session_state:
+        summarize_fn = make_llm_summarizer(ChatOllama(model=llm_model, temperature=0)) if CHAT_SUMMARY_MODE == "llm" else None
+        st.session_state.history_manager = ChatHistoryManager(summarize_fn=summarize_fn)
+    return st.session_state.history_manager
+
+# --- IV. CÁC HÀM CHỨC NĂNG ---
 
 def initialize_app():
     """
@@ -51,52 +125,98 @@ def setup_sidebar():
         
         # Kết nối đến Milvus và lấy danh sách các collection có sẵn.
         try:
-            # Chỉ kết nối nếu chưa có kết nối mặc định nào tồn tại.
-            if not connections.has_connection("default"):
-                host = os.getenv("MILVUS_HOST", "localhost")
-                port = os.getenv("MILVUS_PORT", "19530")
-                connections.connect("default", host=host, port=port)
+            # Lấy kết nối dùng chung (chỉ kết nối lần đầu hoặc khi kết nối cũ hỏng, không phải mỗi lần rerun).
+            alias = get_connection_manager().get()
             # Lấy danh sách tên các collection.
-            available_collections = utility.list_collections()
+            available_collections = utility.list_collections(using=alias)
         except Exception as e:
             # Nếu không kết nối được, hiển thị lỗi và trả về danh sách rỗng.
             st.error(f"Không thể kết nối Milvus: {e}")
             available_collections = []
 
-        def clear_agent_on_change():
+        def reload_shared_resources():
             """
-            Hàm callback quan trọng. Khi người dùng thay đổi cấu hình (collection hoặc model),
-            hàm này sẽ xóa agent cũ khỏi bộ nhớ session.
-            Điều này buộc ứng dụng phải tạo lại agent mới với cấu hình mới ở lần tương tác tiếp theo.
+            Hàm callback cho nút khởi tạo lại: buộc snapshot hóa đơn hỏi Milvus ngay lập tức
+            (chỉ kéo các bản ghi mới, không tải lại toàn bộ). Thông thường không cần bấm,
+            vì snapshot tự làm mới khi /save_milvus báo có thay đổi.
+            Việc đổi collection hoặc model KHÔNG cần callback: agent được cache theo khóa (collection, model).
             """
-            keys_to_delete = ["agent_executor", "collection_for_agent", "model_for_agent"]
-            for key in keys_to_delete:
-                if key in st.session_state:
-                    del st.session_state[key]
+            collection = st.session_state.get("collection_choice")
+            if collection:
+                get_invoice_snapshot(collection).refresh(force=True)
 
         # Tạo dropdown để người dùng chọn collection.
         selected_collection = st.selectbox(
             "Chọn một collection để làm việc:",
             options=available_collections,
             key="collection_choice",
-            on_change=clear_agent_on_change  # Gọi hàm xóa agent khi lựa chọn thay đổi.
         )
 
         st.header("🧠 Lựa chọn Model Trả lời")
         # Tạo dropdown để người dùng chọn model LLM.
         llm_model_name = st.selectbox("Chọn LLM (Ollama):", [
             "llama3.2:latest", "mistral:latest", "qwen:latest", "gemma:7b"
-        ], key="model_choice", on_change=clear_agent_on_change)
+        ], key="model_choice")
+
+        # Nút để tải lại dữ liệu hóa đơn và khởi tạo lại agent.
+        st.button("🚀 Áp dụng và Khởi tạo lại", on_click=reload_shared_resources)
 
-        # Nút để áp dụng thay đổi, cũng gọi hàm xóa agent.
-        st.button("🚀 Áp dụng và Khởi tạo lại", on_click=clear_agent_on_change)
+        # Thống kê cache câu trả lời, giúp chỉnh ngưỡng ANSWER_CACHE_THRESHOLD.
+        with st.expander("📊 Cache câu trả lời"):
+            stats = get_answer_cache().stats()
+            st.metric("Tỉ lệ trúng", f"{stats['hit_rate']:.0%}", help=f"{stats['hits']}/{stats['lookups']} lượt hỏi")
+            st.metric("Thời gian tiết kiệm", f"{stats['saved_s']:.1f}s")
+            st.caption(f"Ngưỡng: {stats['threshold']} · Số mục: {stats['entries']} · Lần hủy: {stats['invalidations']}")
+            if stats["similarity_histogram"]:
+                st.bar_chart({str(k): v for k, v in stats["similarity_histogram"].items()})
 
     return selected_collection, llm_model_name
-ANSI_ESCAPE = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
 
-def main_chat_interface():
+def run_agent_streaming(agent_executor, inputs: dict, answer_placeholder, trace_placeholder):
+    """
+    Chạy agent ở chế độ streaming và cập nhật giao diện theo từng sự kiện:
+    token của LLM hiện ra ngay khi được sinh, các bước gọi công cụ hiện trong khu vực "suy nghĩ".
+
+    Returns:
+        tuple: (câu trả lời cuối cùng của agent, AgentTraceHandler của lượt chạy,
+                True nếu agent hoàn thành với một câu trả lời cuối thực sự)
+    """
+    trace = AgentTraceHandler()
+
+    async def _consume():
+        answer, final = "", None
+        async for event in stream_agent_events(agent_executor, inputs, trace):
+            if event["type"] == "llm_start":
+                answer = ""  # Bước mới của LLM: văn bản của bước trước chỉ là suy nghĩ trung gian.
+            elif event["type"] == "token":
+                answer += event["text"]
+                answer_placeholder.markdown(answer + "▌")
+            elif event["type"] == "tool_start":
+                answer_placeholder.markdown(f"⏳ Đang dùng công cụ `{event['tool']}`...")
+                trace_placeholder.text(trace.format())
+            elif event["type"] == "tool_end":
+                trace_placeholder.text(trace.format())
+            elif event["type"] == "final":
+                final = event["output"]
+        return final, answer
+
+    final, answer = asyncio.run(_consume())
+    # Không có sự kiện "final" (lỗi giữa chừng) hoặc agent dừng vì giới hạn số bước/thời gian: không phải câu trả lời thật.
+    succeeded = bool(final) and final.strip() != AGENT_STOPPED_OUTPUT
+    response_content = (final if final is not None else answer) or "Lỗi: Không nhận được phản hồi."
+    answer_placeholder.markdown(response_content)
+    trace_placeholder.text(trace.format())
+    return response_content, trace, succeeded
+
+def main_chat_interface(agent_executor, snapshot: InvoiceSnapshot, collection_name: str, llm_model: str):
     """
     Hàm hiển thị giao diện chat chính, xử lý đầu vào của người dùng và phản hồi.
+
+    Args:
+        agent_executor: Agent dùng chung của process cho cấu hình hiện tại.
+        snapshot (InvoiceSnapshot): Danh sách hóa đơn dùng chung, cho các câu hỏi được trả lời không qua LLM.
+        collection_name (str): Collection hiện tại (khóa của cache câu trả lời).
+        llm_model (str): Model LLM hiện tại (dùng khi tóm tắt lịch sử bằng LLM).
     """
     st.title("🤖 Trợ lý AI")
     
@@ -125,32 +245,40 @@ def main_chat_interface():
             response_content = "Chào bạn nha! Tôi có thể giúp gì cho bạn hôm nay nè?"
             with st.chat_message("assistant"):
                 st.write(response_content)
+        # --- BỘ ĐỊNH TUYẾN Ý ĐỊNH ---
+        # Câu hỏi đơn giản (đếm, lớn nhất, giờ, tính toán, tra mã hóa đơn) được trả lời
+        # bằng cách gọi thẳng công cụ, không tốn một lượt gọi LLM nào.
+        elif (routed_answer := intent_router.route_and_answer(prompt, snapshot.documents)) is not None:
+            response_content = routed_answer
+            with st.chat_message("assistant"):
+                st.write(response_content)
+        # --- CACHE CÂU TRẢ LỜI ---
+        # Câu hỏi gần giống một câu đã được trả lời trên cùng phiên bản dữ liệu: dùng lại câu trả lời cũ.
+        # Câu hỏi phụ thuộc các lượt trước (khóa cache không gồm lịch sử) thì không tra và không lưu.
+        elif not (uses_history := depends_on_history(msgs.messages[:-1])) \
+                and (cached := get_answer_cache().lookup(collection_name, prompt)).hit:
+            response_content = cached.answer
+            with st.chat_message("assistant"):
+                st.write(response_content)
+                st.caption(f"⚡ Trả lời từ cache (giống \"{cached.matched_question}\" {cached.similarity:.0%}).")
         else:
             # Nếu không phải câu chào, mới thực sự gọi đến AI Agent.
             with st.chat_message("assistant"):
-                # Lấy agent đã được khởi tạo và lưu trong session state.
-                agent_executor = st.session_state.agent_executor
-                
                 # Sử dụng st.expander để tạo một khu vực có thể thu gọn/mở rộng,
-                # cho phép người dùng xem quá trình suy nghĩ của AI nếu muốn.
+                # cho phép người dùng xem quá trình suy nghĩ của AI nếu muốn (cập nhật trực tiếp khi agent chạy).
                 with st.expander("🤔 Xem quá trình suy nghĩ của AI..."):
-                    log_capture_buffer = io.StringIO() # Tạo một buffer để "bắt" log.
-                    # Chuyển hướng tất cả output (ví dụ: print) vào buffer thay vì console.
-                    with contextlib.redirect_stdout(log_capture_buffer):
-                        # Gọi agent với đầu vào và lịch sử chat.
-                        # Các log từ `verbose=True` của agent sẽ được ghi vào `log_capture_buffer`.
-                        response = agent_executor.invoke(
-                            {"input": prompt, "chat_history": msgs.messages},
-                        )
-                    log_output = log_capture_buffer.getvalue() # Lấy nội dung log từ buffer.
-                    log_output_clean = ANSI_ESCAPE.sub('', log_output)
-
-                    st.text(log_output_clean) # Hiển thị log dưới dạng văn bản thô.
-
-                # Lấy nội dung câu trả lời từ kết quả của agent.
-                # Dùng .get() để tránh lỗi nếu key "output" không tồn tại.
-                response_content = response.get("output", "Lỗi: Không nhận được phản hồi.")
-                st.write(response_content)
+                    trace_placeholder = st.empty()
+                answer_placeholder = st.empty()
+                # Gọi agent ở chế độ streaming với đầu vào và lịch sử chat.
+                started = time.perf_counter()
+                response_content, trace, succeeded = run_agent_streaming(
+                    agent_executor,
+                    # Lịch sử có giới hạn token: tóm tắt các lượt cũ + các lượt gần nhất (không gồm câu hỏi hiện tại).
+                    {"input": prompt, "chat_history": get_history_manager(llm_model).build(msgs.messages[:-1])},
+                    answer_placeholder, trace_placeholder,
+                )
+                if not uses_history and is_cacheable(trace.events, succeeded):
+                    get_answer_cache().store(cached, response_content, time.perf_counter() - started)
         
         # Lưu tin nhắn phản hồi của AI vào lịch sử.
         msgs.add_ai_message(response_content)
@@ -169,25 +297,25 @@ def main():
         st.warning("Vui lòng chọn một collection ở thanh bên để bắt đầu.")
         return
 
-    # Kiểm tra xem agent đã được khởi tạo và lưu trong session state chưa.
-    # Nếu chưa, tiến hành khởi tạo.
-    # Logic này đảm bảo agent chỉ được tạo MỘT LẦN cho mỗi cấu hình,
-    # tránh việc phải tải lại model và thiết lập lại mọi thứ sau mỗi tin nhắn.
-    if "agent_executor" not in st.session_state:
+    # Lấy agent dùng chung của process cho cấu hình (collection, model) hiện tại.
+    # Chỉ session đầu tiên của mỗi cấu hình phải chờ khởi tạo; các session và lần rerun sau dùng lại ngay.
+    # Công cụ tìm kiếm hóa đơn (retriever lai) là tùy chọn: lỗi khởi tạo chỉ cảnh báo, lượt sau thử lại.
+    with_search = False
+    if HYBRID_SEARCH_ENABLED:
+        try:
+            get_shared_search_retriever(collection_name)
+            with_search = True
+        except RuntimeError as e:
+            st.warning(f"{e} Trợ lý tạm thời không có công cụ tìm kiếm hóa đơn.")
+    try:
         with st.spinner(f"Đang khởi tạo Trợ lý với model '{llm_model}'..."):
-            # Lấy retriever từ Milvus dựa trên collection đã chọn.
-            retriever = get_milvus_retriever(collection_name)
-            if retriever is None:
-                st.error(f"Không thể khởi tạo retriever cho '{collection_name}'.")
-                return
-            
-            # Tạo agent executor bằng cách gọi hàm từ modelchat.py.
-            # Lưu agent đã tạo vào session state để tái sử dụng.
-            st.session_state.agent_executor = create_chat_agent_executor(retriever, llm_model)
-            st.success("Trợ lý đã sẵn sàng!")
-    
+            agent_executor = get_shared_agent_executor(collection_name, llm_model, with_search)
+    except RuntimeError as e:
+        st.error(str(e))
+        return
+
     # Sau khi đảm bảo agent đã sẵn sàng, hiển thị giao diện chat.
-    main_chat_interface()
+    main_chat_interface(agent_executor, get_invoice_snapshot(collection_name), collection_name, llm_model)
 
 # Điểm khởi đầu của chương trình Python.
 if __name__ == "__main__":
@@ -0,0 +1,130 @@
+# file: milvus_connection.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os  # Đọc thông tin kết nối từ biến môi trường.
+import time  # Đo khoảng thời gian giữa các lần kiểm tra sức khỏe và chờ khi thử lại.
+import random  # Thêm jitter cho thời gian chờ để các process không thử lại cùng lúc.
+import logging
+import threading  # Bảo vệ bảng kết nối khi nhiều session/luồng dùng chung.
+from typing import Optional
+
+from pymilvus import connections, utility  # API kết nối và tiện ích của pymilvus.
+
+logger = logging.getLogger(__name__)
+
+# --- II. CẤU HÌNH ---
+
+# Kết nối tới server Milvus (mặc định), hoặc Milvus Lite khi đặt MILVUS_URI tới một file .db
+# (ví dụ: MILVUS_URI=./milvus_local.db) — tiện cho phát triển và kiểm thử không cần Docker.
+MILVUS_HOST = os.getenv("MILVUS_HOST", "127.0.0.1")
+MILVUS_PORT = os.getenv("MILVUS_PORT", "19530")
+MILVUS_URI = os.getenv("MILVUS_URI", "")
+
+# Số lần thử kết nối lại và thời gian chờ cơ sở (giây) cho backoff lũy thừa.
+MAX_RETRIES = int(os.getenv("MILVUS_CONNECT_RETRIES", "5"))
+BASE_DELAY_S = float(os.getenv("MILVUS_CONNECT_BASE_DELAY", "0.5"))
+MAX_DELAY_S = 10.0
+# Chỉ kiểm tra sức khỏe kết nối khi lần kiểm tra trước đã cũ hơn chừng này giây.
+HEALTH_CHECK_INTERVAL_S = float(os.getenv("MILVUS_HEALTH_CHECK_INTERVAL", "30"))
+
+# --- III. BỘ QUẢN LÝ KẾT NỐI ---
+
+class MilvusConnectionManager:
+    """
+    Quản lý một "pool" các kết nối Milvus có tên (alias), dùng chung trong cả process.
+    - Mỗi database có một alias riêng, được tạo một lần và tái sử dụng (không ngắt/kết nối lại mỗi lần dùng).
+    - Trước khi trả alias, kết nối được kiểm tra sức khỏe (có giới hạn tần suất);
+      nếu hỏng thì kết nối lại với backoff lũy thừa.
+    - `connections_api`/`utility_api` có thể được thay bằng đối tượng giả lập trong bộ nhớ để kiểm thử.
+    """
+
+    def __init__(self, host: str = MILVUS_HOST, port: str = MILVUS_PORT, uri: str = MILVUS_URI,
+                 connections_api=connections, utility_api=utility,
+                 max_retries: int = MAX_RETRIES, base_delay: float = BASE_DELAY_S,
+                 health_check_interval: float = HEALTH_CHECK_INTERVAL_S, sleep=time.sleep):
+        self.host, self.port, self.uri = host, port, uri
+        self._connections = connections_api
+        self._utility = utility_api
+        self._max_retries = max_retries
+        self._base_delay = base_delay
+        self._health_interval = health_check_interval
+        self._sleep = sleep
+        self._last_checked: dict = {}  # alias -> thời điểm kiểm tra sức khỏe gần nhất.
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def alias_for(db_name: str = "default") -> str:
+        """Alias của kết nối ứng với database. Database mặc định dùng alias 'default' quen thuộc."""
+        return "default" if db_name == "default" else f"db_{db_name}"
+
+    def connection_args(self, db_name: str = "default") -> dict:
+        """Tham số kết nối cho các thư viện tự quản lý kết nối (ví dụ: vector store của LangChain)."""
+        if self.uri:
+            return {"uri": self.uri, "db_name": db_name}
+        return {"host": self.host, "port": self.port, "db_name": db_name}
+
+    def get(self, db_name: str = "default") -> str:
+        """
+        Trả về alias của một kết nối còn sống tới `db_name`, tạo mới hoặc kết nối lại nếu cần.
+        Dùng alias này cho các lệnh pymilvus, ví dụ: `utility.list_collections(using=alias)`.
+        """
+        alias = self.alias_for(db_name)
+        with self._lock:
+            if self._connections.has_connection(alias) and self._is_healthy(alias):
+                return alias
+            self._connect(alias, db_name)
+            return alias
+
+    def _is_healthy(self, alias: str) -> bool:
+        now = time.monotonic()
+        if now - self._last_checked.get(alias, float("-inf")) < self._health_interval:
+            return True
+        try:
+            self._utility.get_server_version(using=alias)
+        except Exception as e:
+            logger.warning(f"⚠️ Kết nối Milvus '{alias}' không phản hồi: {e}")
+            return False
+        self._last_checked[alias] = now
+        return True
+
+    def _connect(self, alias: str, db_name: str):
+        """Kết nối (lại) với backoff lũy thừa có jitter; ném lỗi sau lần thử cuối cùng."""
+        if self._connections.has_connection(alias):
+            self._connections.disconnect(alias)
+        kwargs = {"uri": self.uri} if self.uri else {"host": self.host, "port": self.port}
+        for attempt in range(1, self._max_retries + 1):
+            try:
+                logger.info(f"Đang kết nối Milvus alias='{alias}' db='{db_name}' (lần {attempt})...")
+                self._connections.connect(alias, db_name=db_name, **kwargs)
+                self._last_checked[alias] = time.monotonic()
+                logger.info(f"✅ Đã kết nối Milvus alias='{alias}'.")
+                return
+            except Exception as e:
+                if attempt == self._max_retries:
+                    logger.error(f"❌ Không thể kết nối Milvus sau {attempt} lần thử: {e}")
+                    raise
+                delay = min(MAX_DELAY_S, self._base_delay * 2 ** (attempt - 1)) * (0.5 + random.random() / 2)
+                logger.warning(f"⚠️ Kết nối Milvus thất bại ({e}), thử lại sau {delay:.2f}s...")
+                self._sleep(delay)
+
+    def close_all(self):
+        """Ngắt mọi kết nối do bộ quản lý tạo ra (dùng khi tắt ứng dụng)."""
+        with self._lock:
+            for alias in list(self._last_checked):
+                if self._connections.has_connection(alias):
+                    self._connections.disconnect(alias)
+            self._last_checked.clear()
+
+# --- IV. ĐIỂM TRUY CẬP DUY NHẤT ---
+
+_manager: Optional[MilvusConnectionManager] = None
+_manager_lock = threading.Lock()
+
+def get_connection_manager() -> MilvusConnectionManager:
+    """Trả về bộ quản lý kết nối dùng chung của process (FastAPI, Streamlit, script)."""
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = MilvusConnectionManager()
+    return _manager
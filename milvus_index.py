@@ -0,0 +1,203 @@
+# file: milvus_index.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os  # Đọc cấu hình index từ biến môi trường.
+import json  # Tham số build/search được cấu hình dưới dạng chuỗi JSON.
+import math
+import logging
+import threading  # Tránh hai lần rebuild index chạy song song.
+from dataclasses import dataclass, field
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# --- II. CẤU HÌNH MẶC ĐỊNH CHO TỪNG LOẠI INDEX ---
+
+# Tham số build (khi tạo index) và search (khi truy vấn) mặc định cho mỗi loại index.
+# - HNSW: đồ thị nhiều tầng, recall cao, không cần huấn luyện; tốn RAM hơn.
+# - IVF_FLAT: chia cụm (nlist) rồi chỉ quét nprobe cụm gần nhất, vector giữ nguyên.
+# - IVF_SQ8: như IVF_FLAT nhưng nén vector về 8 bit, tiết kiệm bộ nhớ, giảm nhẹ recall.
+# - FLAT: tìm kiếm vét cạn, recall tuyệt đối, phù hợp khi dữ liệu còn nhỏ.
+INDEX_PRESETS = {
+    "HNSW": {"build": {"M": 16, "efConstruction": 200}, "search": {"ef": 64}},
+    "IVF_FLAT": {"build": {"nlist": 128}, "search": {"nprobe": 16}},
+    "IVF_SQ8": {"build": {"nlist": 128}, "search": {"nprobe": 16}},
+    "FLAT": {"build": {}, "search": {}},
+}
+METRICS = ("L2", "IP", "COSINE")
+
+# Rebuild index IVF khi nlist khuyến nghị cho số bản ghi hiện tại lớn hơn nlist đang dùng
+# ít nhất chừng này lần.
+REBUILD_GROWTH_FACTOR = float(os.getenv("MILVUS_REBUILD_GROWTH_FACTOR", "2"))
+# Rebuild là bước bảo trì OFFLINE (tìm kiếm không khả dụng trong lúc rebuild). Mặc định chỉ ghi cảnh báo;
+# đặt "1" để ứng dụng/ingest.py tự rebuild khi cần (chấp nhận gián đoạn ngắn).
+AUTO_REBUILD = os.getenv("MILVUS_AUTO_REBUILD", "0") == "1"
+
+def _json_env(name: str) -> dict:
+    raw = os.getenv(name)
+    if not raw:
+        return {}
+    try:
+        value = json.loads(raw)
+    except ValueError:
+        raise ValueError(f"❌ Biến môi trường {name} phải là JSON hợp lệ, nhận được: {raw!r}")
+    return value if isinstance(value, dict) else {}
+
+def recommended_nlist(num_entities: int) -> int:
+    """
+    Số cụm khuyến nghị cho index IVF: khoảng 4·√N, làm tròn lên lũy thừa của 2,
+    giới hạn trong [16, 65536] theo ràng buộc của Milvus.
+    """
+    target = 4 * math.sqrt(max(num_entities, 1))
+    return int(min(65536, max(16, 2 ** math.ceil(math.log2(target)))))
+
+# --- III. CẤU HÌNH INDEX ---
+
+@dataclass
+class IndexSettings:
+    """Cấu hình index của trường embedding: loại index, metric, tham số build và search."""
+    index_type: str = "IVF_SQ8"
+    metric_type: str = "COSINE"
+    build_params: dict = field(default_factory=dict)
+    search_params: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_env(cls, defaults: Optional[dict] = None) -> "IndexSettings":
+        """
+        Đọc cấu hình từ biến môi trường, các giá trị thiếu lấy từ `defaults`
+        (thường là `embed_model.get_index_profile()`) rồi tới INDEX_PRESETS.
+          MILVUS_INDEX_TYPE    : HNSW | IVF_FLAT | IVF_SQ8 | FLAT
+          MILVUS_METRIC_TYPE   : L2 | IP | COSINE
+          MILVUS_INDEX_PARAMS  : JSON tham số build, ví dụ {"M": 32, "efConstruction": 256}
+          MILVUS_SEARCH_PARAMS : JSON tham số search, ví dụ {"ef": 128} hoặc {"nprobe": 32}
+        """
+        defaults = defaults or {}
+        index_type = os.getenv("MILVUS_INDEX_TYPE", defaults.get("index_type", cls.index_type)).upper()
+        if index_type not in INDEX_PRESETS:
+            raise ValueError(f"❌ Loại index không hỗ trợ: {index_type}. Chọn một trong {list(INDEX_PRESETS)}.")
+        metric_type = os.getenv("MILVUS_METRIC_TYPE", defaults.get("metric_type", cls.metric_type)).upper()
+        if metric_type not in METRICS:
+            raise ValueError(f"❌ Metric không hỗ trợ: {metric_type}. Chọn một trong {list(METRICS)}.")
+        preset = INDEX_PRESETS[index_type]
+        build = dict(preset["build"])
+        if defaults.get("index_type", "").upper() == index_type:
+            build.update(defaults.get("params", {}))
+        build.update(_json_env("MILVUS_INDEX_PARAMS"))
+        search = dict(preset["search"])
+        search.update(_json_env("MILVUS_SEARCH_PARAMS"))
+        return cls(index_type, metric_type, build, search)
+
+    def index_params(self, **overrides) -> dict:
+        """Tham số cho `Collection.create_index`."""
+        return {"index_type": self.index_type, "metric_type": self.metric_type,
+                "params": {**self.build_params, **overrides}}
+
+    def search_param(self) -> dict:
+        """Tham số cho `Collection.search` (hoặc `search_params` của vector store LangChain)."""
+        return {"metric_type": self.metric_type, "params": dict(self.search_params)}
+
+def search_params_for(collection, settings: Optional[IndexSettings] = None, k: int = 0) -> Optional[dict]:
+    """
+    Tham số search khớp với index THỰC TẾ đang có trên collection (loại index và metric),
+    bổ sung tham số search từ cấu hình. Trả về None nếu collection chưa có index.
+    `k`: số kết quả tối đa mỗi lần tìm; với HNSW, Milvus yêu cầu ef >= k nên ef được nâng lên tương ứng.
+    """
+    if not collection.indexes:
+        return None
+    settings = settings or IndexSettings.from_env()
+    params = collection.indexes[0].params
+    index_type = str(params.get("index_type", settings.index_type)).upper()
+    search = dict(INDEX_PRESETS.get(index_type, {}).get("search", {}))
+    if index_type == settings.index_type:
+        search.update(settings.search_params)
+    if index_type == "HNSW":
+        search["ef"] = max(int(search.get("ef", 0)), k)
+    return {"metric_type": params.get("metric_type", settings.metric_type), "params": search}
+
+# --- IV. XÂY DỰNG VÀ XÂY DỰNG LẠI INDEX ---
+
+_rebuild_lock = threading.Lock()
+
+def create_index(collection, settings: IndexSettings, field_name: str = "embedding"):
+    """Tạo index cho trường vector. Với IVF, nlist được điều chỉnh theo số bản ghi hiện có."""
+    overrides = {}
+    if settings.index_type.startswith("IVF") and collection.num_entities:
+        overrides["nlist"] = max(int(settings.build_params.get("nlist", 128)),
+                                 recommended_nlist(collection.num_entities))
+    collection.create_index(field_name, settings.index_params(**overrides))
+
+def _current_index(collection) -> Optional[dict]:
+    """Đọc cấu hình index hiện tại của collection: loại index, metric và tham số build."""
+    if not collection.indexes:
+        return None
+    params = collection.indexes[0].params
+    build = params.get("params", {})
+    if isinstance(build, str):
+        build = json.loads(build)
+    return {"index_type": str(params.get("index_type", "")).upper(),
+            "metric_type": params.get("metric_type"), "params": dict(build)}
+
+def needs_rebuild(collection) -> Optional[int]:
+    """
+    Kiểm tra index IVF có còn phù hợp với kích thước dữ liệu không.
+    Trả về nlist mới nếu dữ liệu đã vượt xa khoảng mà nlist hiện tại được thiết kế, ngược lại None.
+    """
+    current = _current_index(collection)
+    if current is None or not current["index_type"].startswith("IVF"):
+        return None
+    nlist = int(current["params"].get("nlist", 128))
+    target = recommended_nlist(collection.num_entities)
+    return target if target >= nlist * REBUILD_GROWTH_FACTOR else None
+
+def rebuild_index(collection, field_name: str = "embedding") -> bool:
+    """
+    Bước bảo trì OFFLINE: xây dựng lại index (giữ nguyên loại index và metric) khi dữ liệu đã tăng
+    vượt khoảng mà `nlist` được chọn. Collection bị release trong lúc rebuild nên tìm kiếm tạm thời
+    không khả dụng; nên chạy ngoài giờ, ví dụ `python ingest.py <nguồn> --rebuild-index`.
+    Nếu tạo index mới thất bại, index cũ được tạo lại; collection luôn được load lại.
+
+    Returns:
+        bool: True nếu đã rebuild.
+    """
+    new_nlist = needs_rebuild(collection)
+    if new_nlist is None or not _rebuild_lock.acquire(blocking=False):
+        return False
+    try:
+        previous = _current_index(collection)
+        index_params = {**previous, "params": {**previous["params"], "nlist": new_nlist}}
+        logger.info(f"🔧 Rebuild index '{collection.name}': {collection.num_entities} bản ghi -> nlist={new_nlist}")
+        collection.release()
+        dropped = False
+        try:
+            collection.drop_index()
+            dropped = True
+            collection.create_index(field_name, index_params)
+        except Exception:
+            logger.error(f"❌ Rebuild index '{collection.name}' thất bại, khôi phục index cũ.", exc_info=True)
+            if dropped:
+                if collection.indexes:
+                    collection.drop_index()  # Index mới tạo dở.
+                collection.create_index(field_name, previous)
+            return False
+        finally:
+            collection.load()
+        logger.info("✅ Rebuild index hoàn tất.")
+        return True
+    finally:
+        _rebuild_lock.release()
+
+def maybe_rebuild_index(collection, field_name: str = "embedding") -> bool:
+    """
+    Gọi sau mỗi lần chèn dữ liệu. Chỉ rebuild khi MILVUS_AUTO_REBUILD=1; mặc định chỉ ghi cảnh báo
+    để quản trị viên chạy `rebuild_index` như một bước bảo trì offline.
+
+    Returns:
+        bool: True nếu đã rebuild.
+    """
+    if AUTO_REBUILD:
+        return rebuild_index(collection, field_name)
+    new_nlist = needs_rebuild(collection)
+    if new_nlist is not None:
+        logger.warning(f"⚠️ Index '{collection.name}' nên được rebuild (nlist={new_nlist}): "
+                       f"chạy `python ingest.py <nguồn> --rebuild-index` ngoài giờ hoặc đặt MILVUS_AUTO_REBUILD=1.")
+    return False
@@ -5,21 +5,32 @@
 
 import os  # Thư viện tương tác với hệ điều hành, thường dùng để quản lý biến môi trường.
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder # Các thành phần để xây dựng prompt cho chatbot.
-from langchain_core.tools import tool # Decorator để biến một hàm Python thành một "công cụ" mà LLM có thể sử dụng.
 from langchain.agents import create_tool_calling_agent, AgentExecutor # Các hàm chính để tạo ra agent và thực thi nó.
 from langchain_ollama import ChatOllama # Lớp để tương tác với các mô hình ngôn ngữ lớn (LLM) chạy cục bộ qua Ollama.
 from langchain_community.tools.tavily_search import TavilySearchResults # Công cụ tìm kiếm web tích hợp sẵn.
 import json # Thư viện để làm việc với dữ liệu định dạng JSON.
+import time # Ghi thời điểm của từng sự kiện trong dấu vết (trace) của agent.
+from langchain_core.callbacks import BaseCallbackHandler # Lớp cơ sở để nhận sự kiện có cấu trúc từ agent.
 from typing import Literal, Optional # Thư viện để định nghĩa kiểu dữ liệu, giúp LLM hiểu rõ hơn về các tham số của công cụ.
 
 # Import các hàm công cụ được định nghĩa riêng trong file custom_tools.py.
 # Việc tách các công cụ ra file riêng giúp mã nguồn gọn gàng và dễ quản lý.
-from custom_tools import get_vietnam_current_time, calculator, get_invoice_report, filter_invoices
+from custom_tools import get_vietnam_current_time, calculator, get_invoice_report, aggregate_invoices, filter_invoices, search_invoices, fake_web_search, unavailable_web_search
+# Chạy song song các công cụ trong một bước của agent, giới hạn thời gian và ghi nhớ kết quả.
+from tool_runtime import ToolRuntime
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Công cụ tìm kiếm web: "tavily" (Internet, cần TAVILY_API_KEY) hoặc "fake" (dữ liệu giả lập, chạy offline).
+WEB_SEARCH_BACKEND = os.getenv("WEB_SEARCH_BACKEND", "tavily")
+# Thời gian tối đa (giây) cho một lần tìm kiếm web.
+WEB_SEARCH_TIMEOUT_S = float(os.getenv("WEB_SEARCH_TIMEOUT_S", "15"))
 
 # --- II. HÀM TẠO AGENT ---
 # Hàm này đóng gói toàn bộ logic để khởi tạo và cấu hình agent.
 
-def create_chat_agent_executor(retriever, llm_model_name="llama3.2:latest"):
+def create_chat_agent_executor(retriever, llm_model_name="llama3.2:latest", all_docs=None, snapshot=None, search_retriever=None):
     """
     Hàm chính để tạo ra một AgentExecutor.
     AgentExecutor là một vòng lặp chạy agent, nhận đầu vào của người dùng, quyết định công cụ nào cần gọi,
@@ -29,6 +40,12 @@ def create_chat_agent_executor(retriever, llm_model_name="llama3.2:latest"):
         retriever: Một đối tượng retriever (ví dụ: từ một vector store) có khả năng truy xuất các tài liệu liên quan.
                    Nó được dùng để lấy toàn bộ dữ liệu hóa đơn làm ngữ cảnh.
         llm_model_name (str): Tên của mô hình LLM sẽ được sử dụng thông qua Ollama.
+        all_docs (list, optional): Danh sách hóa đơn đã được lấy sẵn (ví dụ: từ cache dùng chung của process).
+                   Nếu bỏ trống, hàm sẽ tự lấy từ `retriever`.
+        snapshot (InvoiceSnapshot, optional): Snapshot hóa đơn cập nhật tăng dần. Nếu có, các công cụ
+                   đọc danh sách hóa đơn mới nhất từ snapshot ở MỖI lần gọi thay vì một danh sách cố định.
+        search_retriever (HybridRetriever, optional): Retriever lai (vector + BM25). Nếu có, agent có thêm công cụ
+                   `search_invoices_with_context` để tra cứu hóa đơn theo mã, số điện thoại, số tiền trong một lần top-k.
 
     Returns:
         AgentExecutor: Một đối tượng agent đã được cấu hình và sẵn sàng để sử dụng.
@@ -41,26 +58,54 @@ def create_chat_agent_executor(retriever, llm_model_name="llama3.2:latest"):
     # 2. Lấy ngữ cảnh (Context) từ Retriever
     # Lấy tất cả các tài liệu (hóa đơn) từ retriever.
     # Truyền một chuỗi rỗng `""` để ra hiệu rằng chúng ta muốn lấy tất cả các tài liệu có liên quan.
-    all_docs = retriever.get_relevant_documents("")
+    # Nếu đã có danh sách hóa đơn được cache sẵn thì dùng lại, không truy vấn Milvus thêm lần nữa.
+    # Với snapshot, danh sách được lấy lại ở mỗi lần gọi công cụ để thấy các hóa đơn vừa được lưu.
+    if snapshot is not None:
+        get_docs = snapshot.documents
+        runtime = ToolRuntime(state_fn=snapshot.state_key)  # Kết quả ghi nhớ theo trạng thái snapshot.
+    else:
+        if all_docs is None:
+            all_docs = retriever.get_relevant_documents("")
+        get_docs = lambda: all_docs
+        runtime = ToolRuntime()  # Danh sách hóa đơn cố định: kết quả luôn dùng lại được.
 
     # 3. Bọc (Wrap) các công cụ với ngữ cảnh
     # Mục đích của việc bọc lại là để "tiêm" (inject) biến `all_docs` vào các hàm công cụ gốc.
     # Điều này cho phép các công cụ truy cập vào dữ liệu hóa đơn mà không cần truyền `all_docs` mỗi lần gọi.
     # LLM sẽ chỉ thấy phiên bản đã được bọc này.
+    # `runtime.tool` thay cho `@tool`: công cụ chạy trong thread pool, có giới hạn thời gian, và các công cụ
+    # hóa đơn thuần túy (`memoize=True`) được ghi nhớ kết quả cho tới khi snapshot có hóa đơn mới.
 
-    @tool
+    @runtime.tool(memoize=True)
     def get_invoice_report_with_context(report_type: Literal['count', 'summarize', 'highest_value']) -> str:
         """(NỘI BỘ) Tạo báo cáo tổng quan về hóa đơn (đếm, tóm tắt, tìm giá trị cao nhất). Dùng khi cần thống kê chung."""
         # Gọi hàm gốc từ custom_tools và truyền vào ngữ cảnh `all_docs`.
-        return get_invoice_report.func(all_documents=all_docs, report_type=report_type)
+        return get_invoice_report.func(all_documents=get_docs(), report_type=report_type)
+
+    @runtime.tool(memoize=True)
+    def aggregate_invoices_with_context(
+        metric: Literal['count', 'sum', 'avg', 'min', 'max', 'top'] = 'sum',
+        group_by: Literal['none', 'store', 'payment_method', 'day', 'week', 'month'] = 'none',
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+        top_n: int = 10
+    ) -> str:
+        """(NỘI BỘ) Thống kê tiền hóa đơn: tổng, trung bình, nhỏ nhất, lớn nhất, top-N; nhóm theo cửa hàng, phương thức thanh toán, ngày, tuần, tháng; lọc theo khoảng ngày."""
+        return aggregate_invoices.func(all_documents=get_docs(), metric=metric, group_by=group_by,
+                                       date_from=date_from, date_to=date_to, top_n=top_n)
 
-    @tool
+    @runtime.tool(memoize=True)
     def filter_invoices_with_context(receipt_number: Optional[str] = None, total_amount: Optional[float] = None, item_name: Optional[str] = None) -> str:
         """(NỘI BỘ) Lọc và tìm kiếm hóa đơn theo các tiêu chí cụ thể như số hóa đơn, tổng tiền, hoặc tên mặt hàng."""
         # Gọi hàm gốc và truyền vào ngữ cảnh.
-        return filter_invoices.func(all_documents=all_docs, receipt_number=receipt_number, total_amount=total_amount, item_name=item_name)
+        return filter_invoices.func(all_documents=get_docs(), receipt_number=receipt_number, total_amount=total_amount, item_name=item_name)
 
-    @tool
+    @runtime.tool(memoize=True)
+    def search_invoices_with_context(query: str) -> str:
+        """(NỘI BỘ) Tìm các hóa đơn phù hợp nhất với một mã hóa đơn, số điện thoại, số tiền, tên cửa hàng hoặc mô tả tự do."""
+        return search_invoices.func(ranked_documents=search_retriever.invoke(query), query=query)
+
+    @runtime.tool(memoize=True)
     def calculator_with_context(expression: str) -> str:
         """Thực hiện các phép tính toán học đơn giản. Ví dụ: '2*3+5/2'."""
         # Mặc dù hàm calculator không cần `all_docs`, việc bọc nó theo cùng một mẫu giúp mã nhất quán.
@@ -71,18 +116,32 @@ def create_chat_agent_executor(retriever, llm_model_name="llama3.2:latest"):
     # Lý do: Nó là một công cụ độc lập, không cần truy cập vào ngữ cảnh `all_docs`.
     # Việc giữ nó ở dạng nguyên bản giúp LLM phân biệt rõ ràng giữa các công cụ cần dữ liệu nội bộ và các công cụ không cần.
     
-    # Khởi tạo công cụ tìm kiếm web
-    web_search_tool = TavilySearchResults(name="web_search", description="(INTERNET) Tìm kiếm thông tin trên Internet về thị trường, tin tức, kiến thức chung.")
+    # Khởi tạo công cụ tìm kiếm web (chạy bất đồng bộ trên event loop, không chiếm luồng của pool).
+    # Dữ liệu giả lập CHỈ dùng khi chọn rõ WEB_SEARCH_BACKEND=fake; thiếu API key thì công cụ báo lỗi "không khả dụng"
+    # để agent không trình bày dữ liệu giả như kết quả thật.
+    if WEB_SEARCH_BACKEND == "fake":
+        web_search_tool = runtime.wrap_async(fake_web_search, timeout=WEB_SEARCH_TIMEOUT_S)
+    elif not os.getenv("TAVILY_API_KEY"):
+        logger.warning("Không có TAVILY_API_KEY: công cụ tìm kiếm web không khả dụng.")
+        web_search_tool = runtime.wrap_async(unavailable_web_search, timeout=WEB_SEARCH_TIMEOUT_S)
+    else:
+        web_search_tool = runtime.wrap_async(
+            TavilySearchResults(name="web_search", description="(INTERNET) Tìm kiếm thông tin trên Internet về thị trường, tin tức, kiến thức chung."),
+            timeout=WEB_SEARCH_TIMEOUT_S,
+        )
     
     # 4. Tạo danh sách công cụ cuối cùng cho Agent
     # Đây là danh sách tất cả các "năng lực" mà agent có thể sử dụng.
     tools = [
         calculator_with_context,          # Công cụ tính toán
         get_invoice_report_with_context,  # Công cụ báo cáo hóa đơn
+        aggregate_invoices_with_context,  # Công cụ thống kê, nhóm hóa đơn
         filter_invoices_with_context,     # Công cụ lọc hóa đơn
         get_vietnam_current_time,         # Công cụ lấy giờ Việt Nam (dùng trực tiếp)
         web_search_tool                   # Công cụ tìm kiếm web
     ]
+    if search_retriever is not None:
+        tools.insert(4, search_invoices_with_context)  # Công cụ tìm kiếm lai (vector + BM25)
 
     # 5. Thiết kế System Prompt - "Bộ não" của Agent
     # Đây là phần quan trọng nhất, định hình tính cách, quy tắc và quy trình ra quyết định của agent.
@@ -94,7 +153,9 @@ def create_chat_agent_executor(retriever, llm_model_name="llama3.2:latest"):
     - `get_vietnam_current_time`: Dùng khi hỏi về giờ. **CÔNG CỤ NÀY KHÔNG CÓ THAM SỐ.** Bạn phải gọi nó mà không có bất kỳ tham số nào.
     - `calculator_with_context`: Dùng cho phép tính. Có 1 tham số là `expression`.
     - `get_invoice_report_with_context`: Dùng cho báo cáo hóa đơn. Có 1 tham số là `report_type` ('count', 'summarize', 'highest_value').
+    - `aggregate_invoices_with_context`: Dùng cho thống kê tiền hóa đơn. Tham số: `metric` ('count', 'sum', 'avg', 'min', 'max', 'top'), `group_by` ('none', 'store', 'payment_method', 'day', 'week', 'month'), `date_from`, `date_to` (YYYY-MM-DD hoặc YYYY-MM), `top_n`.
     - `filter_invoices_with_context`: Dùng để lọc hóa đơn. Có các tham số tùy chọn (`receipt_number`, `total_amount`, `item_name`).
+    - `search_invoices_with_context` (nếu có): Dùng để tìm hóa đơn. Có 1 tham số là `query` (mã hóa đơn, số điện thoại, số tiền, tên cửa hàng hoặc mô tả).
     - `web_search`: Dùng cho thông tin thị trường/Internet.
 
     **QUY TRÌNH RA QUYẾT ĐỊNH (THEO THỨ TỰ ƯU TIÊN):**
@@ -102,9 +163,11 @@ def create_chat_agent_executor(retriever, llm_model_name="llama3.2:latest"):
     1.  **TOÁN HỌC?** -> Nếu câu hỏi là một phép tính, hãy dùng `calculator_with_context`.
     2.  **GIỜ GIẤC?** -> Nếu câu hỏi về thời gian hiện tại, hãy dùng `get_vietnam_current_time`. **KHÔNG ĐƯỢC TRUYỀN BẤT KỲ THAM SỐ NÀO VÀO CÔNG CỤ NÀY.**
     3.  **LỌC HÓA ĐƠN CỤ THỂ?** -> Nếu câu hỏi chứa tiêu chí lọc cụ thể (số hóa đơn, số tiền, tên hàng), hãy dùng `filter_invoices_with_context`.
+        - Nếu có `search_invoices_with_context`: dùng nó khi cần TÌM một hóa đơn theo mã, số điện thoại, số tiền, tên cửa hàng hoặc mô tả tự do (không cần khớp chính xác tuyệt đối), truyền nguyên cụm cần tìm vào `query`.
     4.  **BÁO CÁO HÓA ĐƠN?** -> Nếu câu hỏi mang tính thống kê, tổng hợp về hóa đơn:
         - Chứa từ "bao nhiêu", "số lượng" -> Dùng `get_invoice_report_with_context` với `report_type='count'`.
         - Chứa từ "cao nhất", "lớn nhất" -> Dùng `get_invoice_report_with_context` với `report_type='highest_value'`.
+        - Hỏi tổng tiền, chi tiêu trung bình, theo cửa hàng/phương thức thanh toán, theo ngày/tuần/tháng hoặc trong một khoảng thời gian -> Dùng `aggregate_invoices_with_context`.
         - Các câu hỏi chung chung khác như "tóm tắt", "thông tin các hóa đơn" -> Dùng `get_invoice_report_with_context` với `report_type='summarize'`.
     5.  **CÒN LẠI?** -> Nếu câu hỏi không thuộc các trường hợp trên (ví dụ: hỏi về tin tức, thị trường, kiến thức chung), hãy dùng `web_search`. Nếu là chào hỏi đơn thuần, hãy trả lời trực tiếp.
 
@@ -128,6 +191,81 @@ def create_chat_agent_executor(retriever, llm_model_name="llama3.2:latest"):
     agent = create_tool_calling_agent(llm, tools, prompt)
 
     # 8. Tạo và trả về AgentExecutor
-    # AgentExecutor chịu trách nhiệm thực thi agent. Nó nhận agent, danh sách công cụ,
-    # và cờ `verbose=True` để in ra các bước suy nghĩ của agent trong quá trình chạy, rất hữu ích cho việc gỡ lỗi.
-    return AgentExecutor(agent=agent, tools=tools, verbose=True)
\ No newline at end of file
+    # AgentExecutor chịu trách nhiệm thực thi agent. Nó nhận agent và danh sách công cụ.
+    # Không dùng `verbose=True` (in ra stdout dùng chung của process): các bước suy nghĩ của agent
+    # được thu thập qua `AgentTraceHandler`, riêng cho từng lượt chat.
+    return AgentExecutor(agent=agent, tools=tools)
+
+# --- III. THEO DÕI VÀ STREAMING KẾT QUẢ CỦA AGENT ---
+
+class AgentTraceHandler(BaseCallbackHandler):
+    """
+    Callback thu thập dấu vết có cấu trúc của MỘT lượt chạy agent (công cụ được gọi, tham số, kết quả, lỗi).
+    Mỗi lượt chat tạo một handler riêng và truyền qua `config`, nên an toàn khi nhiều session chạy song song
+    (khác với việc chuyển hướng stdout toàn cục).
+    """
+
+    def __init__(self, max_output_chars: int = 2000):
+        self.events = []
+        self.max_output_chars = max_output_chars
+        self._start = time.perf_counter()
+
+    def _add(self, kind: str, **data):
+        self.events.append({"type": kind, "t": round(time.perf_counter() - self._start, 3), **data})
+
+    def on_agent_action(self, action, **kwargs):
+        self._add("action", tool=action.tool, input=action.tool_input)
+
+    def on_tool_end(self, output, **kwargs):
+        self._add("tool_end", tool=kwargs.get("name"), output=str(output)[:self.max_output_chars])
+
+    def on_tool_error(self, error, **kwargs):
+        self._add("tool_error", tool=kwargs.get("name"), error=str(error))
+
+    def on_llm_error(self, error, **kwargs):
+        self._add("llm_error", error=str(error))
+
+    def on_agent_finish(self, finish, **kwargs):
+        self._add("finish", output=finish.return_values.get("output"))
+
+    def format(self) -> str:
+        """Hiển thị dấu vết dưới dạng văn bản dễ đọc."""
+        lines = []
+        for e in self.events:
+            if e["type"] == "action":
+                lines.append(f"[{e['t']:.2f}s] 🔧 Gọi `{e['tool']}` với {json.dumps(e['input'], ensure_ascii=False, default=str)}")
+            elif e["type"] == "tool_end":
+                lines.append(f"[{e['t']:.2f}s] 📤 Kết quả: {e['output']}")
+            elif e["type"] in ("tool_error", "llm_error"):
+                lines.append(f"[{e['t']:.2f}s] ❌ Lỗi: {e['error']}")
+            elif e["type"] == "finish":
+                lines.append(f"[{e['t']:.2f}s] ✅ Hoàn tất.")
+        return "\n".join(lines) or "(Agent trả lời trực tiếp, không gọi công cụ.)"
+
+async def stream_agent_events(agent_executor, inputs: dict, trace_handler: Optional[AgentTraceHandler] = None):
+    """
+    Chạy agent bất đồng bộ và phát ra các sự kiện NGAY KHI chúng xảy ra (qua `astream_events`):
+    - {"type": "llm_start"}: LLM bắt đầu một bước mới (văn bản của bước trước chỉ là suy nghĩ trung gian).
+    - {"type": "token", "text": ...}: từng token do LLM sinh ra.
+    - {"type": "tool_start", "tool": ..., "input": ...} / {"type": "tool_end", "tool": ..., "output": ...}
+    - {"type": "final", "output": ...}: câu trả lời cuối cùng của agent.
+    """
+    config = {"callbacks": [trace_handler]} if trace_handler else {}
+    async for event in agent_executor.astream_events(inputs, config=config, version="v2"):
+        kind = event["event"]
+        if kind == "on_chat_model_start":
+            yield {"type": "llm_start"}
+        elif kind == "on_chat_model_stream":
+            content = event["data"]["chunk"].content
+            if isinstance(content, list):
+                content = "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+            if content:
+                yield {"type": "token", "text": content}
+        elif kind == "on_tool_start":
+            yield {"type": "tool_start", "tool": event["name"], "input": event["data"].get("input")}
+        elif kind == "on_tool_end":
+            yield {"type": "tool_end", "tool": event["name"], "output": str(event["data"].get("output"))}
+        elif kind == "on_chain_end" and event["name"] == "AgentExecutor" and not event.get("parent_ids"):
+            output = event["data"].get("output")
+            if isinstance(output, dict):
+                yield {"type": "final", "output": output.get("output")}
\ No newline at end of file
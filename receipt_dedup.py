@@ -0,0 +1,357 @@
+# file: receipt_dedup.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os
+import re
+import json
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import cv2  # Cắt, làm phẳng ảnh hóa đơn và tính DCT cho perceptual hash.
+
+import collection_events  # Epoch của collection: collection bị tạo lại thì chỉ mục trùng lặp cũng mất hiệu lực.
+from invoice_analytics import parse_amount, parse_datetime  # Chuẩn hóa số tiền và ngày giờ trên hóa đơn.
+
+# --- II. CẤU HÌNH ---
+# Cùng một hóa đơn thường bị chụp hai lần ở góc hơi khác nhau: so sánh byte không phát hiện được,
+# nên bản trùng phải trả đủ chi phí OCR + sửa lỗi + LLM rồi làm sai lệch các báo cáo tổng hợp.
+# Mỗi ảnh được tính perceptual hash (pHash 64 bit) trên vùng hóa đơn đã cắt và chuẩn hóa, rồi tra trong
+# BK-tree theo khoảng cách Hamming. Ảnh giống nhau chưa chắc là cùng hóa đơn (cùng cửa hàng, cùng mẫu in),
+# nên mọi ứng viên đều được xác nhận bằng mã hóa đơn, ngày giờ và tổng tiền:
+# - Rất gần (<= DEDUP_STRICT_DISTANCE): chỉ OCR nhanh một lượt rồi tìm các giá trị đó trong văn bản;
+#   mã hóa đơn đã lưu BẮT BUỘC có trong văn bản (cùng đủ số trường khớp) thì mới dừng pipeline ngay, bỏ qua
+#   sửa lỗi và LLM. Hóa đơn đã lưu không có mã thì không dừng sớm mà xác nhận ở bước sau.
+# - Gần (<= DEDUP_LOOSE_DISTANCE): chạy pipeline bình thường, so sánh các trường đã trích xuất; khớp thì không chèn.
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+DEDUP_STRICT_DISTANCE = int(os.getenv("DEDUP_STRICT_DISTANCE", "6"))
+DEDUP_LOOSE_DISTANCE = int(os.getenv("DEDUP_LOOSE_DISTANCE", "14"))
+# Số trường (mã hóa đơn, ngày giờ, tổng tiền) tối thiểu phải khớp để coi là cùng một hóa đơn.
+DEDUP_MIN_FIELD_MATCHES = int(os.getenv("DEDUP_MIN_FIELD_MATCHES", "2"))
+DEDUP_STATE_DIR = os.path.join(os.getenv("INVOICE_STATE_DIR", ".invoice_state"), "dedup")
+
+_HASH_SIZE = 8  # pHash: 8x8 hệ số DCT tần số thấp -> 64 bit.
+_DCT_SIZE = 32
+_MIN_RECEIPT_AREA = 0.2  # Vùng hóa đơn phải chiếm ít nhất 20% ảnh, nếu không dùng cả ảnh.
+
+# --- III. PERCEPTUAL HASH ---
+
+def _order_corners(pts: np.ndarray) -> np.ndarray:
+    """Sắp 4 góc theo thứ tự: trên-trái, trên-phải, dưới-phải, dưới-trái."""
+    s, d = pts.sum(axis=1), np.diff(pts, axis=1).ravel()
+    return np.array([pts[np.argmin(s)], pts[np.argmin(d)], pts[np.argmax(s)], pts[np.argmax(d)]], dtype=np.float32)
+
+def normalize_receipt(image: np.ndarray) -> np.ndarray:
+    """
+    Cắt vùng hóa đơn (tờ giấy sáng trên nền tối hơn), xoay thẳng, dựng đứng và cân bằng độ sáng.
+    Nếu không tìm được vùng đủ lớn thì dùng cả ảnh.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # Làm việc trên ảnh nhỏ: đủ để tìm đường viền, nhanh hơn nhiều với ảnh chụp từ điện thoại.
+    scale = 800 / max(gray.shape)
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else gray
+    blurred = cv2.GaussianBlur(small, (5, 5), 0)
+    mask = cv2.threshold(blurred, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15)))
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    receipt = small
+    if contours:
+        largest = max(contours, key=cv2.contourArea)
+        if cv2.contourArea(largest) >= _MIN_RECEIPT_AREA * small.size:
+            (_, _), (w, h), _ = rect = cv2.minAreaRect(largest)
+            w, h = max(int(w), 1), max(int(h), 1)
+            src = _order_corners(cv2.boxPoints(rect))
+            dst = np.array([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]], dtype=np.float32)
+            receipt = cv2.warpPerspective(small, cv2.getPerspectiveTransform(src, dst), (w, h))
+    if receipt.shape[1] > receipt.shape[0]:
+        # Hóa đơn luôn dài hơn rộng; ảnh chụp ngang thì xoay lại.
+        receipt = cv2.rotate(receipt, cv2.ROTATE_90_CLOCKWISE)
+    return cv2.equalizeHist(receipt)
+
+def phash(image: np.ndarray) -> int:
+    """pHash 64 bit: DCT của ảnh 32x32, so sánh 8x8 hệ số tần số thấp (bỏ hệ số DC) với trung vị."""
+    small = cv2.resize(image, (_DCT_SIZE, _DCT_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:_HASH_SIZE, :_HASH_SIZE].ravel()
+    bits = low > np.median(low[1:])
+    return int("".join("1" if b else "0" for b in bits), 2)
+
+def image_hash(image_path: str) -> Optional[int]:
+    """Perceptual hash của ảnh hóa đơn; None nếu không đọc được ảnh."""
+    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if image is None or not image.size:
+        return None
+    return phash(normalize_receipt(image))
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+# --- IV. BK-TREE ---
+
+class BKTree:
+    """
+    Cây BK theo khoảng cách Hamming: tìm mọi hash trong bán kính r mà không phải so với toàn bộ chỉ mục
+    (bất đẳng thức tam giác loại bỏ các nhánh có khoảng cách tới nút ngoài [d - r, d + r]).
+    """
+
+    def __init__(self):
+        self._root = None  # Nút: [hash, danh sách phần tử, {khoảng cách: nút con}]
+        self.size = 0
+
+    def add(self, h: int, item):
+        self.size += 1
+        if self._root is None:
+            self._root = [h, [item], {}]
+            return
+        node = self._root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, [item], {}]
+                return
+            node = child
+
+    def search(self, h: int, radius: int) -> List[Tuple[int, object]]:
+        """Các phần tử có hash cách `h` không quá `radius` bit, sắp theo khoảng cách tăng dần."""
+        found, stack = [], [self._root] if self._root else []
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius:
+                found.extend((d, item) for item in node[1])
+            stack.extend(child for dist, child in node[2].items() if d - radius <= dist <= d + radius)
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+# --- V. XÁC NHẬN BẰNG CÁC TRƯỜNG CỦA HÓA ĐƠN ---
+
+def _normalize_code(value) -> str:
+    """Mã hóa đơn chỉ gồm chữ và số; gộp các ký tự OCR hay nhầm (O/0, I/l/1)."""
+    s = re.sub(r"[^0-9a-z]", "", str(value or "").lower())
+    return s.translate(str.maketrans("oil", "011"))
+
+def fingerprint(data: dict) -> dict:
+    """Các trường dùng để xác nhận trùng lặp: mã hóa đơn, ngày giờ (ISO) và tổng tiền."""
+    dt = parse_datetime(data.get("receipt_datetime"))
+    total = parse_amount(data.get("total_amount"))
+    if total is None:
+        total = parse_amount(data.get("paid_amount"))
+    return {
+        "receipt_number": _normalize_code(data.get("receipt_number")) or None,
+        "receipt_datetime": dt.isoformat(timespec="minutes") if dt else None,
+        "total": total,
+    }
+
+def same_receipt(a: dict, b: dict) -> bool:
+    """Hai fingerprint là cùng một hóa đơn: không trường nào mâu thuẫn và đủ số trường khớp."""
+    matches = 0
+    for name in ("receipt_number", "receipt_datetime", "total"):
+        x, y = a.get(name), b.get(name)
+        if x is None or y is None:
+            continue
+        equal = abs(x - y) < 1 if name == "total" else x == y
+        if not equal:
+            return False
+        matches += 1
+    return matches >= DEDUP_MIN_FIELD_MATCHES
+
+def text_mentions(text: str, fp: dict) -> int:
+    """Số trường của fingerprint xuất hiện trong văn bản OCR thô (dùng cho lượt xác nhận nhanh)."""
+    matches = 0
+    code = fp.get("receipt_number")
+    if code and len(code) >= 3 and code in _normalize_code(text):
+        matches += 1
+    if fp.get("receipt_datetime"):
+        target = parse_datetime(fp["receipt_datetime"])
+        for raw in re.findall(r"\d{1,4}[/\-.]\d{1,2}[/\-.]\d{2,4}", text):
+            dt = parse_datetime(raw.replace(".", "/"))
+            if dt and target and dt.date() == target.date():
+                matches += 1
+                break
+    if fp.get("total") is not None:
+        amounts = (parse_amount(raw) for raw in re.findall(r"\d[\d.,]*\d|\d", text))
+        if any(a is not None and abs(a - fp["total"]) < 1 for a in amounts):
+            matches += 1
+    return matches
+
+def text_confirms(text: str, fp: dict) -> bool:
+    """
+    Văn bản OCR thô đủ để kết luận trùng mà không cần trích xuất: mã hóa đơn của fingerprint phải xuất hiện
+    trong văn bản. Chỉ đếm số tiền và ngày trùng thì dễ nhầm hai hóa đơn khác nhau cùng cửa hàng, cùng ngày,
+    cùng số tiền; trường hợp đó để bước so sánh trường (`same_receipt`, có loại trừ mâu thuẫn) quyết định.
+    """
+    code = fp.get("receipt_number")
+    if not code or len(code) < 3 or code not in _normalize_code(text):
+        return False
+    return text_mentions(text, fp) >= DEDUP_MIN_FIELD_MATCHES
+
+# --- VI. CHỈ MỤC TRÙNG LẶP (LƯU TRÊN ĐĨA) ---
+
+@dataclass
+class DuplicateMatch:
+    key: str  # Tên file (trường `filename` trong Milvus) của hóa đơn đã có.
+    distance: int
+    fingerprint: dict
+    stage: str  # "image" (dừng sớm sau OCR nhanh) hoặc "fields" (sau khi trích xuất).
+
+    def to_dict(self) -> dict:
+        return {"filename": self.key, "distance": self.distance, "stage": self.stage, **self.fingerprint}
+
+class DuplicateIndex:
+    """
+    Chỉ mục perceptual hash của các hóa đơn đã lưu trong một collection.
+
+    Lưu dạng JSONL chỉ ghi nối trong .invoice_state/dedup/<collection>.jsonl, dòng đầu ghi epoch của collection.
+    Nhiều process (FastAPI, ingest.py) cùng ghi một file; mỗi lần tra cứu đọc thêm các dòng mới của process khác.
+    Collection bị xóa và tạo lại (epoch đổi) thì chỉ mục được làm mới từ đầu.
+    """
+
+    def __init__(self, collection_name: str, path: Optional[str] = None):
+        self.collection_name = collection_name
+        self.path = path or os.path.join(DEDUP_STATE_DIR, f"{collection_name}.jsonl")
+        self._lock = threading.Lock()
+        self._epoch = None
+        self._offset = 0
+        self._tree = BKTree()
+        self._removed = set()
+        self.checks = 0
+        self.image_duplicates = 0
+        self.field_duplicates = 0
+        self.rejected_candidates = 0
+
+    def _reset(self, epoch: int):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"epoch": epoch}) + "\n")
+        self._epoch, self._offset = epoch, 0
+        self._tree, self._removed = BKTree(), set()
+
+    def _sync(self):
+        """Đọc các dòng mới (kể cả do process khác ghi); làm mới nếu collection đã được tạo lại."""
+        epoch = collection_events.get_version(self.collection_name)[0]
+        if epoch != self._epoch:
+            self._epoch, self._offset = None, 0
+            self._tree, self._removed = BKTree(), set()
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                if self._offset == 0:
+                    header = json.loads(f.readline() or "{}")
+                    if header.get("epoch") != epoch:
+                        raise FileNotFoundError
+                    self._epoch = epoch
+                else:
+                    f.seek(self._offset)
+                while line := f.readline():
+                    if not line.endswith("\n"):
+                        break  # Dòng đang được process khác ghi dở: đọc lại ở lần sau.
+                    self._apply(json.loads(line))
+                self._offset = f.tell()
+        except (FileNotFoundError, ValueError):
+            self._reset(epoch)
+
+    def _apply(self, record: dict):
+        if "remove" in record:
+            self._removed.add(record["remove"])
+        else:
+            self._removed.discard(record["key"])
+            self._tree.add(int(record["hash"], 16), (record["key"], record["fp"]))
+
+    def _append(self, record: dict):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def candidates(self, h: Optional[int], radius: int = None) -> List[Tuple[int, str, dict]]:
+        """Các hóa đơn đã lưu có hash gần `h`: danh sách (khoảng cách, key, fingerprint)."""
+        if h is None:
+            return []
+        with self._lock:
+            self._sync()
+            hits = self._tree.search(h, DEDUP_LOOSE_DISTANCE if radius is None else radius)
+            return [(d, key, fp) for d, (key, fp) in hits if key not in self._removed]
+
+    def add(self, key: str, h: Optional[int], data: dict):
+        """Ghi nhận một hóa đơn vừa được lưu."""
+        if h is None:
+            return
+        record = {"key": key, "hash": format(h, "016x"), "fp": fingerprint(data)}
+        with self._lock:
+            self._sync()
+            self._append(record)
+            self._sync()
+
+    def discard(self, keys: List[str]):
+        """Bỏ các hóa đơn khỏi chỉ mục (ví dụ: đã ghi nhận nhưng chèn vào Milvus thất bại)."""
+        with self._lock:
+            self._sync()
+            for key in keys:
+                self._append({"remove": key})
+            self._sync()
+
+    def record(self, stage: Optional[str], candidates: int):
+        """Thống kê một lần kiểm tra: `stage` của bản trùng ("image"/"fields"), None nếu không trùng."""
+        with self._lock:
+            self.checks += 1
+            if stage is None:
+                self.rejected_candidates += candidates
+            elif stage == "image":
+                self.image_duplicates += 1
+            else:
+                self.field_duplicates += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "collection": self.collection_name,
+                "indexed": self._tree.size - len(self._removed),
+                "checks": self.checks,
+                "duplicates_short_circuited": self.image_duplicates,
+                "duplicates_after_extraction": self.field_duplicates,
+                "rejected_candidates": self.rejected_candidates,
+                "strict_distance": DEDUP_STRICT_DISTANCE,
+                "loose_distance": DEDUP_LOOSE_DISTANCE,
+            }
+
+# --- VII. PIPELINE CÓ KIỂM TRA TRÙNG LẶP ---
+
+def match_fields(data: dict, candidates: List[Tuple[int, str, dict]]) -> Optional[DuplicateMatch]:
+    """Ứng viên đầu tiên (gần nhất) có cùng mã hóa đơn / ngày giờ / tổng tiền với dữ liệu đã trích xuất."""
+    fp = fingerprint(data)
+    for d, key, other in candidates:
+        if same_receipt(fp, other):
+            return DuplicateMatch(key, d, other, stage="fields")
+    return None
+
+def process_with_dedup(image_path: str, candidates: List[Tuple[int, str, dict]],
+                       process_fn: Callable[[str], Union[dict, str]],
+                       fast_text_fn: Callable[[str], str]) -> Tuple[Union[dict, str, None], Optional[DuplicateMatch]]:
+    """
+    Chạy pipeline cho một ảnh với các ứng viên trùng lặp đã tra từ chỉ mục.
+
+    Returns:
+        (dữ liệu, bản trùng). Khi dừng sớm ở lượt ảnh, dữ liệu là None (không chạy sửa lỗi và LLM).
+    """
+    strict = [c for c in candidates if c[0] <= DEDUP_STRICT_DISTANCE]
+    if strict:
+        text = fast_text_fn(image_path)
+        for d, key, fp in strict:
+            if text_confirms(text, fp):
+                return None, DuplicateMatch(key, d, fp, stage="image")
+    data = process_fn(image_path)
+    if isinstance(data, dict) and candidates:
+        return data, match_fields(data, candidates)
+    return data, None
+
+_indexes: Dict[str, DuplicateIndex] = {}
+_indexes_lock = threading.Lock()
+
+def get_duplicate_index(collection_name: str) -> DuplicateIndex:
+    """Chỉ mục dùng chung trong process cho một collection."""
+    with _indexes_lock:
+        if collection_name not in _indexes:
+            _indexes[collection_name] = DuplicateIndex(collection_name)
+        return _indexes[collection_name]
@@ -0,0 +1,326 @@
+# file: receipt_parser.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import re
+import json
+import threading  # Thống kê được cập nhật từ nhiều request song song.
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from invoice_analytics import parse_amount  # Hiểu số tiền kiểu Việt Nam: "1.250.000", "125.000 VND".
+
+# --- II. PARSE JSON TĂNG DẦN, CHỊU LỖI ---
+# Gemini đôi khi trả về JSON "gần đúng": bọc trong ```json```, có chú thích //, dấu phẩy thừa trước } hoặc ],
+# số có dấu chấm phân tách hàng nghìn (1.250.000), hoặc bị cắt ngang giữa chừng (hết token, mất kết nối).
+# Bộ parse dưới đây nhận từng đoạn văn bản khi model đang sinh (streaming), sửa các lỗi đó NGAY khi đọc,
+# và khi kết thúc chỉ cần đóng các ngoặc còn mở thay vì parse lại từ đầu.
+
+_BARE_TOKEN_CHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789.+-_")
+_BARE_LITERALS = {"None": "null", "True": "true", "False": "false", "NULL": "null", "Null": "null"}
+# Chỉ sửa số có từ hai nhóm trở lên ("1.250.000" không phải JSON hợp lệ); "1.500" vẫn là 1.5 hợp lệ.
+_DOTTED_THOUSANDS = re.compile(r"-?\d{1,3}(?:\.\d{3}){2,}")
+_CLOSERS = {"{": "}", "[": "]"}
+
+class StreamingJSONRepair:
+    """
+    Bộ đọc JSON tăng dần: `feed(chunk)` với từng đoạn văn bản, `result()` khi kết thúc.
+    - Bỏ qua mọi thứ trước dấu '{' đầu tiên và sau khi đối tượng gốc đã đóng (rào ```json, lời dẫn).
+    - Bỏ chú thích // và /* */, dấu phẩy thừa; đổi None/True/False và số "1.250.000" về JSON hợp lệ.
+    - Nếu văn bản bị cắt ngang: đóng chuỗi/ngoặc đang mở; nếu vẫn lỗi, lùi về phần tử hoàn chỉnh gần nhất.
+    """
+
+    def __init__(self):
+        self._out: List[str] = []
+        self._stack: List[str] = []
+        self._token: List[str] = []
+        self._cuts: List[Tuple[int, Tuple[str, ...]]] = []  # Các vị trí có thể cắt an toàn.
+        self._in_string = False
+        self._escape = False
+        self._comment: Optional[str] = None
+        self._comment_star = False
+        self._pending_slash = False
+        self.started = False
+        self.done = False
+        self.repaired = False  # Có phải sửa lỗi nào không (ngoài rào markdown).
+        self.truncated = False
+        self._raw: List[str] = []
+
+    @property
+    def raw_text(self) -> str:
+        """Toàn bộ văn bản đã nhận (để báo lỗi khi không thể khôi phục)."""
+        return "".join(self._raw)
+
+    def feed(self, chunk: str):
+        self._raw.append(chunk)
+        for ch in chunk:
+            self._step(ch)
+
+    def _step(self, ch: str):
+        if self.done:
+            return
+        if not self.started:
+            if ch == "{":
+                self.started = True
+                self._open(ch)
+            return
+        if self._comment == "//":
+            if ch == "\n":
+                self._comment = None
+                self._out.append(ch)
+            return
+        if self._comment == "/*":
+            if self._comment_star and ch == "/":
+                self._comment = None
+            self._comment_star = ch == "*"
+            return
+        if self._in_string:
+            self._out.append(ch)
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+            return
+        if self._pending_slash:
+            self._pending_slash = False
+            if ch in "/*":
+                self._flush_token()
+                self._comment = "//" if ch == "/" else "/*"
+                self._comment_star = False
+                self.repaired = True
+                return
+            self._out.append("/")
+        if ch == "/":
+            self._pending_slash = True
+            return
+        if ch in _BARE_TOKEN_CHARS:
+            self._token.append(ch)
+            return
+        self._flush_token()
+        if ch == '"':
+            self._in_string = True
+            self._out.append(ch)
+        elif ch in "{[":
+            self._open(ch)
+        elif ch in "}]":
+            self._close()
+        elif ch == ",":
+            self._cuts.append((len(self._out), tuple(self._stack)))
+            self._out.append(ch)
+        else:
+            self._out.append(ch)
+
+    def _open(self, ch: str):
+        self._stack.append(ch)
+        self._out.append(ch)
+        self._cuts.append((len(self._out), tuple(self._stack)))
+
+    def _close(self):
+        if self._strip_trailing_comma(self._out):
+            self.repaired = True
+        if not self._stack:
+            return
+        self._out.append(_CLOSERS[self._stack.pop()])  # Dùng đúng ngoặc đóng, kể cả khi model viết nhầm.
+        if not self._stack:
+            self.done = True
+
+    def _flush_token(self):
+        if not self._token:
+            return
+        token = "".join(self._token)
+        self._token = []
+        if token in _BARE_LITERALS:
+            token = _BARE_LITERALS[token]
+            self.repaired = True
+        elif _DOTTED_THOUSANDS.fullmatch(token):
+            token = token.replace(".", "")
+            self.repaired = True
+        self._out.append(token)
+
+    @staticmethod
+    def _strip_trailing_comma(out: List[str]) -> bool:
+        i = len(out) - 1
+        while i >= 0 and out[i].isspace():
+            i -= 1
+        if i >= 0 and out[i] == ",":
+            del out[i:]
+            return True
+        return False
+
+    @staticmethod
+    def _close_text(out: List[str], stack) -> str:
+        out = list(out)
+        StreamingJSONRepair._strip_trailing_comma(out)
+        text = "".join(out).rstrip()
+        if text.endswith(":"):
+            text += " null"  # Khóa đã có nhưng giá trị bị cắt mất.
+        return text + "".join(_CLOSERS[c] for c in reversed(stack))
+
+    def result(self) -> dict:
+        """
+        Kết thúc việc đọc và trả về đối tượng đã parse (có thể đã được sửa).
+
+        Raises:
+            ValueError: Không tìm thấy đối tượng JSON nào có thể khôi phục.
+        """
+        if not self.started:
+            raise ValueError("Không tìm thấy đối tượng JSON trong phản hồi.")
+        if self.done:
+            return json.loads("".join(self._out))
+        # Văn bản bị cắt ngang giữa chừng.
+        self.truncated = self.repaired = True
+        self._flush_token()
+        out = list(self._out)
+        if self._in_string:
+            out.append('"')
+        candidates = [(out, self._stack)] + [(self._out[:pos], stack) for pos, stack in reversed(self._cuts)]
+        for partial, stack in candidates:
+            try:
+                return json.loads(self._close_text(partial, stack))
+            except json.JSONDecodeError:
+                continue
+        raise ValueError("Không thể khôi phục JSON bị cắt ngang.")
+
+def parse_llm_json(text: str) -> Tuple[dict, StreamingJSONRepair]:
+    """Parse toàn bộ phản hồi một lần (không streaming). Trả về (đối tượng, bộ parse để xem cờ repaired/truncated)."""
+    parser = StreamingJSONRepair()
+    parser.feed(text)
+    return parser.result(), parser
+
+# --- III. LƯỢC ĐỒ HÓA ĐƠN VÀ KIỂM TRA KIỂU ---
+
+STRING_FIELDS = ("store_name", "website", "address", "payment_method", "receipt_number", "receipt_datetime", "staff_name")
+AMOUNT_FIELDS = ("total_amount", "discount_amount", "paid_amount", "customer_paid", "change")
+ALL_FIELDS = STRING_FIELDS + ("items",) + AMOUNT_FIELDS  # Thứ tự giống prompt.
+
+def parse_quantity(value) -> Optional[float]:
+    """Số lượng/trọng lượng: "0,5" hoặc "0.500" là số thập phân (khác với số tiền)."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    match = re.search(r"-?\d+(?:[.,]\d+)?", str(value))
+    return float(match.group(0).replace(",", ".")) if match else None
+
+def _normalize_number(value) -> Optional[float]:
+    """Bỏ phần thập phân .0 để giữ dạng số nguyên như Gemini vẫn trả về (125000 thay vì 125000.0)."""
+    return int(value) if isinstance(value, float) and value.is_integer() else value
+
+@dataclass
+class ValidationResult:
+    data: dict  # Dữ liệu đã chuẩn hóa (chỉ gồm các trường hợp lệ).
+    errors: Dict[str, str] = field(default_factory=dict)  # Trường lỗi -> lý do.
+
+def _validate_string(value) -> Tuple[Optional[str], Optional[str]]:
+    if value is None:
+        return None, None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value), None  # Ví dụ: receipt_number trả về dạng số.
+    if isinstance(value, str):
+        return (value.strip() or None), None
+    return None, f"phải là chuỗi hoặc null, nhận được {type(value).__name__}"
+
+def _validate_amount(value) -> Tuple[Optional[float], Optional[str]]:
+    if value is None or value == "":
+        return None, None
+    amount = parse_amount(value) if not isinstance(value, (dict, list)) else None
+    if amount is None:
+        return None, f"không phải số tiền hợp lệ: {value!r}"
+    return _normalize_number(amount), None
+
+def _validate_items(value) -> Tuple[list, Optional[str]]:
+    if value is None:
+        return [], None
+    if not isinstance(value, list):
+        return [], "phải là danh sách sản phẩm"
+    items, problems = [], []
+    for i, raw in enumerate(value):
+        if not isinstance(raw, dict) or not str(raw.get("name") or "").strip():
+            problems.append(f"sản phẩm #{i + 1} thiếu tên")
+            continue
+        item = {"name": str(raw["name"]).strip()}
+        qty = raw.get("quantity")
+        item["quantity"] = _normalize_number(parse_quantity(qty)) if qty not in (None, "") else None
+        for key in ("unit_price", "total_price"):
+            amount, error = _validate_amount(raw.get(key))
+            if error:
+                problems.append(f"sản phẩm #{i + 1}: {key} {error}")
+            item[key] = amount
+        items.append(item)
+    return items, ("; ".join(problems) or None)
+
+def validate_receipt(data: dict, required: Tuple[str, ...] = ALL_FIELDS) -> ValidationResult:
+    """
+    Kiểm tra và chuẩn hóa dữ liệu hóa đơn theo lược đồ trong prompt.
+    - Trường bị thiếu hẳn hoặc sai kiểu không chuyển được -> lỗi (sẽ được hỏi lại).
+    - Giá trị null là hợp lệ (thông tin không có trên hóa đơn).
+    - Số tiền dạng chuỗi kiểu Việt Nam ("1.250.000", "125.000đ") được chuyển thành số.
+    """
+    result = ValidationResult(data={})
+    if not isinstance(data, dict):
+        result.errors = {name: "không có trong phản hồi" for name in required}
+        return result
+    for name in required:
+        if name not in data:
+            result.errors[name] = "không có trong phản hồi"
+            continue
+        if name in STRING_FIELDS:
+            value, error = _validate_string(data[name])
+        elif name in AMOUNT_FIELDS:
+            value, error = _validate_amount(data[name])
+        else:
+            value, error = _validate_items(data[name])
+        result.data[name] = value
+        if error:
+            result.errors[name] = error
+    return result
+
+def suspect_field(data: dict, parser: StreamingJSONRepair) -> Optional[str]:
+    """Khi phản hồi bị cắt ngang, trường cuối cùng đọc được có thể chưa hoàn chỉnh."""
+    if parser.truncated and isinstance(data, dict) and data:
+        return list(data)[-1]
+    return None
+
+# --- IV. THỐNG KÊ ---
+
+class ExtractionStats:
+    """Đếm số hóa đơn phải sửa JSON / hỏi lại, và số token tiết kiệm được nhờ chỉ hỏi lại các trường lỗi."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.receipts = 0
+        self.repaired = 0
+        self.truncated = 0
+        self.retried = 0
+        self.fields_reasked = 0
+        self.failed = 0
+        self.tokens_used = 0
+        self.tokens_saved = 0
+
+    def record(self, *, repaired: bool, truncated: bool, reasked_fields: int, tokens_used: int,
+               tokens_saved: int, failed: bool):
+        with self._lock:
+            self.receipts += 1
+            self.repaired += int(repaired)
+            self.truncated += int(truncated)
+            self.retried += int(reasked_fields > 0)
+            self.fields_reasked += reasked_fields
+            self.failed += int(failed)
+            self.tokens_used += tokens_used
+            self.tokens_saved += tokens_saved
+
+    def report(self) -> dict:
+        with self._lock:
+            n = self.receipts or 1
+            return {
+                "receipts": self.receipts,
+                "repaired_rate": round(self.repaired / n, 3),
+                "truncated_rate": round(self.truncated / n, 3),
+                "retry_rate": round(self.retried / n, 3),
+                "fields_reasked": self.fields_reasked,
+                "failed": self.failed,
+                "tokens_used": self.tokens_used,
+                # So với việc gửi lại toàn bộ prompt trích xuất cho mỗi hóa đơn phải thử lại.
+                "tokens_saved": self.tokens_saved,
+            }
+
+extraction_stats = ExtractionStats()
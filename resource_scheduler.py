@@ -0,0 +1,259 @@
+# file: resource_scheduler.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os
+import sys
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# --- II. CẤU HÌNH ---
+# Tesseract (OpenMP), mô hình sửa lỗi (luồng intra-op của torch) và SentenceTransformer (embedding)
+# cùng chạy trong process FastAPI và mặc định đều dùng MỌI nhân. Khi nhiều ảnh được tải lên cùng lúc,
+# số luồng vượt xa số nhân và thông lượng sụp đổ. Bộ lập lịch chia các nhân thành ba nhóm riêng:
+# - "ocr":     nhiều worker, mỗi worker MỘT luồng (Tesseract chạy song song theo ảnh hiệu quả hơn theo luồng).
+# - "correct": một worker, số luồng torch = số nhân của nhóm (gom dòng thành batch như hiện tại).
+# - "embed":   một worker (luồng của embedding_service), số luồng torch = số nhân của nhóm.
+# Luồng đang chạy một bước được ghim (sched_setaffinity) vào các nhân của nhóm; tiến trình Tesseract con
+# kế thừa affinity của luồng gọi nó. Cách chia được điều chỉnh dần theo độ dài hàng đợi đo được của từng bước.
+
+STAGES = ("ocr", "correct", "embed")
+SCHED_ENABLED = os.getenv("SCHED_ENABLED", "1") == "1"
+# Danh sách nhân được dùng (ví dụ "0-7" hoặc "0,2,4,6"); mặc định: các nhân process được phép chạy.
+SCHED_CORES = os.getenv("SCHED_CORES", "")
+# Tỉ lệ chia ban đầu giữa các bước.
+SCHED_INITIAL_SPLIT = os.getenv("SCHED_INITIAL_SPLIT", "ocr=2,correct=1,embed=1")
+# Ghim luồng vào nhân (chỉ có trên Linux).
+SCHED_PIN = os.getenv("SCHED_PIN", "1") == "1"
+# Chu kỳ (giây) xem xét chia lại nhân; mỗi lần chỉ chuyển tối đa một nhân để tránh dao động.
+SCHED_REBALANCE_S = float(os.getenv("SCHED_REBALANCE_S", "5"))
+# Hệ số làm mượt (EWMA) cho độ dài hàng đợi và thời gian xử lý.
+SCHED_EWMA_ALPHA = float(os.getenv("SCHED_EWMA_ALPHA", "0.2"))
+
+_CAN_PIN = hasattr(os, "sched_setaffinity")
+
+def _parse_cores(spec: str) -> List[int]:
+    cores = []
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        if "-" in part:
+            lo, hi = part.split("-")
+            cores.extend(range(int(lo), int(hi) + 1))
+        else:
+            cores.append(int(part))
+    return sorted(set(cores))
+
+def available_cores() -> List[int]:
+    if SCHED_CORES:
+        return _parse_cores(SCHED_CORES)
+    if _CAN_PIN:
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def _parse_split(spec: str) -> Dict[str, float]:
+    weights = {stage: 1.0 for stage in STAGES}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        name, _, value = part.partition("=")
+        if name.strip() in weights:
+            weights[name.strip()] = max(float(value), 0.0)
+    return weights
+
+def split_cores(n: int, weights: Dict[str, float]) -> Dict[str, int]:
+    """Chia n nhân theo trọng số (phần dư lớn nhất), mỗi bước ít nhất một nhân."""
+    total = sum(weights.values()) or 1.0
+    spare = n - len(STAGES)
+    raw = {s: spare * weights[s] / total for s in STAGES}
+    counts = {s: 1 + int(raw[s]) for s in STAGES}
+    for s in sorted(STAGES, key=lambda s: raw[s] - int(raw[s]), reverse=True)[:n - sum(counts.values())]:
+        counts[s] += 1
+    return counts
+
+# --- III. THỐNG KÊ TỪNG BƯỚC ---
+
+class _StageState:
+    def __init__(self, name: str):
+        self.name = name
+        self.cores: List[int] = []
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.busy_s = 0.0
+        self.wait_s = 0.0
+        self.ewma_depth = 0.0
+        self.ewma_service_s = 0.0
+
+    @property
+    def permits(self) -> int:
+        # OCR: một worker một luồng cho mỗi nhân; sửa lỗi / embedding: một worker dùng cả nhóm nhân.
+        return max(1, len(self.cores)) if self.name == "ocr" else 1
+
+    @property
+    def threads(self) -> int:
+        return 1 if self.name == "ocr" else max(1, len(self.cores))
+
+    @property
+    def demand(self) -> float:
+        """Lượng việc tồn đọng ước tính (giây): độ dài hàng đợi × thời gian xử lý trung bình."""
+        return self.ewma_depth * max(self.ewma_service_s, 1e-3)
+
+# --- IV. BỘ LẬP LỊCH ---
+
+class CoreScheduler:
+    """
+    Chia nhân CPU giữa các bước OCR / sửa lỗi / embedding.
+
+    Dùng: `with scheduler.stage("ocr"): ...` quanh mỗi lần gọi một bước. Luồng gọi chờ tới khi bước còn
+    chỗ (số worker của bước), được ghim vào nhóm nhân của bước và đặt số luồng torch phù hợp, rồi được
+    trả lại affinity ban đầu khi xong. Khi `enabled=False`, chỉ đo đạc (hành vi mặc định của thư viện).
+
+    Lưu ý: số luồng torch (`torch.set_num_threads`) áp dụng cho luồng gọi với bản torch dùng OpenMP;
+    giới hạn chắc chắn là affinity, nên trên nền tảng không ghim được, bộ lập lịch chỉ giới hạn số worker.
+    """
+
+    def __init__(self, cores: Optional[List[int]] = None, weights: Optional[Dict[str, float]] = None,
+                 enabled: bool = SCHED_ENABLED, pin: bool = SCHED_PIN, rebalance_s: float = SCHED_REBALANCE_S):
+        self.cores = cores or available_cores()
+        self.enabled = enabled
+        self.pin = pin and _CAN_PIN
+        self.rebalance_s = rebalance_s
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._stages = {name: _StageState(name) for name in STAGES}
+        self._generation = 0
+        self._last_rebalance = time.monotonic()
+        self.rebalances = 0
+        # Quá ít nhân để chia: mọi bước dùng chung tất cả, không ghim, không chia lại.
+        self.partitioned = len(self.cores) >= len(STAGES)
+        if self.partitioned:
+            self._assign(split_cores(len(self.cores), weights or _parse_split(SCHED_INITIAL_SPLIT)))
+        else:
+            for state in self._stages.values():
+                state.cores = list(self.cores)
+
+    def _assign(self, counts: Dict[str, int]):
+        start = 0
+        for name in STAGES:
+            self._stages[name].cores = self.cores[start:start + counts[name]]
+            start += counts[name]
+        self._generation += 1
+
+    # -- Vào / ra một bước --
+
+    def _sample(self, state: _StageState):
+        a = SCHED_EWMA_ALPHA
+        state.ewma_depth = (1 - a) * state.ewma_depth + a * (state.waiting + state.running)
+
+    def _bind(self, state: _StageState):
+        """Ghim luồng hiện tại vào nhóm nhân của bước và đặt số luồng cho các thư viện bên dưới."""
+        if self.pin and self.partitioned:
+            os.sched_setaffinity(0, state.cores)  # pid 0 = luồng gọi (Linux).
+        if state.name == "ocr":
+            # Tesseract đọc biến này khi tiến trình con khởi động. Chỉ đặt lúc này (torch đã được nạp),
+            # để OpenMP của chính process này không bị giới hạn theo.
+            os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+        elif "torch" in sys.modules:
+            key = (state.name, state.threads)
+            if getattr(self._local, "torch_threads", None) != key:
+                sys.modules["torch"].set_num_threads(state.threads)
+                self._local.torch_threads = key
+
+    def _unbind(self, previous):
+        if previous is not None:
+            os.sched_setaffinity(0, previous)
+
+    @contextmanager
+    def stage(self, name: str):
+        state = self._stages[name]
+        queued = time.perf_counter()
+        with self._cond:
+            state.waiting += 1
+            self._sample(state)
+            while self.enabled and state.running >= state.permits:
+                self._cond.wait()
+            state.waiting -= 1
+            state.running += 1
+        started = time.perf_counter()
+        previous = None
+        try:
+            if self.enabled:
+                if self.pin and self.partitioned:
+                    previous = os.sched_getaffinity(0)
+                self._bind(state)
+            yield
+        finally:
+            self._unbind(previous)
+            elapsed = time.perf_counter() - started
+            with self._cond:
+                state.running -= 1
+                state.completed += 1
+                state.busy_s += elapsed
+                state.wait_s += started - queued
+                a = SCHED_EWMA_ALPHA
+                state.ewma_service_s = elapsed if state.completed == 1 else (1 - a) * state.ewma_service_s + a * elapsed
+                self._sample(state)
+                self._maybe_rebalance()
+                self._cond.notify_all()
+
+    def wrap(self, name: str, fn: Callable) -> Callable:
+        """Bọc một hàm để mọi lần gọi đều chạy trong bước `name`."""
+        def wrapped(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+        return wrapped
+
+    # -- Chia lại nhân theo hàng đợi --
+
+    def _maybe_rebalance(self):
+        """Chuyển một nhân từ bước thừa nhất sang bước thiếu nhất theo lượng việc tồn đọng (gọi khi giữ khóa)."""
+        now = time.monotonic()
+        if not (self.enabled and self.partitioned) or now - self._last_rebalance < self.rebalance_s:
+            return
+        self._last_rebalance = now
+        demand = {name: s.demand for name, s in self._stages.items()}
+        if sum(demand.values()) <= 0:
+            return
+        target = split_cores(len(self.cores), demand)
+        current = {name: len(s.cores) for name, s in self._stages.items()}
+        donor = max(STAGES, key=lambda s: current[s] - target[s])
+        receiver = max(STAGES, key=lambda s: target[s] - current[s])
+        if current[donor] - target[donor] < 1 or target[receiver] - current[receiver] < 1:
+            return
+        current[donor] -= 1
+        current[receiver] += 1
+        self._assign(current)
+        self.rebalances += 1
+        logger.info(f"Chia lại nhân: {donor} -> {receiver} ({current})")
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "enabled": self.enabled,
+                "pinned": self.pin and self.partitioned,
+                "cores": len(self.cores),
+                "rebalances": self.rebalances,
+                "stages": {
+                    name: {
+                        "cores": list(s.cores), "workers": s.permits, "threads_per_worker": s.threads,
+                        "waiting": s.waiting, "running": s.running, "completed": s.completed,
+                        "avg_service_ms": round(1000 * s.busy_s / s.completed, 1) if s.completed else None,
+                        "avg_wait_ms": round(1000 * s.wait_s / s.completed, 1) if s.completed else None,
+                        "queue_depth_ewma": round(s.ewma_depth, 2),
+                    }
+                    for name, s in self._stages.items()
+                },
+            }
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler() -> CoreScheduler:
+    """Bộ lập lịch dùng chung của process (khởi tạo lười, chỉ một lần)."""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = CoreScheduler()
+    return _scheduler
@@ -0,0 +1,161 @@
+# file: safe_calculator.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import ast  # Phân tích biểu thức thành cây cú pháp, KHÔNG thực thi mã.
+import math
+import operator
+import re
+import time
+from typing import Union
+
+Number = Union[int, float]
+
+# --- II. GIỚI HẠN AN TOÀN ---
+# Biểu thức do LLM sinh ra nên phải được coi là dữ liệu không tin cậy.
+# Các giới hạn dưới đây đảm bảo mỗi phép tính kết thúc trong thời gian rất ngắn.
+
+MAX_EXPRESSION_CHARS = 500  # Độ dài tối đa của biểu thức.
+MAX_NODES = 300  # Số nút tối đa của cây cú pháp.
+MAX_EXPONENT = 100  # Số mũ tối đa (chặn các biểu thức kiểu 9**9**9).
+MAX_MAGNITUDE = 1e30  # Giá trị tuyệt đối tối đa của mọi kết quả trung gian.
+MAX_EVAL_MS = 50.0  # Thời gian tính tối đa (ms).
+
+class CalculatorError(ValueError):
+    """Biểu thức không hợp lệ hoặc vượt quá giới hạn an toàn."""
+
+# --- III. CHUẨN HÓA SỐ KIỂU VIỆT NAM ---
+# - "1.250.000" hoặc "1.250" -> 1250000 / 1250 (dấu chấm phân tách hàng nghìn, nhóm 3 chữ số).
+# - "12,5" -> 12.5 (dấu phẩy thập phân); "1.250.000,5" -> 1250000.5.
+# - "1,250,000" (kiểu Anh, nhiều nhóm 3 chữ số) -> 1250000.
+# - Trong các hàm như sum(...), các đối số được ngăn cách bằng ";" hoặc ", " (phẩy + khoảng trắng).
+
+_ARG_SEP = "\x00"
+_NUMBER_TOKEN = re.compile(r"\d[\d.,]*")
+_VN_THOUSANDS = re.compile(r"\d{1,3}(?:\.\d{3})+(?:,\d+)?")
+_EN_THOUSANDS = re.compile(r"\d{1,3}(?:,\d{3}){2,}(?:\.\d+)?")
+
+def _normalize_number(token: str) -> str:
+    if _VN_THOUSANDS.fullmatch(token) and not token.startswith("0."):  # "0.125" là số thập phân.
+        return token.replace(".", "").replace(",", ".")
+    if _EN_THOUSANDS.fullmatch(token):
+        return token.replace(",", "")
+    if token.count(",") == 1 and "." not in token:
+        return token.replace(",", ".")  # Dấu phẩy thập phân.
+    if token.count(",") > 1 and "." not in token:
+        return token.replace(",", _ARG_SEP)  # "1,2,3" trong sum(1,2,3): danh sách số.
+    return token
+
+def normalize_expression(expression: str) -> str:
+    """Đưa biểu thức người dùng/LLM viết về cú pháp Python chỉ gồm số và toán tử."""
+    expr = expression.strip().rstrip("=?").strip()
+    expr = re.sub(r";|,\s+", _ARG_SEP, expr)
+    expr = _NUMBER_TOKEN.sub(lambda m: _normalize_number(m.group(0)), expr)
+    expr = re.sub(r"(?<=[\d)\s])[x×](?=[\s\d(])", "*", expr)
+    expr = expr.replace("÷", "/").replace(":", "/").replace("^", "**")
+    # Phần trăm: 15% -> 0.15; "%" đứng trước một toán hạng ("5 % 3") là phép chia lấy dư.
+    expr = re.sub(r"(\d+(?:\.\d+)?)\s*%(?!\s*[\d(.])", r"(\1/100)", expr)
+    return expr.replace(_ARG_SEP, ",")
+
+# --- IV. BỘ TÍNH TOÁN TRÊN CÂY CÚ PHÁP ---
+
+def _avg(*values: Number) -> float:
+    return sum(values) / len(values)
+
+_BIN_OPS = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+_UNARY_OPS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+# Các hàm được phép. Hàm tổng hợp nhận nhiều đối số hoặc một danh sách [a, b, c].
+_FUNCTIONS = {
+    "sum": lambda *v: sum(v), "tong": lambda *v: sum(v),
+    "avg": _avg, "mean": _avg, "tb": _avg, "trungbinh": _avg,
+    "min": min, "max": max, "abs": abs, "round": round, "sqrt": math.sqrt,
+}
+_AGGREGATES = {"sum", "tong", "avg", "mean", "tb", "trungbinh", "min", "max"}
+
+class _Evaluator:
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+
+    def _check(self, value) -> Number:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise CalculatorError("Kết quả không phải là số.")
+        if isinstance(value, float) and not math.isfinite(value):
+            raise CalculatorError("Kết quả không xác định (vô cực hoặc NaN).")
+        if abs(value) > MAX_MAGNITUDE:
+            raise CalculatorError(f"Kết quả vượt quá giới hạn {MAX_MAGNITUDE:g}.")
+        return value
+
+    def eval(self, node) -> Number:
+        if time.perf_counter() > self.deadline:
+            raise CalculatorError(f"Phép tính vượt quá {MAX_EVAL_MS:g} ms.")
+        if isinstance(node, ast.Expression):
+            return self.eval(node.body)
+        if isinstance(node, ast.Constant):
+            return self._check(node.value)
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPS:
+            return self._check(_UNARY_OPS[type(node.op)](self.eval(node.operand)))
+        if isinstance(node, ast.BinOp) and type(node.op) in _BIN_OPS:
+            left, right = self.eval(node.left), self.eval(node.right)
+            if isinstance(node.op, ast.Pow):
+                self._check_power(left, right)
+            try:
+                return self._check(_BIN_OPS[type(node.op)](left, right))
+            except ZeroDivisionError:
+                raise CalculatorError("Không thể chia cho 0.")
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            name = node.func.id.lower()
+            if name not in _FUNCTIONS:
+                raise CalculatorError(f"Hàm '{node.func.id}' không được hỗ trợ.")
+            args = []
+            for arg in node.args:
+                if isinstance(arg, (ast.List, ast.Tuple)) and name in _AGGREGATES:
+                    args.extend(self.eval(e) for e in arg.elts)  # sum([1, 2, 3])
+                else:
+                    args.append(self.eval(arg))
+            if not args:
+                raise CalculatorError(f"Hàm '{name}' cần ít nhất một đối số.")
+            try:
+                return self._check(_FUNCTIONS[name](*args))
+            except (TypeError, ValueError) as e:
+                raise CalculatorError(f"Đối số không hợp lệ cho '{name}': {e}")
+        raise CalculatorError(f"Thành phần không được phép trong biểu thức: {type(node).__name__}.")
+
+    @staticmethod
+    def _check_power(base: Number, exponent: Number):
+        if abs(exponent) > MAX_EXPONENT:
+            raise CalculatorError(f"Số mũ vượt quá giới hạn {MAX_EXPONENT}.")
+        # Ước lượng độ lớn trước khi tính, để không phải tạo ra số nguyên khổng lồ.
+        if abs(base) > 1 and exponent > 0 and exponent * math.log10(abs(base)) > math.log10(MAX_MAGNITUDE):
+            raise CalculatorError(f"Kết quả vượt quá giới hạn {MAX_MAGNITUDE:g}.")
+
+def evaluate(expression: str) -> Number:
+    """
+    Tính giá trị một biểu thức số học một cách an toàn (không dùng `eval`).
+
+    Hỗ trợ: + - * / // % **, ngoặc, phần trăm (15%), số kiểu Việt Nam (1.250.000; 12,5)
+    và các hàm sum/avg/min/max/abs/round/sqrt.
+
+    Raises:
+        CalculatorError: Biểu thức không hợp lệ hoặc vượt giới hạn an toàn.
+    """
+    if len(expression) > MAX_EXPRESSION_CHARS:
+        raise CalculatorError(f"Biểu thức dài hơn {MAX_EXPRESSION_CHARS} ký tự.")
+    try:
+        tree = ast.parse(normalize_expression(expression), mode="eval")
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        raise CalculatorError("Cú pháp biểu thức không hợp lệ.")
+    if sum(1 for _ in ast.walk(tree)) > MAX_NODES:
+        raise CalculatorError("Biểu thức quá phức tạp.")
+    return _Evaluator(time.perf_counter() + MAX_EVAL_MS / 1000.0).eval(tree)
+
+def format_number(value: Number) -> str:
+    """Định dạng kết quả theo kiểu Việt Nam: 1.250.000 hoặc 12,5."""
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        value = int(value)
+    if isinstance(value, int):
+        return f"{value:,}".replace(",", ".")
+    text = f"{value:,.6f}".rstrip("0").rstrip(".")
+    return text.replace(",", "\x00").replace(".", ",").replace("\x00", ".")
@@ -0,0 +1,143 @@
+# file: tool_runtime.py
+
+# --- I. KHAI BÁO THƯ VIỆN ---
+import os
+import json
+import asyncio  # Chạy song song các lệnh gọi công cụ trong cùng một bước của agent.
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError  # Luồng cho công cụ tốn CPU.
+from typing import Callable, Hashable, Optional
+
+from langchain_core.tools import BaseTool, StructuredTool  # Tạo công cụ có cả phiên bản đồng bộ và bất đồng bộ.
+
+logger = logging.getLogger(__name__)
+
+# --- II. CẤU HÌNH ---
+
+# Số luồng dùng chung cho các công cụ tốn CPU (thống kê, lọc hóa đơn...).
+TOOL_WORKERS = int(os.getenv("AGENT_TOOL_WORKERS", str(min(8, (os.cpu_count() or 2)))))
+# Thời gian tối đa (giây) của MỘT lần gọi công cụ.
+TOOL_TIMEOUT_S = float(os.getenv("AGENT_TOOL_TIMEOUT_S", "20"))
+# Số kết quả công cụ tối đa được ghi nhớ cho mỗi agent.
+TOOL_MEMO_MAX_ENTRIES = int(os.getenv("AGENT_TOOL_MEMO_MAX_ENTRIES", "256"))
+
+# Pool dùng chung của process: mọi agent/session cùng chia sẻ, nên số luồng CPU không tăng theo số người dùng.
+_POOL = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="agent-tool")
+
+def _timeout_message(name: str, timeout: float) -> str:
+    return f"Công cụ '{name}' không trả kết quả trong {timeout:g} giây. Hãy thử lại với yêu cầu đơn giản hơn."
+
+# --- III. BỘ CHẠY CÔNG CỤ ---
+
+class ToolRuntime:
+    """
+    Bọc các hàm công cụ của agent để:
+    - Chạy trong thread pool dùng chung và có phiên bản bất đồng bộ: khi LLM yêu cầu nhiều công cụ
+      trong một bước, AgentExecutor (chế độ async, xem `stream_agent_events`) chạy chúng song song.
+    - Giới hạn thời gian cho từng lần gọi; quá hạn thì trả về thông báo cho LLM thay vì treo cả lượt chat.
+    - Ghi nhớ (memoize) kết quả của các công cụ thuần túy theo (tên công cụ, tham số, trạng thái dữ liệu):
+      `state_fn` trả về khóa trạng thái của snapshot hóa đơn, nên kết quả cũ tự mất hiệu lực khi có hóa đơn mới.
+
+    Lưu ý: quá hạn chỉ dừng việc CHỜ; luồng đang chạy vẫn chạy nốt ở nền.
+    """
+
+    def __init__(self, state_fn: Callable[[], Hashable] = lambda: None, timeout: float = TOOL_TIMEOUT_S,
+                 memo_max_entries: int = TOOL_MEMO_MAX_ENTRIES):
+        self.state_fn = state_fn
+        self.timeout = timeout
+        self.memo_max_entries = memo_max_entries
+        self._memo: "OrderedDict[tuple, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memo_hits = 0
+        self.memo_misses = 0
+
+    def _memo_key(self, name: str, kwargs: dict) -> tuple:
+        return name, json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str), self.state_fn()
+
+    def _memo_get(self, key):
+        with self._lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                self.memo_hits += 1
+                return self._memo[key]
+            self.memo_misses += 1
+            return None
+
+    def _memo_put(self, key, value: str):
+        with self._lock:
+            self._memo[key] = value
+            while len(self._memo) > self.memo_max_entries:
+                self._memo.popitem(last=False)
+
+    def tool(self, memoize: bool = False, timeout: Optional[float] = None):
+        """
+        Decorator thay cho `@tool` của LangChain. Giữ nguyên tên, mô tả (docstring) và lược đồ tham số
+        của hàm, nên LLM thấy công cụ y hệt như trước.
+
+        Args:
+            memoize (bool): Ghi nhớ kết quả (chỉ dùng cho công cụ thuần túy: cùng tham số + cùng dữ liệu -> cùng kết quả).
+            timeout (float, optional): Thời gian tối đa riêng cho công cụ này.
+        """
+        limit = timeout or self.timeout
+
+        def decorator(fn: Callable[..., str]) -> BaseTool:
+            name = fn.__name__
+            base = StructuredTool.from_function(func=fn)  # Suy ra lược đồ tham số từ chữ ký hàm.
+
+            def call(**kwargs) -> str:
+                key = self._memo_key(name, kwargs) if memoize else None
+                if key is not None and (cached := self._memo_get(key)) is not None:
+                    return cached
+                result = fn(**kwargs)
+                if key is not None:
+                    self._memo_put(key, result)
+                return result
+
+            def run_sync(**kwargs) -> str:
+                try:
+                    return _POOL.submit(call, **kwargs).result(timeout=limit)
+                except FutureTimeoutError:
+                    logger.warning(f"Công cụ '{name}' quá hạn {limit:g}s.")
+                    return _timeout_message(name, limit)
+
+            async def run_async(**kwargs) -> str:
+                loop = asyncio.get_running_loop()
+                try:
+                    return await asyncio.wait_for(loop.run_in_executor(_POOL, lambda: call(**kwargs)), timeout=limit)
+                except asyncio.TimeoutError:
+                    logger.warning(f"Công cụ '{name}' quá hạn {limit:g}s.")
+                    return _timeout_message(name, limit)
+
+            return StructuredTool(name=name, description=base.description, args_schema=base.args_schema,
+                                  func=run_sync, coroutine=run_async)
+        return decorator
+
+    def wrap_async(self, tool: BaseTool, timeout: Optional[float] = None) -> BaseTool:
+        """
+        Bọc một công cụ có sẵn phiên bản async (ví dụ: tìm kiếm web qua mạng) để chạy trên event loop,
+        không chiếm luồng của pool, kèm giới hạn thời gian. Kết quả KHÔNG được ghi nhớ (dữ liệu ngoài thay đổi).
+        """
+        limit = timeout or self.timeout
+
+        async def run_async(**kwargs):
+            try:
+                return await asyncio.wait_for(tool.ainvoke(kwargs), timeout=limit)
+            except asyncio.TimeoutError:
+                logger.warning(f"Công cụ '{tool.name}' quá hạn {limit:g}s.")
+                return _timeout_message(tool.name, limit)
+
+        def run_sync(**kwargs):
+            # Chế độ đồng bộ: chạy phiên bản async trong một luồng của pool (công cụ có thể chỉ có bản async).
+            try:
+                return _POOL.submit(lambda: asyncio.run(tool.ainvoke(kwargs))).result(timeout=limit)
+            except FutureTimeoutError:
+                return _timeout_message(tool.name, limit)
+
+        return StructuredTool(name=tool.name, description=tool.description, args_schema=tool.args_schema,
+                              func=run_sync, coroutine=run_async)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"memo_hits": self.memo_hits, "memo_misses": self.memo_misses, "memo_entries": len(self._memo)}